@@ -0,0 +1,111 @@
+"""
+Encoding benchmark for tagged Entity schemas
+
+Measures the time per record to encode PFB Entities of a schema with many
+similar tables, with the PFB Entity schema, whose object union branch is
+found by matching each record, and with the tagged schema of the record's
+table (pfb_exporter.writer.make_tagged_schemas). Both must produce the same
+bytes.
+
+Usage:
+
+    python benchmarks/entity_encoding.py --tables 45 --rows 20000
+"""
+import io
+import time
+import random
+import argparse
+
+from fastavro import schemaless_writer
+
+from pfb_exporter.writer import PfbWriter, compile_schema
+
+# Attributes that nearly every table in the Kids First dataservice has
+COMMON_ATTRIBUTES = [
+    {'name': 'kf_id', 'type': 'string'},
+    {'name': 'uuid', 'type': 'string'},
+    {'name': 'created_at', 'type': 'string'},
+    {'name': 'modified_at', 'type': 'string'},
+    {'name': 'external_id', 'type': 'string'},
+    {'name': 'visible', 'type': 'boolean'},
+]
+
+
+def synthetic_schema(n_tables):
+    """
+    PFB schema with n_tables tables which share the common attributes and
+    have a few attributes of their own
+    """
+    return {
+        f'table_{i:02d}': {
+            'attributes': COMMON_ATTRIBUTES + [
+                {'name': f'attr_{i}_{j}', 'type': t}
+                for j, t in enumerate(['string', 'int', 'boolean', 'string'])
+            ],
+            'foreign_keys': [{'table': 'table_00', 'name': 'parent_id'}]
+        }
+        for i in range(n_tables)
+    }
+
+
+def synthetic_records(pfb_schema, n, seed=0):
+    """
+    Generator which yields n records spread evenly over the tables
+    """
+    rand = random.Random(seed)
+    tables = list(pfb_schema)
+    for i in range(n):
+        table = tables[i % len(tables)]
+        record = {'type': table, 'parent_id': f'TB_{rand.randrange(n):08d}'}
+        for attr in pfb_schema[table]['attributes']:
+            if attr['type'] == 'boolean':
+                record[attr['name']] = rand.random() < 0.5
+            elif attr['type'] == 'int':
+                record[attr['name']] = rand.randrange(1000)
+            else:
+                record[attr['name']] = f'{attr["name"]}-{i:08d}'
+        yield record
+
+
+def encode(entities, schemas):
+    """
+    Encode the Entities and return the seconds per Entity and the bytes
+    """
+    buf = io.BytesIO()
+    start = time.perf_counter()
+    for entity in entities:
+        schemaless_writer(buf, schemas(entity), entity)
+    return (time.perf_counter() - start) / len(entities), buf.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--tables', type=int, default=45)
+    parser.add_argument('--rows', type=int, default=20000)
+    args = parser.parse_args()
+
+    pfb_schema = synthetic_schema(args.tables)
+    compiled = compile_schema(pfb_schema)
+    writer = PfbWriter(io.BytesIO(), pfb_schema)
+    entities = [
+        writer.make_entity(r)
+        for r in synthetic_records(pfb_schema, args.rows)
+    ]
+
+    union, union_bytes = encode(
+        entities, lambda entity: compiled.parsed_schema
+    )
+    tagged, tagged_bytes = encode(
+        entities, lambda entity: compiled.tagged_schemas[entity['name']]
+    )
+    assert union_bytes == tagged_bytes
+
+    print(f'Tables:  {args.tables}')
+    print(f'Records: {args.rows}')
+    print(f'union:   {union * 1e6:.1f} us/record')
+    print(f'tagged:  {tagged * 1e6:.1f} us/record')
+    print(f'Speedup: {union / tagged:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Memory benchmark for the compact row representation
+
+Measures the bytes per record held in memory for synthetic participant-like
+records as parsed payload dicts and as compact rows (pfb_exporter.rows).
+
+Usage:
+
+    python benchmarks/row_memory.py --rows 1000000
+"""
+import gc
+import json
+import random
+import argparse
+import tracemalloc
+
+from pfb_exporter.rows import RowPacker
+
+PFB_SCHEMA = {
+    'participant': {
+        'attributes': [
+            {'name': 'kf_id', 'type': 'string'},
+            {'name': 'external_id', 'type': 'string'},
+            {'name': 'family_id', 'type': 'string'},
+            {'name': 'gender', 'type': 'string'},
+            {'name': 'ethnicity', 'type': 'string'},
+            {'name': 'race', 'type': 'string'},
+            {'name': 'is_proband', 'type': 'boolean'},
+            {'name': 'affected_status', 'type': 'boolean'},
+            {'name': 'diagnosis_category', 'type': 'string'},
+            {'name': 'days_to_lost_to_followup', 'type': 'int'},
+            {'name': 'visible', 'type': 'boolean'},
+            {'name': 'created_at', 'type': 'string'},
+        ],
+        'foreign_keys': [{'table': 'family', 'name': 'family_id'}]
+    }
+}
+
+
+def synthetic_payloads(n, seed=0):
+    """
+    Generator which yields n synthetic participant payloads, serialized the
+    way they are read from payload files
+    """
+    rand = random.Random(seed)
+    for i in range(n):
+        yield json.dumps({
+            'kf_id': f'PT_{i:08d}',
+            'external_id': f'ext-{rand.getrandbits(40):x}',
+            'family_id': f'FM_{i // 4:08d}',
+            'gender': rand.choice(['Female', 'Male', 'Not Reported']),
+            'ethnicity': rand.choice([
+                'Hispanic or Latino', 'Not Hispanic or Latino', 'Unknown'
+            ]),
+            'race': rand.choice([
+                'White', 'Asian', 'Black or African American', 'Other'
+            ]),
+            'is_proband': rand.random() < 0.3,
+            'affected_status': rand.random() < 0.5,
+            'diagnosis_category': rand.choice([
+                'Cancer', 'Structural Birth Defect', 'Other'
+            ]),
+            'days_to_lost_to_followup': rand.randrange(1000),
+            'visible': True,
+            'created_at': '2019-05-13T17:51:34.457937+00:00',
+            'type': 'participant'
+        })
+
+
+def measure(n, convert):
+    """
+    Hold n converted records in memory and return the traced bytes per
+    record
+    """
+    payloads = list(synthetic_payloads(n))
+    gc.collect()
+    tracemalloc.start()
+    held = [convert(json.loads(p)) for p in payloads]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(held) == n
+    return size / n
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    packer = RowPacker(PFB_SCHEMA)
+    before = measure(args.rows, lambda record: record)
+    after = measure(args.rows, packer.pack)
+
+    print(f'Records: {args.rows}')
+    print(f'dict:    {before:.0f} bytes/record')
+    print(f'row:     {after:.0f} bytes/record')
+    print(f'Saved:   {1 - after / before:.0%}')
+
+
+if __name__ == '__main__':
+    main()
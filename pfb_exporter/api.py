@@ -0,0 +1,170 @@
+"""
+In-process API for exporting records to PFB
+
+Use this API to write a PFB straight from Python iterables (or async
+iterables) of records to any binary file-like object or stream, without
+writing payloads to disk or running the CLI. Unlike the CLI, errors are
+raised as exceptions instead of exiting the process.
+
+Example:
+
+    from pfb_exporter.api import build_pfb_schema, export_records
+
+    pfb_schema = build_pfb_schema(models_filepath='models.py')
+    with open('study.avro', 'wb') as pfb_file:
+        export_records(
+            {'family': families, 'participant': participants},
+            pfb_file,
+            pfb_schema
+        )
+
+Tables are written in dependency level order so parents are written before
+their children. Records within a table are written in the order they are
+produced.
+"""
+import os
+from collections import defaultdict
+
+from pfb_exporter.config import (
+    DEFAULT_AVRO_CODEC,
+    DEFAULT_MODELS_PATH,
+    DEFAULT_TRANFORM_MOD
+)
+from pfb_exporter.export import create_transformer
+from pfb_exporter.graph import import_order
+from pfb_exporter.writer import PfbWriter
+
+
+class PfbExportError(Exception):
+    """
+    Raised when a PFB export fails
+    """
+
+
+def build_pfb_schema(
+    models_filepath=DEFAULT_MODELS_PATH,
+    db_conn_url=None,
+    transform_module_filepath=DEFAULT_TRANFORM_MOD,
+    output_dir=None
+):
+    """
+    Build the PFB schema from SQLAlchemy models or a database
+
+    :param models_filepath: path to where the SQLAlchemy models are stored
+    or will be written if they are generated
+    :type models_filepath: str
+    :param db_conn_url: Connection URL for database to generate models from
+    :type db_conn_url: str
+    :param transform_module_filepath: path to transform module
+    :type transform_module_filepath: str
+    :param output_dir: if provided, the PFB schema is also written here
+    :type output_dir: str
+    :raises PfbExportError: if the schema cannot be built
+    :returns: PFB schema dict
+    """
+    try:
+        transformer = create_transformer(
+            transform_module_filepath,
+            os.path.abspath(os.path.expanduser(models_filepath)),
+            output_dir,
+            db_conn_url=db_conn_url
+        )
+        return transformer.transform()
+    except Exception as e:
+        raise PfbExportError(f'Failed to build PFB schema: {e}') from e
+
+
+def _group_by_table(records, pfb_schema):
+    """
+    Normalize the records argument to a list of (table, iterable) in
+    import order
+    """
+    if isinstance(records, dict):
+        tables = records
+    else:
+        # A single stream of records with a `type` field cannot be
+        # reordered without buffering it, so it is written as is
+        return [(None, records)]
+
+    unknown = set(tables) - set(pfb_schema)
+    if unknown:
+        raise PfbExportError(
+            f'Tables {sorted(unknown)} are not in the PFB schema'
+        )
+
+    order = {table: i for i, table in enumerate(import_order(pfb_schema))}
+    return sorted(tables.items(), key=lambda item: order[item[0]])
+
+
+def _write(writer, table, record, counts):
+    try:
+        if writer.write(record, entity_type=table):
+            counts[table or record['type']] += 1
+    except Exception as e:
+        raise PfbExportError(
+            f'Failed to write {table or record.get("type")} record: {e}'
+        ) from e
+
+
+def export_records(
+    records, fo, pfb_schema, codec=DEFAULT_AVRO_CODEC
+):
+    """
+    Export records to a PFB file
+
+    :param records: dict of table name -> iterable of records, or an iterable
+    of records which each have a `type` field with their table name
+    :type records: dict or iterable
+    :param fo: path or binary file-like object or stream to write to
+    :type fo: str or file-like object
+    :param pfb_schema: PFB schema, see build_pfb_schema
+    :type pfb_schema: dict
+    :param codec: Avro compression codec
+    :type codec: str
+    :raises PfbExportError: if the export fails
+    :returns: dict of table name -> number of records written
+    """
+    counts = defaultdict(int)
+    try:
+        writer = PfbWriter(fo, pfb_schema, codec=codec)
+    except Exception as e:
+        raise PfbExportError(f'Failed to create PFB writer: {e}') from e
+
+    with writer:
+        writer.write_metadata()
+        for table, table_records in _group_by_table(records, pfb_schema):
+            for record in table_records:
+                _write(writer, table, record, counts)
+
+    return dict(counts)
+
+
+async def export_records_async(
+    records, fo, pfb_schema, codec=DEFAULT_AVRO_CODEC
+):
+    """
+    Export records from async iterables to a PFB file
+
+    Same as export_records except each iterable of records may be an
+    async iterable
+
+    :raises PfbExportError: if the export fails
+    :returns: dict of table name -> number of records written
+    """
+    counts = defaultdict(int)
+    try:
+        writer = PfbWriter(fo, pfb_schema, codec=codec)
+    except Exception as e:
+        raise PfbExportError(f'Failed to create PFB writer: {e}') from e
+
+    with writer:
+        writer.write_metadata()
+        for table, table_records in _group_by_table(records, pfb_schema):
+            if hasattr(table_records, '__aiter__'):
+                async for record in table_records:
+                    _write(writer, table, record, counts)
+            else:
+                for record in table_records:
+                    _write(writer, table, record, counts)
+
+    return dict(counts)
@@ -0,0 +1,305 @@
+"""
+Export a batch of studies in one process
+
+Running `export` once per study re-imports the models, rebuilds the PFB
+schema and recompiles the Avro schema for every study. A batch export does
+that once: the transformer, the PFB schema, the pooled database engine and
+the compiled schema (see pfb_exporter.writer.compile_schema) are shared by
+all studies, which run concurrently on a pool of jobs workers.
+
+Studies are listed in a YAML (or JSON) manifest. Each study has an output
+dir and either a data dir with its payloads or a root record which selects
+its records in the database (see pfb_exporter.subgraph):
+
+    studies:
+      - name: SD_00000001
+        data_dir: payloads/SD_00000001
+        output_dir: out/SD_00000001
+      - name: SD_00000002
+        root: study:kf_id=SD_00000002
+        output_dir: out/SD_00000002
+        detect_enums: true
+        columnar: parquet
+
+Relative paths are relative to the manifest's dir. Optional study settings:
+detect_enums, enum_threshold, enum_overrides, columnar, append, max_memory.
+
+Each study writes its log to <study output_dir>/logs. A study that fails
+does not stop the others. The status of every study is written to
+<batch output_dir>/status.json as the batch runs.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from pfb_exporter.config import (
+    BATCH_STATUS_FILE,
+    DEFAULT_BATCH_JOBS,
+    DEFAULT_DB_POOL_SIZE,
+    DEFAULT_ENUM_THRESHOLD,
+    DEFAULT_LOG_FILENAME,
+    DEFAULT_MODELS_PATH,
+    DEFAULT_OUTPUT_DIR,
+    DEFAULT_TRANFORM_MOD,
+    DEFAULT_WORKERS
+)
+from pfb_exporter.enums import parse_overrides
+from pfb_exporter.export import PfbExporter, create_transformer
+from pfb_exporter.extract import create_pooled_engine
+from pfb_exporter.memory import parse_size
+from pfb_exporter.subgraph import parse_root
+from pfb_exporter.utils import (
+    add_thread_log_handler,
+    remove_log_handler,
+    timestamp
+)
+
+STUDY_SETTINGS = {
+    'name', 'data_dir', 'root', 'output_dir', 'detect_enums',
+    'enum_threshold', 'enum_overrides', 'columnar', 'append', 'max_memory'
+}
+
+
+class ManifestError(ValueError):
+    """
+    Raised when a batch manifest is not valid
+    """
+
+
+def load_manifest(filepath):
+    """
+    Load and validate a batch manifest
+
+    :param filepath: path to the YAML or JSON manifest
+    :type filepath: str
+    :raises ManifestError: if the manifest is not valid
+    :returns: list of study dicts with absolute paths and parsed settings
+    """
+    with open(filepath) as manifest_file:
+        manifest = yaml.safe_load(manifest_file)
+    if not isinstance(manifest, dict) or not isinstance(
+        manifest.get('studies'), list
+    ):
+        raise ManifestError(
+            f'Manifest {filepath} must have a list of studies'
+        )
+
+    base_dir = os.path.dirname(os.path.abspath(filepath))
+
+    def _path(path):
+        return os.path.join(base_dir, os.path.expanduser(path))
+
+    studies = []
+    for i, study in enumerate(manifest['studies']):
+        if not isinstance(study, dict):
+            raise ManifestError(f'Study {i} in {filepath} is not a mapping')
+        unknown = set(study) - STUDY_SETTINGS
+        if unknown:
+            raise ManifestError(
+                f'Study {i} has unknown settings {sorted(unknown)}. '
+                f'Allowed: {sorted(STUDY_SETTINGS)}'
+            )
+        if not study.get('output_dir'):
+            raise ManifestError(f'Study {i} has no output_dir')
+        if bool(study.get('data_dir')) == bool(study.get('root')):
+            raise ManifestError(
+                f'Study {i} must have either a data_dir or a root'
+            )
+        study = dict(study)
+        study['output_dir'] = _path(study['output_dir'])
+        study.setdefault('name', os.path.basename(study['output_dir']))
+        try:
+            if study.get('data_dir'):
+                study['data_dir'] = _path(study['data_dir'])
+            else:
+                study['root'] = parse_root(study['root'])
+            study['enum_overrides'] = parse_overrides(
+                study.get('enum_overrides')
+            )
+            if study.get('max_memory'):
+                study['max_memory'] = parse_size(study['max_memory'])
+        except ValueError as e:
+            raise ManifestError(f'Study {study["name"]}: {e}')
+        studies.append(study)
+
+    names = [s['name'] for s in studies]
+    duplicates = sorted({n for n in names if names.count(n) > 1})
+    if duplicates:
+        raise ManifestError(f'Duplicate study names {duplicates}')
+    return studies
+
+
+class BatchExporter(object):
+
+    def __init__(
+        self,
+        manifest_filepath,
+        models_filepath=DEFAULT_MODELS_PATH,
+        transform_module_filepath=DEFAULT_TRANFORM_MOD,
+        output_dir=DEFAULT_OUTPUT_DIR,
+        db_conn_url=None,
+        jobs=DEFAULT_BATCH_JOBS,
+        workers=DEFAULT_WORKERS,
+        pool_size=DEFAULT_DB_POOL_SIZE
+    ):
+        """
+        Constructor. Loads the manifest and builds the PFB schema
+
+        :param manifest_filepath: path to the batch manifest
+        :type manifest_filepath: str
+        :param models_filepath: path to where the SQLAlchemy models are stored
+        or will be written if they are generated
+        :type models_filepath: str
+        :param transform_module_filepath: path to transform module
+        :type transform_module_filepath: str
+        :param output_dir: dir where the PFB schema, the batch log and the
+        batch status are written
+        :type output_dir: str
+        :param db_conn_url: Connection URL for database. Required by studies
+        with a root
+        :type db_conn_url: str
+        :param jobs: max number of studies exported at once
+        :type jobs: int
+        :param workers: max number of tables processed concurrently per study
+        :type workers: int
+        :param pool_size: number of pooled database connections shared by
+        all studies
+        :type pool_size: int
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.studies = load_manifest(manifest_filepath)
+        if not db_conn_url and any(s.get('root') for s in self.studies):
+            raise ManifestError(
+                'Studies with a root require a database connection URL'
+            )
+        self.output_dir = os.path.abspath(os.path.expanduser(output_dir))
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.status_file = os.path.join(self.output_dir, BATCH_STATUS_FILE)
+        self.jobs = jobs
+        self.workers = workers
+        self._lock = threading.Lock()
+        self.status = {
+            s['name']: {
+                'status': 'queued',
+                'output_dir': s['output_dir'],
+                'log': os.path.join(
+                    s['output_dir'], 'logs', DEFAULT_LOG_FILENAME
+                ),
+                'error': None,
+                'started_at': None,
+                'finished_at': None,
+                'seconds': None
+            }
+            for s in self.studies
+        }
+
+        self.transformer = create_transformer(
+            transform_module_filepath,
+            os.path.abspath(os.path.expanduser(models_filepath)),
+            self.output_dir,
+            db_conn_url=db_conn_url
+        )
+        self.pfb_schema = self.transformer.transform()
+        self.engine = (
+            create_pooled_engine(db_conn_url, pool_size)
+            if db_conn_url else None
+        )
+        # One scan slot per pooled connection, shared by all exports so
+        # together they never run more queries than the pool holds
+        self.scan_slots = threading.BoundedSemaphore(pool_size)
+
+    def run(self):
+        """
+        Export all studies
+
+        :returns: list of the names of the studies that failed
+        """
+        self.logger.info(
+            f'Exporting {len(self.studies)} studies with {self.jobs} jobs'
+        )
+        self._write_status()
+        try:
+            with ThreadPoolExecutor(
+                max_workers=self.jobs, thread_name_prefix='study'
+            ) as pool:
+                list(pool.map(self._run_study, self.studies))
+        finally:
+            if self.engine:
+                self.engine.dispose()
+
+        failed = [
+            name for name, s in self.status.items()
+            if s['status'] == 'failed'
+        ]
+        if failed:
+            self.logger.info(
+                f'❌ {len(failed)} of {len(self.studies)} studies failed: '
+                f'{failed}. See {self.status_file}'
+            )
+        else:
+            self.logger.info(
+                f'✅ Exported all {len(self.studies)} studies'
+            )
+        return failed
+
+    def _run_study(self, study):
+        """
+        Export one study on the current worker thread with the shared
+        transformer, PFB schema and engine
+        """
+        name = study['name']
+        status = self.status[name]
+        self._update(name, status='running', started_at=timestamp())
+        handler = add_thread_log_handler(status['log'])
+        start = time.monotonic()
+        try:
+            PfbExporter(
+                study.get('data_dir'),
+                output_dir=study['output_dir'],
+                workers=self.workers,
+                detect_enums=study.get('detect_enums', False),
+                enum_threshold=study.get(
+                    'enum_threshold', DEFAULT_ENUM_THRESHOLD
+                ),
+                enum_overrides=study['enum_overrides'],
+                columnar_format=study.get('columnar'),
+                transformer=self.transformer,
+                pfb_schema=self.pfb_schema,
+                engine=self.engine,
+                scan_slots=self.scan_slots,
+                setup_logging=False,
+                append=study.get('append', False),
+                root=study.get('root'),
+                max_memory=study.get('max_memory')
+            ).run()
+        except Exception as e:
+            self._update(name, status='failed', error=str(e))
+        else:
+            self._update(name, status='succeeded')
+        finally:
+            remove_log_handler(handler)
+            self._update(
+                name,
+                finished_at=timestamp(),
+                seconds=round(time.monotonic() - start, 3)
+            )
+            self.logger.info(f'Study {name} {status["status"]}')
+
+    def _update(self, name, **kwargs):
+        """
+        Update the status of a study and rewrite the status file
+        """
+        with self._lock:
+            self.status[name].update(kwargs)
+            self._write_status()
+
+    def _write_status(self):
+        tmp_file = f'{self.status_file}.tmp'
+        with open(tmp_file, 'w') as json_file:
+            json.dump(self.status, json_file, indent=4)
+        os.replace(tmp_file, self.status_file)
@@ -1,6 +1,9 @@
 """
 Entry point for the Kids First PFB Exporter
 """
+import os
+import json
+import logging
 
 import click
 
@@ -8,9 +11,29 @@ import click
 from pfb_exporter.config import (
     DEFAULT_TRANFORM_MOD,
     DEFAULT_OUTPUT_DIR,
-    DEFAULT_MODELS_PATH
+    DEFAULT_MODELS_PATH,
+    DEFAULT_WORKERS,
+    DEFAULT_ENUM_THRESHOLD,
+    DEFAULT_SERVER_HOST,
+    DEFAULT_SERVER_PORT,
+    DEFAULT_MAX_JOBS,
+    DEFAULT_JOB_QUEUE_SIZE,
+    DEFAULT_DB_POOL_SIZE,
+    DEFAULT_SCAN_WORKERS,
+    DEFAULT_SCAN_SLICES,
+    DEFAULT_BATCH_JOBS,
+    DEFAULT_ESTIMATE_SAMPLE_SIZE
 )
+from pfb_exporter.batch import BatchExporter
+from pfb_exporter.columnar import COLUMNAR_FORMATS
+from pfb_exporter.enums import parse_overrides
 from pfb_exporter.export import PfbExporter
+from pfb_exporter.index import RecordIndexError, build_index, get_records
+from pfb_exporter.memory import parse_size
+from pfb_exporter.merge import PfbMerger
+from pfb_exporter.server import ExportServer
+from pfb_exporter.subgraph import parse_root
+from pfb_exporter.utils import setup_logger
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
@@ -60,12 +83,164 @@ def common_args_options(func):
     return func
 
 
+def enum_options(func):
+    """
+    Click options for detecting low-cardinality text columns and encoding
+    them as Avro enums
+    """
+    func = click.option(
+        '--enum_override',
+        multiple=True,
+        help='Force a column to be encoded as an enum or a string. '
+        'Format: <table>.<column>=<enum|string>. May be repeated')(func)
+
+    func = click.option(
+        '--enum_threshold',
+        help='Max number of distinct values in a column encoded as an enum',
+        show_default=True,
+        default=DEFAULT_ENUM_THRESHOLD,
+        type=click.IntRange(min=1))(func)
+
+    func = click.option(
+        '--detect_enums',
+        is_flag=True,
+        help='Profile the payloads (or the database) and encode '
+        'low-cardinality text columns as Avro enums')(func)
+
+    return func
+
+
+def table_options(func):
+    """
+    Click options for selecting the tables that are reflected, imported and
+    exported
+    """
+    func = click.option(
+        '--db_schema',
+        help='Database schema to generate the models from. Defaults to the '
+        'database\'s default schema')(func)
+
+    func = click.option(
+        '--exclude_tables',
+        multiple=True,
+        help='Leave out these tables. Comma separated, may be repeated. '
+        'Foreign keys to them are left out of the PFB schema',
+        callback=_parse_tables)(func)
+
+    func = click.option(
+        '--tables',
+        multiple=True,
+        help='Only export these tables and the tables they depend on '
+        'through foreign keys. Comma separated, may be repeated',
+        callback=_parse_tables)(func)
+
+    return func
+
+
+def profile_option(func):
+    """
+    Click option for profiling each phase of the command
+    """
+    return click.option(
+        '--profile',
+        is_flag=True,
+        help='Profile each phase with cProfile and tracemalloc and write '
+        'pstats, allocation and collapsed stack (flamegraph) files to '
+        'output_dir/profile')(func)
+
+
+def _parse_tables(ctx, param, values):
+    tables = [t.strip() for v in values for t in v.split(',') if t.strip()]
+    return tables or None
+
+
+def _parse_enum_overrides(values):
+    try:
+        return parse_overrides(values)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--enum_override')
+
+
+def _parse_size(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return parse_size(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def _parse_root(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return parse_root(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
 @click.command()
 @common_args_options
-@click.argument('data_dir',
+@enum_options
+@table_options
+@profile_option
+@click.option(
+    '--columnar',
+    help='Also write one file per table in this columnar format to '
+    'output_dir/tables, from the same pass over the records',
+    type=click.Choice(list(COLUMNAR_FORMATS)))
+@click.option(
+    '--workers', '-w',
+    help='Max number of tables in the same dependency level to process '
+    'concurrently',
+    show_default=True,
+    default=DEFAULT_WORKERS,
+    type=click.IntRange(min=1))
+@click.option(
+    '--scan_workers',
+    help='Number of key range slices of a table read concurrently when '
+    'exporting from the database',
+    show_default=True,
+    default=DEFAULT_SCAN_WORKERS,
+    type=click.IntRange(min=1))
+@click.option(
+    '--scan_slices',
+    help='Number of key range slices large tables are split into when '
+    'exporting from the database',
+    show_default=True,
+    default=DEFAULT_SCAN_SLICES,
+    type=click.IntRange(min=1))
+@click.option(
+    '--scan_key',
+    help='Column to split tables into key range slices by, e.g. created_at. '
+    'Defaults to the primary key')
+@click.option(
+    '--append',
+    is_flag=True,
+    help='Append to the PFB file in output_dir instead of overwriting it. '
+    'The PFB schema must be backward compatible with the file\'s schema')
+@click.option(
+    '--root',
+    help='Only export the records connected to this root record through '
+    'foreign keys. Format: <table>:<key>=<value>, e.g. '
+    'study:kf_id=SD_00000001',
+    callback=_parse_root)
+@click.option(
+    '--max_memory',
+    help='Memory budget for the export\'s buffers, e.g. 6G. When it is '
+    'reached, readers wait and the largest buffers are spilled to disk',
+    callback=_parse_size)
+@click.option(
+    '--pool_size',
+    help='Number of pooled database connections. Defaults to scan_workers',
+    type=click.IntRange(min=1))
+@click.argument('data_dir', required=False,
                 type=click.Path(exists=True, file_okay=True, dir_okay=True))
 def export(
-    data_dir, database_url, models_filepath, transform_module, output_dir
+    data_dir, database_url, models_filepath, transform_module, output_dir,
+    workers, columnar, detect_enums, enum_threshold, enum_override,
+    scan_workers, scan_slices, scan_key, pool_size, profile, append, root,
+    max_memory, tables, exclude_tables, db_schema
 ):
     """
     Export Kids First data to PFB (Portable Bioinformatics Format)
@@ -74,16 +249,107 @@ def export(
     Arguments:
         \b
         data_dir - Path to directory containing the JSON payloads which
-        conform to the SQLAlchemy models.
+        conform to the SQLAlchemy models. If omitted, the data is read
+        from the database at --database_url.
     """
+    if not (data_dir or database_url):
+        raise click.UsageError('Either DATA_DIR or --database_url is required')
+
     PfbExporter(
         data_dir, database_url, models_filepath, transform_module, output_dir,
+        workers=workers,
+        detect_enums=detect_enums,
+        enum_threshold=enum_threshold,
+        enum_overrides=_parse_enum_overrides(enum_override),
+        columnar_format=columnar,
+        scan_workers=scan_workers,
+        scan_slices=scan_slices,
+        scan_key=scan_key,
+        pool_size=pool_size,
+        profile=profile,
+        append=append,
+        root=root,
+        max_memory=max_memory,
+        tables=tables,
+        exclude_tables=exclude_tables,
+        db_schema=db_schema
     ).export()
 
 
+@click.command()
+@common_args_options
+@table_options
+@click.option(
+    '--sample_size',
+    help='Max number of records sampled per payload file or table',
+    show_default=True,
+    default=DEFAULT_ESTIMATE_SAMPLE_SIZE,
+    type=click.IntRange(min=1))
+@click.option(
+    '--workers', '-w',
+    help='Max number of tables in the same dependency level the export '
+    'will process concurrently',
+    show_default=True,
+    default=DEFAULT_WORKERS,
+    type=click.IntRange(min=1))
+@click.option(
+    '--scan_workers',
+    help='Number of key range slices of a table the export will read '
+    'concurrently from the database',
+    show_default=True,
+    default=DEFAULT_SCAN_WORKERS,
+    type=click.IntRange(min=1))
+@click.option(
+    '--max_memory',
+    help='Memory budget the export will run with, e.g. 6G',
+    callback=_parse_size)
+@click.argument('data_dir', required=False,
+                type=click.Path(exists=True, file_okay=True, dir_okay=True))
+def estimate(
+    data_dir, database_url, models_filepath, transform_module, output_dir,
+    tables, exclude_tables, db_schema, sample_size, workers,
+    scan_workers, max_memory
+):
+    """
+    Estimate the wall time, output size and peak memory of an export from a
+    sample of each table, without running the export. The estimate is
+    written to output_dir/estimate.json
+
+    \b
+    Arguments:
+        \b
+        data_dir - Path to directory containing the JSON payloads. If
+        omitted, the tables are sampled from the database at --database_url.
+    """
+    if not (data_dir or database_url):
+        raise click.UsageError('Either DATA_DIR or --database_url is required')
+
+    exporter = PfbExporter(
+        data_dir, database_url, models_filepath, transform_module, output_dir,
+        workers=workers,
+        scan_workers=scan_workers,
+        max_memory=max_memory,
+        tables=tables,
+        exclude_tables=exclude_tables,
+        db_schema=db_schema
+    )
+    try:
+        exporter.estimate(sample_size=sample_size)
+    except Exception as e:
+        exporter.logger.exception(str(e))
+        exit(1)
+
+
 @click.command('create_schema')
 @common_args_options
-def create_schema(database_url, models_filepath, transform_module, output_dir):
+@enum_options
+@table_options
+@profile_option
+def create_schema(
+    database_url, models_filepath, transform_module, output_dir,
+    detect_enums, enum_threshold, enum_override, tables, exclude_tables,
+    db_schema, profile
+):
     """
     Transform Kids First relational model into a Gen3 data dictionary, which
     is a required input for PFB file creation.
@@ -96,9 +362,232 @@ def create_schema(database_url, models_filepath, transform_module, output_dir):
     """
 
     PfbExporter(
-        '', database_url, models_filepath, transform_module, output_dir
+        '', database_url, models_filepath, transform_module, output_dir,
+        detect_enums=detect_enums,
+        enum_threshold=enum_threshold,
+        enum_overrides=_parse_enum_overrides(enum_override),
+        profile=profile,
+        tables=tables,
+        exclude_tables=exclude_tables,
+        db_schema=db_schema
     ).export(output_to_pfb=False)
 
 
+@click.command()
+@common_args_options
+@click.option(
+    '--host',
+    help='Host to listen on',
+    show_default=True,
+    default=DEFAULT_SERVER_HOST)
+@click.option(
+    '--port', '-p',
+    help='Port to listen on',
+    show_default=True,
+    default=DEFAULT_SERVER_PORT,
+    type=int)
+@click.option(
+    '--socket', 'socket_path',
+    help='Listen on this Unix socket instead of host and port',
+    type=click.Path(dir_okay=False))
+@click.option(
+    '--max_jobs', '-j',
+    help='Max number of export jobs that run at once',
+    show_default=True,
+    default=DEFAULT_MAX_JOBS,
+    type=click.IntRange(min=1))
+@click.option(
+    '--queue_size',
+    help='Max number of export jobs waiting to run',
+    show_default=True,
+    default=DEFAULT_JOB_QUEUE_SIZE,
+    type=click.IntRange(min=1))
+@click.option(
+    '--pool_size',
+    help='Number of pooled database connections',
+    show_default=True,
+    default=DEFAULT_DB_POOL_SIZE,
+    type=click.IntRange(min=1))
+@click.option(
+    '--workers', '-w',
+    help='Max number of tables in the same dependency level to process '
+    'concurrently within a job',
+    show_default=True,
+    default=DEFAULT_WORKERS,
+    type=click.IntRange(min=1))
+def serve(
+    database_url, models_filepath, transform_module, output_dir, host, port,
+    socket_path, max_jobs, queue_size, pool_size, workers
+):
+    """
+    Run a long running export server which keeps the models, PFB schema and
+    database connection pool loaded and runs export jobs submitted over a
+    local HTTP API
+
+    \b
+    Submit a job:
+        curl -X POST localhost:8765/jobs -d '{"data_dir": "/path/to/data"}'
+    """
+    setup_logger(os.path.join(output_dir, 'logs'))
+    ExportServer(
+        models_filepath=models_filepath,
+        transform_module_filepath=transform_module,
+        output_dir=output_dir,
+        db_conn_url=database_url,
+        max_jobs=max_jobs,
+        queue_size=queue_size,
+        pool_size=pool_size,
+        workers=workers
+    ).serve_forever(host=host, port=port, socket_path=socket_path)
+
+
+@click.command()
+@common_args_options
+@click.option(
+    '--jobs', '-j',
+    help='Max number of studies exported at once',
+    show_default=True,
+    default=DEFAULT_BATCH_JOBS,
+    type=click.IntRange(min=1))
+@click.option(
+    '--workers', '-w',
+    help='Max number of tables in the same dependency level to process '
+    'concurrently within a study',
+    show_default=True,
+    default=DEFAULT_WORKERS,
+    type=click.IntRange(min=1))
+@click.option(
+    '--pool_size',
+    help='Number of pooled database connections shared by all studies',
+    show_default=True,
+    default=DEFAULT_DB_POOL_SIZE,
+    type=click.IntRange(min=1))
+@click.argument('manifest',
+                type=click.Path(exists=True, file_okay=True, dir_okay=False))
+def batch(
+    manifest, database_url, models_filepath, transform_module, output_dir,
+    jobs, workers, pool_size
+):
+    """
+    Export a batch of studies listed in a manifest in one process, building
+    the PFB schema once. Exits with status 1 if any study failed. See
+    output_dir/status.json for the status of each study
+
+    \b
+    Arguments:
+        \b
+        manifest - Path to a YAML manifest with the data_dir (or the root
+        record in the database) and output_dir of each study. See
+        pfb_exporter.batch
+    """
+    setup_logger(os.path.join(output_dir, 'logs'))
+    try:
+        failed = BatchExporter(
+            manifest,
+            models_filepath=models_filepath,
+            transform_module_filepath=transform_module,
+            output_dir=output_dir,
+            db_conn_url=database_url,
+            jobs=jobs,
+            workers=workers,
+            pool_size=pool_size
+        ).run()
+    except Exception as e:
+        logging.getLogger('batch').exception(str(e))
+        exit(1)
+    if failed:
+        exit(1)
+
+
+@click.command()
+@click.option(
+    '--output', '-o', 'output_filepath',
+    required=True,
+    help='Path to the merged PFB file',
+    type=click.Path(dir_okay=False))
+@click.argument('pfb_files', nargs=-1, required=True,
+                type=click.Path(exists=True, file_okay=True, dir_okay=False))
+def merge(pfb_files, output_filepath):
+    """
+    Merge PFB files with identical or compatible schemas into one PFB file,
+    copying their data blocks without decoding the records
+
+    \b
+    Arguments:
+        \b
+        pfb_files - Paths to the PFB files to merge
+    """
+    output_dir = os.path.dirname(os.path.abspath(output_filepath))
+    setup_logger(os.path.join(output_dir, 'logs'))
+    try:
+        PfbMerger(pfb_files, output_filepath).merge()
+    except Exception as e:
+        logging.getLogger('merge').exception(str(e))
+        exit(1)
+
+
+@click.command()
+@click.option(
+    '--index', 'index_filepath',
+    help='Path to the record id index. Defaults to <pfb_file>.idx',
+    type=click.Path(dir_okay=False))
+@click.argument('pfb_file',
+                type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.argument('entity_type')
+@click.argument('record_ids', nargs=-1, required=True)
+def get(pfb_file, entity_type, record_ids, index_filepath):
+    """
+    Print PFB Entities by id as JSON lines, using the PFB file's record id
+    index to decode only the blocks they are in
+
+    \b
+    Arguments:
+        \b
+        pfb_file - Path to the PFB file
+        entity_type - Table of the Entities, e.g. participant
+        record_ids - Ids of the Entities, e.g. PT_00000001
+    """
+    try:
+        entities = get_records(
+            pfb_file, entity_type, record_ids, index_filepath=index_filepath
+        )
+    except RecordIndexError as e:
+        raise click.ClickException(str(e))
+    for entity in entities:
+        click.echo(json.dumps(entity, default=str))
+
+    missing = set(record_ids) - {e['id'] for e in entities}
+    if missing:
+        click.echo(f'Not found: {", ".join(sorted(missing))}', err=True)
+        exit(1)
+
+
+@click.command()
+@click.option(
+    '--index', 'index_filepath',
+    help='Path to the record id index. Defaults to <pfb_file>.idx',
+    type=click.Path(dir_okay=False))
+@click.argument('pfb_file',
+                type=click.Path(exists=True, file_okay=True, dir_okay=False))
+def index(pfb_file, index_filepath):
+    """
+    Build the record id index of a PFB file, e.g. one written before
+    indexes were written by export or one created by merge
+
+    \b
+    Arguments:
+        \b
+        pfb_file - Path to the PFB file
+    """
+    count = build_index(pfb_file, index_filepath=index_filepath)
+    click.echo(f'Indexed {count} entities in {pfb_file}')
+
+
 cli.add_command(export)
 cli.add_command(create_schema)
+cli.add_command(serve)
+cli.add_command(merge)
+cli.add_command(batch)
+cli.add_command(get)
+cli.add_command(index)
+cli.add_command(estimate)
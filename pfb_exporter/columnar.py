@@ -0,0 +1,213 @@
+"""
+Write a columnar copy of the exported records, one dataset per table
+
+The columnar writer is fed from the same record stream as the PFB writer, so
+analytics consumers get per-table Parquet (or Arrow IPC) files without a
+second pass over the input or re-parsing the PFB file. Column types come from
+the PFB schema. Records are buffered per table into record batches of
+batch_size rows. With a memory governor, a table's batch is written early
+when the governor asks for it.
+
+Requires pyarrow: pip install kf-lib-pfb-exporter[columnar]
+"""
+import os
+import logging
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+from pfb_exporter.config import DEFAULT_RECORD_BATCH_SIZE, COLUMNAR_DIR
+from pfb_exporter.memory import record_size
+from pfb_exporter.writer import avro_attributes, coerce_value
+
+COLUMNAR_FORMATS = {
+    'parquet': '.parquet',
+    'arrow': '.arrow',
+}
+
+
+def arrow_type(attr):
+    """
+    Get the Arrow type for an attribute in the PFB schema
+    """
+    if attr['type'] == 'enum':
+        return pa.dictionary(pa.int32(), pa.string())
+    return {
+        'string': pa.string(),
+        'boolean': pa.bool_(),
+        'float': pa.float32(),
+        'double': pa.float64(),
+        'int': pa.int32(),
+        'long': pa.int64(),
+    }[attr['type']]
+
+
+def arrow_schema(node_schema):
+    """
+    Create the Arrow schema for one table in the PFB schema
+    """
+    return pa.schema([
+        pa.field(attr['name'], arrow_type(attr), nullable=True)
+        for attr in avro_attributes(node_schema)
+    ])
+
+
+class _TableWriter(object):
+    """
+    Buffers the records of one table and writes them as record batches
+    """
+
+    def __init__(self, filepath, node_schema, fmt, batch_size, memory=None):
+        self.filepath = filepath
+        self.memory = memory
+        self.schema = arrow_schema(node_schema)
+        self.attributes = [
+            (a['name'], a['type']) for a in avro_attributes(node_schema)
+        ]
+        self.batch_size = batch_size
+        self.row_count = 0
+        self._columns = {name: [] for name, _ in self.attributes}
+        self._buffered = 0
+
+        if fmt == 'parquet':
+            self._writer = pq.ParquetWriter(filepath, self.schema)
+        else:
+            self._sink = pa.OSFile(filepath, 'wb')
+            self._writer = pa.ipc.new_file(self._sink, self.schema)
+
+    def write(self, record):
+        """
+        :returns: whether the memory governor asked for a spill
+        """
+        spill = self.memory.add(record_size(record)) if self.memory else False
+        for name, atype in self.attributes:
+            value = record.get(name)
+            if atype == 'enum':
+                value = None if value is None else str(value)
+            else:
+                value = coerce_value(value, atype)
+            self._columns[name].append(value)
+        self._buffered += 1
+        if self._buffered >= self.batch_size:
+            self.flush()
+        return spill
+
+    def flush(self):
+        if not self._buffered:
+            return
+        batch = pa.RecordBatch.from_arrays(
+            [
+                pa.array(self._columns[field.name], type=field.type)
+                for field in self.schema
+            ],
+            schema=self.schema
+        )
+        self._writer.write_batch(batch)
+        self.row_count += self._buffered
+        self._columns = {name: [] for name, _ in self.attributes}
+        self._buffered = 0
+        if self.memory:
+            self.memory.release()
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+        if hasattr(self, '_sink'):
+            self._sink.close()
+
+
+class ColumnarWriter(object):
+
+    def __init__(
+        self,
+        output_dir,
+        pfb_schema,
+        fmt='parquet',
+        batch_size=DEFAULT_RECORD_BATCH_SIZE,
+        memory=None
+    ):
+        """
+        Constructor
+
+        :param output_dir: dir where the columnar dir with one file per table
+        is created
+        :type output_dir: str
+        :param pfb_schema: table name -> attributes and foreign keys
+        :type pfb_schema: dict
+        :param fmt: columnar file format, one of COLUMNAR_FORMATS
+        :type fmt: str
+        :param batch_size: number of rows per record batch
+        :type batch_size: int
+        :param memory: if provided, the record batches are registered with
+        this memory governor
+        :type memory: pfb_exporter.memory.MemoryGovernor
+        """
+        if pa is None:
+            raise ImportError(
+                'Columnar output requires pyarrow. Install it with: '
+                'pip install kf-lib-pfb-exporter[columnar]'
+            )
+        if fmt not in COLUMNAR_FORMATS:
+            raise ValueError(
+                f'Unsupported columnar format {fmt}. Supported formats: '
+                f'{list(COLUMNAR_FORMATS)}'
+            )
+        self.logger = logging.getLogger(type(self).__name__)
+        self.output_dir = os.path.join(output_dir, COLUMNAR_DIR)
+        self.pfb_schema = pfb_schema
+        self.fmt = fmt
+        self.batch_size = batch_size
+        self.memory = memory
+        self._tables = {}
+        os.makedirs(self.output_dir, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def filepath(self, table):
+        """
+        Path to the columnar file for a table
+        """
+        return os.path.join(
+            self.output_dir, f'{table}{COLUMNAR_FORMATS[self.fmt]}'
+        )
+
+    def write(self, record, entity_type=None):
+        """
+        Buffer a payload record in its table's next record batch
+
+        Records whose entity type is not in the PFB schema are skipped
+        """
+        table = entity_type or record.get('type')
+        writer = self._tables.get(table)
+        if writer is None:
+            node = self.pfb_schema.get(table)
+            if node is None:
+                return
+            writer = self._tables[table] = _TableWriter(
+                self.filepath(table), node, self.fmt, self.batch_size,
+                memory=self.memory and self.memory.consumer(
+                    'columnar batches', spillable=True
+                )
+            )
+        if writer.write(record):
+            # Write the table's partial batch when the governor asks for it
+            writer.flush()
+            writer.memory.spilled()
+
+    def close(self):
+        """
+        Flush all buffered record batches and close the files
+        """
+        for table, writer in self._tables.items():
+            writer.close()
+            self.logger.info(
+                f'Wrote {writer.row_count} {table} rows to {writer.filepath}'
+            )
+        self._tables.clear()
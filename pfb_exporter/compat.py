@@ -0,0 +1,375 @@
+"""
+Compare PFB schemas and update existing PFB files in place
+
+Any change to the models used to mean a full re-export. This module lets an
+export append to an existing PFB file when the new PFB schema is backward
+compatible with the schema the file was written with.
+
+Schemas are identified by the CRC-64-AVRO (Rabin) fingerprint of their
+Parsing Canonical Form (PCF), as defined by the Avro spec and computed by
+fastavro.
+
+A new PFB schema is compatible with an old one if every change is one of:
+
+- A new table
+- A new attribute (all attributes are nullable)
+- A widened type: int -> long, float or double, long -> float or double,
+  float -> double
+- New enum values
+
+Removed tables and attributes, narrowed or changed types and changed logical
+types are incompatible.
+
+When the schemas are compatible but not identical, the file is rewritten with
+the new schema in its header before new records are appended. Blocks whose
+encoding is the same under both schemas (e.g. when only tables were added)
+are copied as is. Other blocks are decoded with the old schema, resolved to
+the new one and re-encoded.
+"""
+import os
+import logging
+from copy import deepcopy
+
+from fastavro import parse_schema
+from fastavro.schema import (
+    fingerprint as avro_fingerprint,
+    to_parsing_canonical_form
+)
+
+from pfb_exporter.container import Block, Header, iter_blocks
+from pfb_exporter.enums import decode_enum
+from pfb_exporter.writer import make_avro_schema, make_metadata
+
+AVRO_PRIMITIVES = {
+    'null', 'boolean', 'int', 'long', 'float', 'double', 'bytes', 'string'
+}
+
+# type -> types it may be widened to
+WIDENED_TYPES = {
+    'int': {'long', 'float', 'double'},
+    'long': {'float', 'double'},
+    'float': {'double'},
+}
+
+
+class IncompatibleSchemaError(ValueError):
+    """
+    Raised when a PFB schema is not backward compatible with the schema of
+    an existing PFB file
+    """
+
+    def __init__(self, incompatible):
+        self.incompatible = incompatible
+        super().__init__(
+            'The PFB schemas are not compatible:\n' +
+            '\n'.join(f'- {c}' for c in incompatible)
+        )
+
+
+def fingerprint(schema):
+    """
+    Get the CRC-64-AVRO fingerprint of the Parsing Canonical Form of an
+    Avro schema
+
+    :param schema: Avro schema
+    :type schema: dict, list or str
+    :returns: fingerprint as a hex string
+    """
+    return avro_fingerprint(to_parsing_canonical_form(schema), 'CRC-64-AVRO')
+
+
+def pfb_schema_from_avro(avro_schema):
+    """
+    Recover the PFB schema from the Avro schema of a PFB file. Foreign keys
+    are not part of the Avro schema, so the tables have none
+
+    :param avro_schema: Avro schema created by
+    pfb_exporter.writer.make_avro_schema
+    :type avro_schema: dict
+    :returns: PFB schema dict
+    """
+    object_field = next(
+        f for f in avro_schema['fields'] if f['name'] == 'object'
+    )
+    pfb_schema = {}
+    for node in object_field['type']:
+        if node['name'] == 'Metadata':
+            continue
+        attributes = []
+        for field in node['fields']:
+            atype = next(t for t in field['type'] if t != 'null')
+            attr = {'name': field['name']}
+            if isinstance(atype, str):
+                attr['type'] = atype
+            elif atype['type'] == 'enum':
+                attr['type'] = 'enum'
+                attr['symbols'] = [decode_enum(s) for s in atype['symbols']]
+            else:
+                attr['type'] = atype['type']
+                attr['logicalType'] = atype['logicalType']
+            attributes.append(attr)
+        pfb_schema[node['name']] = {'attributes': attributes}
+    return pfb_schema
+
+
+class SchemaChanges(object):
+
+    def __init__(self, old_pfb_schema, new_pfb_schema):
+        """
+        Compare two PFB schemas
+
+        :param old_pfb_schema: PFB schema of the existing PFB file
+        :type old_pfb_schema: dict
+        :param new_pfb_schema: newly created PFB schema
+        :type new_pfb_schema: dict
+        """
+        # Descriptions of the compatible and incompatible changes
+        self.compatible = []
+        self.incompatible = []
+
+        for table in old_pfb_schema:
+            if table not in new_pfb_schema:
+                self.incompatible.append(f'Removed table {table}')
+
+        for table, node in new_pfb_schema.items():
+            if table not in old_pfb_schema:
+                self.compatible.append(f'Added table {table}')
+                continue
+            old_attrs = _attributes_by_name(old_pfb_schema[table])
+            new_attrs = _attributes_by_name(node)
+            for name in old_attrs:
+                if name not in new_attrs:
+                    self.incompatible.append(
+                        f'Removed attribute {table}.{name}'
+                    )
+            for name, attr in new_attrs.items():
+                if name not in old_attrs:
+                    self.compatible.append(f'Added attribute {table}.{name}')
+                else:
+                    self._compare(f'{table}.{name}', old_attrs[name], attr)
+
+    def _compare(self, name, old, new):
+        old_type, new_type = old['type'], new['type']
+        if old.get('logicalType') != new.get('logicalType'):
+            self.incompatible.append(
+                f'Changed logical type of {name} from '
+                f'{old.get("logicalType")} to {new.get("logicalType")}'
+            )
+        elif old_type == 'enum' and new_type == 'enum':
+            removed = set(old['symbols']) - set(new['symbols'])
+            if removed:
+                self.incompatible.append(
+                    f'Removed enum values {sorted(removed)} from {name}'
+                )
+            elif len(new['symbols']) > len(old['symbols']):
+                self.compatible.append(f'Added enum values to {name}')
+        elif old_type == new_type:
+            return
+        elif new_type in WIDENED_TYPES.get(old_type, ()):
+            self.compatible.append(
+                f'Widened {name} from {old_type} to {new_type}'
+            )
+        else:
+            self.incompatible.append(
+                f'Changed type of {name} from {old_type} to {new_type}'
+            )
+
+    @property
+    def is_compatible(self):
+        return not self.incompatible
+
+    def __bool__(self):
+        return bool(self.compatible or self.incompatible)
+
+
+def _attributes_by_name(node):
+    return {
+        a['name']: a for a in node.get('attributes', []) if a.get('type')
+    }
+
+
+def check_compatibility(old_pfb_schema, new_pfb_schema):
+    """
+    Check that a new PFB schema is backward compatible with an old one
+
+    :raises IncompatibleSchemaError: if it is not
+    :returns: SchemaChanges
+    """
+    changes = SchemaChanges(old_pfb_schema, new_pfb_schema)
+    if not changes.is_compatible:
+        raise IncompatibleSchemaError(changes.incompatible)
+    return changes
+
+
+def merge_pfb_schemas(pfb_schemas):
+    """
+    Create the union of compatible PFB schemas: all of their tables and
+    attributes, the widest type of each attribute and all enum values
+
+    :param pfb_schemas: list of PFB schemas
+    :type pfb_schemas: list
+    :raises IncompatibleSchemaError: if any schema is not compatible with
+    the union
+    :returns: PFB schema dict
+    """
+    merged = deepcopy(pfb_schemas[0])
+    for pfb_schema in pfb_schemas[1:]:
+        for table, node in pfb_schema.items():
+            if table not in merged:
+                merged[table] = deepcopy(node)
+                continue
+            merged_attrs = _attributes_by_name(merged[table])
+            for attr in node.get('attributes', []):
+                current = merged_attrs.get(attr['name'])
+                if current is None:
+                    merged[table]['attributes'].append(deepcopy(attr))
+                elif current['type'] == 'enum' and attr['type'] == 'enum':
+                    current['symbols'] = current['symbols'] + [
+                        s for s in attr['symbols']
+                        if s not in current['symbols']
+                    ]
+                elif attr['type'] in WIDENED_TYPES.get(current['type'], ()):
+                    current['type'] = attr['type']
+
+    incompatible = []
+    for pfb_schema in pfb_schemas:
+        incompatible.extend(
+            c for c in SchemaChanges(pfb_schema, merged).incompatible
+            if c not in incompatible
+        )
+    if incompatible:
+        raise IncompatibleSchemaError(incompatible)
+    return merged
+
+
+def align_pfb_schema(old_pfb_schema, new_pfb_schema):
+    """
+    Order a new PFB schema like an old one so that as much of the old
+    encoding as possible stays valid: existing tables keep their position in
+    the Entity union with new tables after them, and existing enum values
+    keep their position with new values after them
+
+    :returns: a new PFB schema dict
+    """
+    position = {table: i for i, table in enumerate(old_pfb_schema)}
+    aligned = {}
+    for table in sorted(
+        new_pfb_schema, key=lambda t: position.get(t, len(position))
+    ):
+        node = dict(new_pfb_schema[table])
+        old_attrs = _attributes_by_name(old_pfb_schema.get(table, {}))
+        attributes = []
+        for attr in node.get('attributes', []):
+            old = old_attrs.get(attr['name'])
+            if (
+                old and old['type'] == 'enum' and attr.get('type') == 'enum'
+            ):
+                attr = dict(attr)
+                attr['symbols'] = old['symbols'] + sorted(
+                    set(attr['symbols']) - set(old['symbols'])
+                )
+            attributes.append(attr)
+        node['attributes'] = attributes
+        aligned[table] = node
+    return aligned
+
+
+def binary_compatible(old, new):
+    """
+    Check whether data encoded with an old Avro schema has the same encoding
+    under a new Avro schema, so it can be copied without re-encoding
+
+    :param old: Avro schema
+    :param new: Avro schema
+    :returns: bool
+    """
+    if isinstance(old, dict) and old.get('type') in AVRO_PRIMITIVES:
+        old = old['type']
+    if isinstance(new, dict) and new.get('type') in AVRO_PRIMITIVES:
+        new = new['type']
+
+    if isinstance(old, str) or isinstance(new, str):
+        # int and long share the same zig-zag varint encoding
+        return old == new or (old, new) == ('int', 'long')
+    if isinstance(old, list) or isinstance(new, list):
+        # Union branches are encoded by index
+        return (
+            isinstance(old, list) and isinstance(new, list) and
+            len(old) <= len(new) and
+            all(binary_compatible(o, n) for o, n in zip(old, new))
+        )
+    if old['type'] != new['type'] or old.get('name') != new.get('name'):
+        return False
+    if old['type'] == 'record':
+        return len(old['fields']) == len(new['fields']) and all(
+            o['name'] == n['name'] and binary_compatible(o['type'], n['type'])
+            for o, n in zip(old['fields'], new['fields'])
+        )
+    if old['type'] == 'enum':
+        # Enum symbols are encoded by index
+        return new['symbols'][:len(old['symbols'])] == old['symbols']
+    if old['type'] == 'array':
+        return binary_compatible(old['items'], new['items'])
+    if old['type'] == 'map':
+        return binary_compatible(old['values'], new['values'])
+    return to_parsing_canonical_form(old) == to_parsing_canonical_form(new)
+
+
+def _node_schemas(avro_schema):
+    object_field = next(
+        f for f in avro_schema['fields'] if f['name'] == 'object'
+    )
+    return object_field['type']
+
+
+def rewrite_pfb(filepath, header, pfb_schema):
+    """
+    Rewrite a PFB file with a new, compatible PFB schema in its header and
+    an updated Metadata entity. The file keeps its codec and sync marker
+
+    :param filepath: path to the PFB file
+    :type filepath: str
+    :param header: the file's current header
+    :type header: pfb_exporter.container.Header
+    :param pfb_schema: new PFB schema
+    :type pfb_schema: dict
+    :returns: number of blocks which had to be re-encoded
+    """
+    logger = logging.getLogger('rewrite_pfb')
+    new_avro_schema = make_avro_schema(pfb_schema)
+    old_parsed = parse_schema(header.schema)
+    new_parsed = parse_schema(new_avro_schema)
+    copy_blocks = binary_compatible(
+        _node_schemas(header.schema), _node_schemas(new_avro_schema)
+    )
+    new_header = Header(
+        new_avro_schema, codec=header.codec, sync=header.sync,
+        meta=header.meta
+    )
+
+    reencoded = 0
+    tmp_filepath = f'{filepath}.tmp'
+    with open(filepath, 'rb') as src, open(tmp_filepath, 'wb') as dst:
+        src.seek(header.size)
+        dst.write(new_header.encode())
+        for i, block in enumerate(iter_blocks(src, header)):
+            if i == 0 or not copy_blocks:
+                records = block.records(
+                    header.codec, old_parsed, new_parsed,
+                    return_record_name=True
+                )
+                if i == 0 and records and records[0]['name'] == 'Metadata':
+                    # Keep the misc entries, e.g. the statistics
+                    metadata = make_metadata(pfb_schema)
+                    metadata['misc'] = records[0]['object'][1]['misc']
+                    records[0]['object'] = ('Metadata', metadata)
+                block = Block.from_records(records, header.codec, new_parsed)
+                reencoded += 1
+            dst.write(block.encode(header.sync))
+    os.replace(tmp_filepath, filepath)
+
+    logger.info(
+        f'✏️ Rewrote {filepath} with the new PFB schema, re-encoded '
+        f'{reencoded} blocks'
+    )
+    return reencoded
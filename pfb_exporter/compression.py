@@ -0,0 +1,266 @@
+"""
+Decompress payload files on background threads
+
+Compressed payload files (.json.gz, .jsonl.zst, ...) are read without
+decompressing them to disk first. Each file is decompressed by a background
+thread into a bounded queue of chunks, and the parser reads the decompressed
+bytes from the other end of the queue as a file-like object. zlib and zstd
+release the GIL while they decompress, so decompression runs in parallel
+with parsing and encoding on the main thread.
+
+Gzip files with several members (e.g. concatenated .gz files) and zstd files
+with several frames are decompressed member by member until the end of the
+file.
+
+zstd requires the zstandard package: pip install kf-lib-pfb-exporter[zstd]
+"""
+import io
+import os
+import zlib
+import queue
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from pfb_exporter.config import (
+    COMPRESSED_PAYLOAD_EXTS,
+    DEFAULT_DECOMPRESS_CHUNK_SIZE,
+    DEFAULT_DECOMPRESS_QUEUE_SIZE
+)
+from pfb_exporter.utils import in_log_context
+
+
+def compression_codec(filepath):
+    """
+    Get the compression codec of a file from its extension
+
+    participant.json.gz -> gzip
+
+    :returns: codec name or None if the file is not compressed
+    """
+    return COMPRESSED_PAYLOAD_EXTS.get(os.path.splitext(filepath)[-1])
+
+
+def strip_compression_ext(filepath):
+    """
+    Remove the compression extension from a file path
+
+    participant.json.gz -> participant.json
+    """
+    root, ext = os.path.splitext(filepath)
+    return root if ext in COMPRESSED_PAYLOAD_EXTS else filepath
+
+
+def _decompressobj(codec):
+    """
+    Create a streaming decompressor for one gzip member or zstd frame
+    """
+    if codec == 'gzip':
+        return zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImportError(
+                'Reading zstd compressed payloads requires zstandard. '
+                'Install it with: pip install kf-lib-pfb-exporter[zstd]'
+            )
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(
+        f'Unsupported compression codec {codec}. '
+        f'Supported: {sorted(set(COMPRESSED_PAYLOAD_EXTS.values()))}'
+    )
+
+
+def iter_decompressed(
+    compressed_file, codec, chunk_size=DEFAULT_DECOMPRESS_CHUNK_SIZE
+):
+    """
+    Generator which yields the decompressed content of a compressed file
+    object in chunks, member by member (or frame by frame) until the end of
+    the file
+
+    :param compressed_file: binary file object
+    :param codec: compression codec
+    :type codec: str
+    :param chunk_size: number of compressed bytes read at a time
+    :type chunk_size: int
+    :raises EOFError: if the file ends before the end of the stream
+    """
+    decompressor = _decompressobj(codec)
+    pending = False
+    while True:
+        data = compressed_file.read(chunk_size)
+        if not data:
+            break
+        while data:
+            pending = True
+            out = decompressor.decompress(data)
+            if out:
+                yield out
+            if decompressor.eof:
+                # End of a gzip member or zstd frame. Any data after it
+                # belongs to the next one
+                data = decompressor.unused_data
+                decompressor = _decompressobj(codec)
+                pending = False
+            else:
+                data = b''
+    if pending:
+        raise EOFError(
+            f'Compressed file {getattr(compressed_file, "name", "")} ended '
+            'before the end of the stream'
+        )
+
+
+class _Done(object):
+    def __init__(self, error=None):
+        self.error = error
+
+
+class DecompressingReader(io.RawIOBase):
+    """
+    Binary file-like object with the decompressed content of a file, which
+    is decompressed by a background thread
+    """
+
+    def __init__(
+        self, filepath, codec=None,
+        chunk_size=DEFAULT_DECOMPRESS_CHUNK_SIZE,
+        queue_size=DEFAULT_DECOMPRESS_QUEUE_SIZE,
+        memory=None
+    ):
+        """
+        Constructor
+
+        :param filepath: path to the compressed file
+        :type filepath: str
+        :param codec: compression codec. Defaults to the codec of the file
+        extension
+        :type codec: str
+        :param chunk_size: number of compressed bytes read at a time
+        :type chunk_size: int
+        :param queue_size: max number of decompressed chunks buffered ahead
+        of the reader
+        :type queue_size: int
+        :param memory: if provided, the buffered chunks are registered with
+        this memory governor, and decompression waits while the budget is
+        used up
+        :type memory: pfb_exporter.memory.MemoryGovernor
+        """
+        super().__init__()
+        self.filepath = filepath
+        self.codec = codec or compression_codec(filepath)
+        # Fail before a thread is started if the codec is not available
+        _decompressobj(self.codec)
+        self.chunk_size = chunk_size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._chunk = memoryview(b'')
+        self._done = False
+        self._memory = (
+            memory.consumer('decompressed chunks') if memory else None
+        )
+
+    def start(self, executor=None):
+        """
+        Start decompressing the file on a thread of the executor, or on a
+        new daemon thread
+
+        :param executor: thread pool to run the decompression on
+        :type executor: concurrent.futures.ThreadPoolExecutor
+        :returns: self
+        """
+        decompress = in_log_context(self._decompress)
+        if executor:
+            executor.submit(decompress)
+        else:
+            threading.Thread(
+                target=decompress,
+                name=f'decompress-{os.path.basename(self.filepath)}',
+                daemon=True
+            ).start()
+        return self
+
+    def _put(self, item):
+        if self._memory and not isinstance(item, _Done):
+            if not self._memory.reserve(len(item), self._stop):
+                return
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _decompress(self):
+        error = None
+        try:
+            with open(self.filepath, 'rb') as compressed_file:
+                for out in iter_decompressed(
+                    compressed_file, self.codec, self.chunk_size
+                ):
+                    if self._stop.is_set():
+                        break
+                    self._put(out)
+        except Exception as e:
+            error = e
+        finally:
+            self._put(_Done(error))
+            if self._memory and self._stop.is_set():
+                # The reader was closed. Chunks reserved since then are
+                # never read
+                self._memory.close()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._chunk:
+            if self._done:
+                return 0
+            if self._memory:
+                # The previous chunk has been read
+                self._memory.release(len(self._chunk.obj))
+            item = self._queue.get()
+            if isinstance(item, _Done):
+                self._done = True
+                if item.error:
+                    raise item.error
+                return 0
+            self._chunk = memoryview(item)
+        n = min(len(b), len(self._chunk))
+        b[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+    def close(self):
+        """
+        Stop the background thread if it is still decompressing
+        """
+        self._stop.set()
+        super().close()
+        if self._memory:
+            self._memory.close()
+
+
+def open_payload_file(filepath, executor=None, memory=None):
+    """
+    Open a payload file as text, decompressing it on a background thread if
+    it is compressed
+
+    :param filepath: path to the payload file
+    :type filepath: str
+    :param executor: thread pool to decompress on. See
+    DecompressingReader.start
+    :type executor: concurrent.futures.ThreadPoolExecutor
+    :param memory: memory governor the decompressed chunks are registered
+    with
+    :type memory: pfb_exporter.memory.MemoryGovernor
+    :returns: text file object
+    """
+    if not compression_codec(filepath):
+        return open(filepath)
+    raw = DecompressingReader(filepath, memory=memory).start(executor)
+    return io.TextIOWrapper(io.BufferedReader(raw), encoding='utf-8')
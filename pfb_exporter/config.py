@@ -17,3 +17,96 @@ DEFAULT_MODELS_PATH = os.path.join(DEFAULT_OUTPUT_DIR, 'models.py')
 DEFAULT_TRANFORM_MOD = os.path.join(
     ROOT_DIR, 'pfb_exporter', 'transform', 'sqla.py'
 )
+
+# Payload input
+PAYLOAD_FILE_EXTS = ['.json', '.jsonl', '.ndjson']
+# Compressed payload file extension -> codec, e.g. participant.json.gz
+COMPRESSED_PAYLOAD_EXTS = {'.gz': 'gzip', '.zst': 'zstd'}
+# Compressed payloads - number of files decompressed at once on background
+# threads, size of the compressed chunks read and max number of
+# decompressed chunks buffered per file ahead of the parser
+DEFAULT_DECOMPRESS_WORKERS = 2
+DEFAULT_DECOMPRESS_CHUNK_SIZE = 64 * 1024
+DEFAULT_DECOMPRESS_QUEUE_SIZE = 16
+# Payload fields used (in order of preference) as the PFB entity id
+RECORD_ID_FIELDS = ['kf_id', 'submitter_id']
+
+# External sort - max bytes of serialized records held in memory before
+# a sorted run is spilled to disk
+DEFAULT_SORT_BUFFER_SIZE = 256 * 1024 ** 2
+
+# Concurrency - max number of tables in a dependency level processed at once
+# and max number of records buffered per table ahead of the writer
+DEFAULT_WORKERS = os.cpu_count() or 1
+DEFAULT_PREFETCH_SIZE = 1000
+
+# Enum detection - max number of distinct values in an enum attribute and
+# max ratio of distinct values to non-null values
+DEFAULT_ENUM_THRESHOLD = 50
+DEFAULT_ENUM_MAX_RATIO = 0.5
+
+# Columnar side output - dir (inside output dir) with one file per table and
+# number of rows per record batch
+COLUMNAR_DIR = 'tables'
+DEFAULT_RECORD_BATCH_SIZE = 10000
+
+# Avro
+DEFAULT_AVRO_CODEC = 'null'
+# Max number of compiled PFB schemas (Avro schema, value converters) cached
+# per process
+DEFAULT_SCHEMA_CACHE_SIZE = 8
+# Size in bytes of the uncompressed data after which an Avro block is written
+DEFAULT_SYNC_INTERVAL = 16000
+# Per-entity statistics written alongside the PFB file
+DEFAULT_STATS_FILE = 'stats.json'
+# Record id index - extension of the sidecar file written next to the PFB
+# file and max number of entries held in memory before a sorted run is
+# spilled to disk
+INDEX_FILE_EXT = '.idx'
+DEFAULT_INDEX_BUFFER_SIZE = 1000000
+
+# Parallel database range scans - tables with at least DEFAULT_SCAN_MIN_ROWS
+# rows are split into DEFAULT_SCAN_SLICES key ranges, read by
+# DEFAULT_SCAN_WORKERS workers, DEFAULT_SCAN_BATCH_SIZE rows at a time
+DEFAULT_SCAN_WORKERS = 4
+DEFAULT_SCAN_SLICES = 16
+DEFAULT_SCAN_BATCH_SIZE = 5000
+DEFAULT_SCAN_MIN_ROWS = 100000
+# Seconds without progress after which a slice is reported as stalled
+DEFAULT_SCAN_STALL_TIMEOUT = 60
+
+# Subgraph export - max number of key values looked up in one query
+DEFAULT_SUBGRAPH_BATCH_SIZE = 1000
+
+# Export server
+DEFAULT_SERVER_HOST = '127.0.0.1'
+DEFAULT_SERVER_PORT = 8765
+# Max number of export jobs that run at once and max number of queued jobs
+DEFAULT_MAX_JOBS = 2
+DEFAULT_JOB_QUEUE_SIZE = 100
+DEFAULT_DB_POOL_SIZE = 5
+
+# Batch export - number of exports run at once and the batch status file
+DEFAULT_BATCH_JOBS = 2
+BATCH_STATUS_FILE = 'status.json'
+
+# Memory governor - seconds between logs of the memory used per buffer
+DEFAULT_MEMORY_LOG_INTERVAL = 30
+# Share of the budget a spillable buffer must hold before it is asked to
+# spill, so small buffers are not spilled record by record
+DEFAULT_MIN_SPILL_SHARE = 0.05
+
+# Compact rows
+# Max number of distinct string values interned per column
+DEFAULT_INTERN_POOL_SIZE = 1000
+
+# Profiling
+# Dir in the output dir where per phase profiles are written
+PROFILE_DIR = 'profile'
+# Number of allocation sites written per phase
+PROFILE_TOP_ALLOCATIONS = 25
+
+# Export estimate - number of records sampled per payload file or table and
+# the file the estimate is written to in the output dir
+DEFAULT_ESTIMATE_SAMPLE_SIZE = 1000
+DEFAULT_ESTIMATE_FILE = 'estimate.json'
@@ -0,0 +1,282 @@
+"""
+Read and write the blocks of an Avro object container file
+
+An Avro file is a header (magic bytes, a metadata map with the schema and
+codec, and a 16 byte sync marker) followed by data blocks. Each block is the
+number of records in it, the size of its (compressed) data, the data and the
+sync marker. See https://avro.apache.org/docs/current/spec.html
+
+Working at the block level lets a PFB file be rewritten or merged without
+decoding every record: blocks whose encoding is unchanged are copied as is,
+and only the blocks that need to change are decoded and re-encoded.
+"""
+import io
+import os
+import bz2
+import json
+import lzma
+import zlib
+
+from fastavro import parse_schema, schemaless_reader, schemaless_writer
+
+MAGIC = b'Obj\x01'
+SYNC_SIZE = 16
+# Codecs that blocks can be decoded from and encoded to
+CODECS = ['null', 'deflate', 'bzip2', 'xz']
+
+
+class ContainerError(Exception):
+    """
+    Raised when a file is not a valid Avro object container file
+    """
+
+
+def encode_long(value):
+    """
+    Encode an int as an Avro long (zig-zag varint)
+    """
+    value = (value << 1) ^ (value >> 63)
+    out = bytearray()
+    while value & ~0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def read_long(fo):
+    """
+    Read an Avro long from a binary file-like object
+
+    :returns: the int or None at the end of the file
+    """
+    shift = 0
+    value = 0
+    while True:
+        b = fo.read(1)
+        if not b:
+            if shift:
+                raise ContainerError('Unexpected end of file')
+            return None
+        b = b[0]
+        value |= (b & 0x7F) << shift
+        if not b & 0x80:
+            break
+        shift += 7
+    return (value >> 1) ^ -(value & 1)
+
+
+def encode_bytes(data):
+    return encode_long(len(data)) + data
+
+
+def read_bytes(fo):
+    size = read_long(fo)
+    data = fo.read(size)
+    if size is None or len(data) != size:
+        raise ContainerError('Unexpected end of file')
+    return data
+
+
+def compress(codec, data):
+    """
+    Compress the data of a block with an Avro codec
+    """
+    if codec == 'null':
+        return data
+    if codec == 'deflate':
+        # Raw deflate without the zlib header and checksum
+        return zlib.compress(data)[2:-4]
+    if codec == 'bzip2':
+        return bz2.compress(data)
+    if codec == 'xz':
+        return lzma.compress(data)
+    raise ValueError(f'Unsupported codec {codec}. Supported: {CODECS}')
+
+
+def decompress(codec, data):
+    """
+    Decompress the data of a block with an Avro codec
+    """
+    if codec == 'null':
+        return data
+    if codec == 'deflate':
+        return zlib.decompress(data, -15)
+    if codec == 'bzip2':
+        return bz2.decompress(data)
+    if codec == 'xz':
+        return lzma.decompress(data)
+    raise ValueError(f'Unsupported codec {codec}. Supported: {CODECS}')
+
+
+class Header(object):
+
+    def __init__(self, schema, codec='null', sync=None, meta=None):
+        """
+        Constructor
+
+        :param schema: Avro schema of the file
+        :type schema: dict
+        :param codec: Avro codec of the blocks
+        :type codec: str
+        :param sync: 16 byte sync marker. A random one is created if not
+        provided
+        :type sync: bytes
+        :param meta: other file metadata, key -> bytes
+        :type meta: dict
+        """
+        self.schema = schema
+        self.codec = codec
+        self.sync = sync or os.urandom(SYNC_SIZE)
+        self.meta = dict(meta or {})
+        # Size of the header in bytes, set when the header is read
+        self.size = None
+
+    def encode(self):
+        """
+        Encode the header as bytes
+        """
+        meta = dict(self.meta)
+        meta['avro.schema'] = json.dumps(self.schema).encode('utf-8')
+        meta['avro.codec'] = self.codec.encode('utf-8')
+        out = [MAGIC, encode_long(len(meta))]
+        for key, value in meta.items():
+            out.append(encode_bytes(key.encode('utf-8')))
+            out.append(encode_bytes(value))
+        out.append(encode_long(0))
+        out.append(self.sync)
+        return b''.join(out)
+
+    @classmethod
+    def read(cls, fo):
+        """
+        Read the header from the start of a binary file-like object
+        """
+        start = fo.tell()
+        if fo.read(len(MAGIC)) != MAGIC:
+            raise ContainerError('Not an Avro object container file')
+        meta = {}
+        while True:
+            count = read_long(fo)
+            if not count:
+                break
+            if count < 0:
+                # A negative count is followed by the size of the map block
+                read_long(fo)
+                count = -count
+            for _ in range(count):
+                key = read_bytes(fo).decode('utf-8')
+                meta[key] = read_bytes(fo)
+        sync = fo.read(SYNC_SIZE)
+        if len(sync) != SYNC_SIZE:
+            raise ContainerError('Unexpected end of file')
+
+        schema = json.loads(meta.pop('avro.schema').decode('utf-8'))
+        codec = meta.pop('avro.codec', b'null').decode('utf-8')
+        header = cls(schema, codec=codec, sync=sync, meta=meta)
+        header.size = fo.tell() - start
+        return header
+
+
+class Block(object):
+
+    def __init__(self, count, data, offset=None):
+        """
+        Constructor
+
+        :param count: number of records in the block
+        :type count: int
+        :param data: compressed block data
+        :type data: bytes
+        :param offset: offset of the block in its file
+        :type offset: int
+        """
+        self.count = count
+        self.data = data
+        self.offset = offset
+
+    def encode(self, sync):
+        """
+        Encode the block as bytes, ending with the file's sync marker
+        """
+        return b''.join(
+            [encode_long(self.count), encode_bytes(self.data), sync]
+        )
+
+    def records(
+        self, codec, writer_schema, reader_schema=None,
+        return_record_name=False
+    ):
+        """
+        Decode the records in the block
+
+        :param codec: codec of the file the block is from
+        :type codec: str
+        :param writer_schema: parsed schema of the file the block is from
+        :type writer_schema: dict
+        :param reader_schema: parsed schema to resolve the records to
+        :type reader_schema: dict
+        :param return_record_name: whether records in unions are returned as
+        (record name, record) tuples, so they are encoded as the same union
+        branch when written again
+        :type return_record_name: bool
+        :returns: list of records
+        """
+        buf = io.BytesIO(decompress(codec, self.data))
+        return [
+            schemaless_reader(
+                buf, writer_schema, reader_schema,
+                return_record_name=return_record_name
+            )
+            for _ in range(self.count)
+        ]
+
+    @classmethod
+    def from_records(cls, records, codec, schema):
+        """
+        Encode records into a new block
+
+        :param records: list of records
+        :type records: list
+        :param codec: codec of the file the block is written to
+        :type codec: str
+        :param schema: parsed schema of the file the block is written to
+        :type schema: dict
+        """
+        buf = io.BytesIO()
+        for record in records:
+            schemaless_writer(buf, schema, record)
+        return cls(len(records), compress(codec, buf.getvalue()))
+
+
+def iter_blocks(fo, header):
+    """
+    Generator which yields the blocks after the header of an Avro file
+
+    :param fo: binary file-like object positioned after the header
+    :type fo: file-like object
+    :param header: the file's header
+    :type header: Header
+    """
+    while True:
+        offset = fo.tell()
+        count = read_long(fo)
+        if count is None:
+            return
+        data = read_bytes(fo)
+        if fo.read(SYNC_SIZE) != header.sync:
+            raise ContainerError(
+                f'Invalid sync marker after the block at offset {offset}'
+            )
+        yield Block(count, data, offset=offset)
+
+
+def read_container(filepath):
+    """
+    Read the header and parsed schema of an Avro file
+
+    :returns: tuple of (Header, parsed schema)
+    """
+    with open(filepath, 'rb') as avro_file:
+        header = Header.read(avro_file)
+    return header, parse_schema(header.schema)
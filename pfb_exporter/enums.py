@@ -0,0 +1,241 @@
+"""
+Detect low-cardinality text columns and encode them as Avro enums
+
+Text columns such as genomic_file.data_type hold a small, fixed set of values.
+Encoded as an Avro string every value is written out in full on every row.
+Encoded as an Avro enum each value is written as a single varint index.
+
+The EnumDetector profiles payload records (or the database columns) for the
+string attributes in the PFB schema. An attribute becomes an enum if it has at
+most `threshold` distinct values and its values repeat, i.e. the ratio of
+distinct values to non-null values is at most `max_ratio`. Overrides force an
+attribute to be (or never be) an enum regardless of its cardinality.
+
+Avro enum symbols must match [A-Za-z_][A-Za-z0-9_]*, so values are encoded
+the same way pypfb encodes them: a leading digit and every character that is
+not alphanumeric are replaced with _<hex code point>_
+"""
+import re
+import logging
+from collections import defaultdict
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.inspection import inspect as sqla_inspect
+
+from pfb_exporter.config import DEFAULT_ENUM_THRESHOLD, DEFAULT_ENUM_MAX_RATIO
+
+
+def _encode_char(match):
+    return f'_{ord(match.group(0)):x}_'
+
+
+def _decode_char(match):
+    return chr(int(match.group(0).strip('_'), 16))
+
+
+def encode_enum(value):
+    """
+    Encode a value as a valid Avro enum symbol
+    """
+    return re.sub('^[0-9]|[^A-Za-z0-9]', _encode_char, str(value))
+
+
+def decode_enum(symbol):
+    """
+    Decode an Avro enum symbol created by encode_enum back to its value
+    """
+    return re.sub('_[a-f0-9]{2,}_', _decode_char, symbol)
+
+
+def parse_overrides(values):
+    """
+    Parse enum overrides from the CLI
+
+    :param values: list of strings formatted as <table>.<column>=<enum|string>
+    :type values: list
+    :returns: dict of (table, column) -> True to force an enum, False to
+    never use an enum
+    """
+    overrides = {}
+    for value in values or []:
+        column, _, kind = value.partition('=')
+        table, _, column = column.partition('.')
+        if not (table and column) or kind not in ('enum', 'string'):
+            raise ValueError(
+                f'Invalid enum override "{value}". Expected format: '
+                '<table>.<column>=<enum|string>'
+            )
+        overrides[(table, column)] = (kind == 'enum')
+    return overrides
+
+
+class EnumDetector(object):
+
+    def __init__(
+        self,
+        pfb_schema,
+        threshold=DEFAULT_ENUM_THRESHOLD,
+        overrides=None,
+        max_ratio=DEFAULT_ENUM_MAX_RATIO
+    ):
+        """
+        Constructor
+
+        :param pfb_schema: table name -> attributes and foreign keys
+        :type pfb_schema: dict
+        :param threshold: max number of distinct values in an enum
+        :type threshold: int
+        :param overrides: (table, column) -> True to force an enum, False to
+        never use an enum. See parse_overrides
+        :type overrides: dict
+        :param max_ratio: max ratio of distinct to non-null values in an enum
+        :type max_ratio: float
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.threshold = threshold
+        self.max_ratio = max_ratio
+        self.overrides = overrides or {}
+
+        # table -> candidate columns
+        self.candidates = defaultdict(list)
+        # (table, column) -> set of distinct values, None once the column
+        # has too many distinct values to be an enum
+        self._values = {}
+        # (table, column) -> number of non-null values
+        self._counts = defaultdict(int)
+
+        for table, node in pfb_schema.items():
+            fk_columns = {fk['name'] for fk in node.get('foreign_keys', [])}
+            for attr in node.get('attributes', []):
+                key = (table, attr['name'])
+                forced = self.overrides.get(key)
+                if forced is False:
+                    continue
+                if forced or (
+                    attr.get('type') == 'string' and
+                    not attr.get('logicalType') and
+                    attr['name'] not in fk_columns
+                ):
+                    self.candidates[table].append(attr['name'])
+                    self._values[key] = set()
+
+    def _add(self, key, value):
+        self._counts[key] += 1
+        values = self._values[key]
+        if values is None:
+            return
+        values.add(str(value))
+        if len(values) > self.threshold and not self.overrides.get(key):
+            self._values[key] = None
+
+    def observe(self, record, entity_type=None):
+        """
+        Add the values of the candidate columns of a payload record to the
+        profile
+
+        :param record: payload record
+        :type record: dict
+        :param entity_type: table the record belongs to. Defaults to the
+        record's `type` field
+        :type entity_type: str
+        """
+        table = entity_type or record.get('type')
+        for column in self.candidates.get(table, []):
+            value = record.get(column)
+            if value is not None:
+                self._add((table, column), value)
+
+    def observe_all(self, records):
+        """
+        Generator which profiles and passes through an iterable of records
+        """
+        for record in records:
+            self.observe(record)
+            yield record
+
+    def profile_database(self, engine, model_dict):
+        """
+        Profile the candidate columns in the database
+
+        Only threshold + 1 distinct values are fetched per column, since that
+        is enough to rule the column out
+
+        :param engine: SQLAlchemy engine or connection URL for database
+        :type engine: sqlalchemy.engine.Engine or str
+        :param model_dict: model class name -> SQLAlchemy model class
+        :type model_dict: dict
+        """
+        owns_engine = isinstance(engine, str)
+        if owns_engine:
+            engine = create_engine(engine)
+        try:
+            with engine.connect() as conn:
+                for model_cls in model_dict.values():
+                    table = model_cls.__tablename__
+                    columns = sqla_inspect(model_cls).columns
+                    for name in self.candidates.get(table, []):
+                        self._profile_column(conn, table, columns[name])
+        finally:
+            if owns_engine:
+                engine.dispose()
+
+    def _profile_column(self, conn, table, column):
+        key = (table, column.key)
+        query = select([column]).where(column.isnot(None)).distinct()
+        if not self.overrides.get(key):
+            query = query.limit(self.threshold + 1)
+        values = {str(row[0]) for row in conn.execute(query)}
+
+        self._counts[key] = conn.execute(
+            select([func.count(column)])
+        ).scalar()
+        if len(values) > self.threshold and not self.overrides.get(key):
+            values = None
+        self._values[key] = values
+
+    def enums(self):
+        """
+        Get the attributes which should be encoded as enums
+
+        :returns: dict of (table, column) -> sorted list of values
+        """
+        enums = {}
+        for key, values in self._values.items():
+            forced = self.overrides.get(key)
+            if values is None or not self._counts[key]:
+                continue
+            if '' in values:
+                if forced:
+                    self.logger.warning(
+                        f'⚠️ {".".join(key)} has empty values and cannot '
+                        'be encoded as an enum'
+                    )
+                continue
+            if forced or (
+                len(values) / self._counts[key] <= self.max_ratio
+            ):
+                enums[key] = sorted(values)
+        return enums
+
+    def apply(self, pfb_schema):
+        """
+        Change the type of the detected enum attributes in the PFB schema to
+        enum and add the enum values as `symbols`
+
+        :param pfb_schema: table name -> attributes and foreign keys
+        :type pfb_schema: dict
+        :returns: the modified PFB schema
+        """
+        enums = self.enums()
+        for (table, column), values in enums.items():
+            for attr in pfb_schema[table]['attributes']:
+                if attr['name'] == column:
+                    attr['type'] = 'enum'
+                    attr['symbols'] = values
+                    attr.pop('logicalType', None)
+
+        self.logger.info(
+            f'Detected {len(enums)} enum attributes: '
+            f'{sorted(".".join(k) for k in enums)}'
+        )
+        return pfb_schema
@@ -0,0 +1,534 @@
+"""
+Estimate the wall time, output size and peak memory of an export
+
+Before an export is scheduled, a sample of each table is read and put
+through the same steps as the export: payload records are parsed and
+externally sorted, database rows are fetched, and all of them are converted
+to PFB Entities, encoded with the tagged schemas of the real PFB schema and
+compressed with the export's codec, in blocks of the same size as the
+writer's. The measured cost and size per record are extrapolated to the
+number of rows of each table:
+
+- Payload files: the first sample_size records of each file are parsed,
+  reading only as much of the file as they take. The rows of a file are
+  extrapolated from the share of the file on disk that was read for the
+  sample (compressed bytes for compressed files), or counted if the whole
+  file was read
+- Database: rows are counted with COUNT queries and the first sample_size
+  rows of each table are fetched
+
+Peak memory is the memory of the process after the PFB schema was built
+plus the sum of the export's bounded buffers (see pfb_exporter.memory), or
+the memory budget if it is smaller. Estimates assume the sampled records
+are representative of their table.
+"""
+import io
+import os
+import sys
+import json
+import time
+import codecs
+import logging
+import itertools
+from collections import OrderedDict, defaultdict
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from fastavro import schemaless_writer
+from sqlalchemy import func, select
+
+from pfb_exporter.config import (
+    DEFAULT_AVRO_CODEC,
+    DEFAULT_DECOMPRESS_CHUNK_SIZE,
+    DEFAULT_ESTIMATE_SAMPLE_SIZE,
+    DEFAULT_INDEX_BUFFER_SIZE,
+    DEFAULT_PREFETCH_SIZE,
+    DEFAULT_SCAN_BATCH_SIZE,
+    DEFAULT_SCAN_WORKERS,
+    DEFAULT_SORT_BUFFER_SIZE,
+    DEFAULT_SYNC_INTERVAL,
+    DEFAULT_WORKERS
+)
+from pfb_exporter.compression import (
+    compression_codec,
+    iter_decompressed,
+    strip_compression_ext
+)
+from pfb_exporter.container import compress
+from pfb_exporter.extract import json_value
+from pfb_exporter.memory import format_size, record_size
+from pfb_exporter.payloads import (
+    list_payload_files,
+    payload_type_from_filename
+)
+from pfb_exporter.rows import RowPacker
+from pfb_exporter.sort import ExternalSorter
+from pfb_exporter.utils import get_record_id
+from pfb_exporter.writer import PfbWriter, compile_schema
+
+
+def process_memory():
+    """
+    Get the peak resident memory of the process so far in bytes, or 0 if it
+    cannot be measured on this platform
+    """
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def format_seconds(seconds):
+    """
+    Format a duration for logs, e.g. 1h 02m 03s
+    """
+    seconds = int(round(seconds))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return f'{hours}h {minutes:02d}m {seconds:02d}s'
+    if minutes:
+        return f'{minutes}m {seconds:02d}s'
+    return f'{seconds}s'
+
+
+def iter_file_chunks(filepath, chunk_size=DEFAULT_DECOMPRESS_CHUNK_SIZE):
+    """
+    Generator which yields the content of a payload file in chunks,
+    decompressed if the file is compressed, each with the number of bytes of
+    the file on disk read so far
+    """
+    codec = compression_codec(filepath)
+    with open(filepath, 'rb') as payload_file:
+        if codec:
+            chunks = iter_decompressed(payload_file, codec, chunk_size)
+        else:
+            chunks = iter(lambda: payload_file.read(chunk_size), b'')
+        for data in chunks:
+            yield data, payload_file.tell()
+
+
+def file_position(positions, offset):
+    """
+    Map an offset in the content of a file to the bytes of the file on disk
+    read up to it, interpolating within the chunk the offset falls in
+
+    :param positions: list of (content bytes, file bytes) read so far after
+    each chunk
+    :type positions: list
+    :param offset: offset in the content
+    :type offset: int
+    :returns: number of bytes of the file on disk
+    """
+    prev_offset, prev_pos = 0, 0
+    for end_offset, end_pos in positions:
+        if offset <= end_offset:
+            share = (offset - prev_offset) / ((end_offset - prev_offset) or 1)
+            return prev_pos + (end_pos - prev_pos) * share
+        prev_offset, prev_pos = end_offset, end_pos
+    return prev_pos
+
+
+def sample_lines(chunks, sample_size):
+    """
+    Parse the first records of a JSON lines file
+
+    :param chunks: iterable of the file's content in chunks of bytes
+    :param sample_size: max number of records
+    :type sample_size: int
+    :returns: tuple of the records, the number of content bytes they took
+    and whether the whole file was read
+    """
+    records, offset, rest = [], 0, b''
+    for data in chunks:
+        lines = (rest + data).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            offset += len(line) + 1
+            if line.strip():
+                records.append(json.loads(line))
+                if len(records) >= sample_size:
+                    return records, offset, False
+    if rest.strip():
+        records.append(json.loads(rest))
+    return records, offset + len(rest), True
+
+
+def sample_document(chunks, sample_size):
+    """
+    Parse the first records of a JSON document, which holds an array of
+    records or a single record, without parsing the rest of the array
+
+    :param chunks: iterable of the file's content in chunks of bytes
+    :param sample_size: max number of records
+    :type sample_size: int
+    :returns: tuple of the records, the number of content bytes they took
+    and whether the whole file was read
+    """
+    decode = codecs.getincrementaldecoder('utf-8')().decode
+    raw_decode = json.JSONDecoder().raw_decode
+    records = []
+    # Text not parsed yet, and the bytes of the text dropped before it
+    text, pos, dropped = '', 0, 0
+    is_array = None
+    for data in itertools.chain(chunks, [None]):
+        end = data is None
+        text += decode(b'' if end else data, final=end)
+        while True:
+            while pos < len(text) and text[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(text):
+                break
+            if is_array is None:
+                is_array = text[pos] == '['
+                if is_array:
+                    pos += 1
+                continue
+            if not is_array:
+                if not end:
+                    # A single record is read as a whole
+                    break
+                records.append(json.loads(text[pos:]))
+                return records, dropped + len(text.encode('utf-8')), True
+            if text[pos] == ']':
+                return records, dropped + len(text.encode('utf-8')), True
+            try:
+                record, pos = raw_decode(text, pos)
+            except ValueError:
+                if end:
+                    raise
+                break
+            records.append(record)
+            if len(records) >= sample_size:
+                return (
+                    records, dropped + len(text[:pos].encode('utf-8')), False
+                )
+        dropped += len(text[:pos].encode('utf-8'))
+        text, pos = text[pos:], 0
+    raise ValueError('JSON document ended before the end of the array')
+
+
+class ExportEstimator(object):
+
+    def __init__(
+        self,
+        pfb_schema,
+        codec=DEFAULT_AVRO_CODEC,
+        sample_size=DEFAULT_ESTIMATE_SAMPLE_SIZE,
+        workers=DEFAULT_WORKERS,
+        scan_workers=DEFAULT_SCAN_WORKERS,
+        max_memory=None,
+        tmp_dir=None
+    ):
+        """
+        Constructor
+
+        :param pfb_schema: table name -> attributes and foreign keys
+        :type pfb_schema: dict
+        :param codec: Avro codec the output size is estimated for. Defaults
+        to the codec the export writes
+        :type codec: str
+        :param sample_size: max number of records sampled per payload file
+        or table
+        :type sample_size: int
+        :param workers: max number of tables processed concurrently by the
+        export
+        :type workers: int
+        :param scan_workers: number of slices of a table read concurrently
+        by the export
+        :type scan_workers: int
+        :param max_memory: memory budget of the export's buffers
+        :type max_memory: int
+        :param tmp_dir: dir where the sort of the sample spills its runs
+        :type tmp_dir: str
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.pfb_schema = pfb_schema
+        self.codec = codec
+        self.sample_size = sample_size
+        self.workers = workers
+        self.scan_workers = scan_workers
+        self.max_memory = max_memory
+        self.tmp_dir = tmp_dir
+        self.source = None
+        # table -> sampled records
+        self.samples = defaultdict(list)
+        # table -> estimated number of rows
+        self.rows = defaultdict(float)
+        # table -> [seconds spent reading sampled records, count]
+        self._read = defaultdict(lambda: [0.0, 0])
+
+    def sample_payloads(self, data_dir):
+        """
+        Sample the payload files in data_dir and estimate their rows
+        """
+        self.source = 'payloads'
+        filepaths = list_payload_files(data_dir)
+        self.logger.info(f'Sampling {len(filepaths)} payload files')
+        for filepath in filepaths:
+            self._sample_file(filepath)
+
+    def _sample_file(self, filepath):
+        default_type = payload_type_from_filename(filepath)
+        ext = os.path.splitext(strip_compression_ext(filepath))[-1]
+        sample = sample_lines if ext in ('.jsonl', '.ndjson') else (
+            sample_document
+        )
+        # (content bytes, file bytes) read after each chunk
+        positions = []
+
+        def _chunks(offset=0):
+            for data, pos in iter_file_chunks(filepath):
+                offset += len(data)
+                positions.append((offset, pos))
+                yield data
+
+        start = time.perf_counter()
+        chunks = _chunks()
+        try:
+            sampled, offset, complete = sample(chunks, self.sample_size)
+        finally:
+            chunks.close()
+        seconds = time.perf_counter() - start
+        if not sampled:
+            return
+        total = len(sampled)
+        if not complete:
+            total *= os.path.getsize(filepath) / max(
+                file_position(positions, offset), 1
+            )
+
+        counts = defaultdict(int)
+        for record in sampled:
+            table = record.setdefault('type', default_type)
+            counts[table] += 1
+            if len(self.samples[table]) < self.sample_size:
+                self.samples[table].append(record)
+        for table, count in counts.items():
+            share = count / len(sampled)
+            self.rows[table] += total * share
+            self._read[table][0] += seconds * share
+            self._read[table][1] += count
+
+    def sample_database(self, engine, tables):
+        """
+        Count the rows of the tables and sample their first rows
+
+        :param engine: SQLAlchemy engine
+        :type engine: sqlalchemy.engine.Engine
+        :param tables: table name -> SQLAlchemy Table
+        :type tables: dict
+        """
+        self.source = 'database'
+        self.logger.info(f'Sampling {len(tables)} tables in the database')
+        with engine.connect() as conn:
+            for name, table in tables.items():
+                self.rows[name] = conn.execute(
+                    select([func.count()]).select_from(table)
+                ).scalar()
+                start = time.perf_counter()
+                self.samples[name] = [
+                    {k: json_value(v) for k, v in row.items()}
+                    for row in conn.execute(
+                        select([table]).limit(self.sample_size)
+                    )
+                ]
+                self._read[name] = [
+                    time.perf_counter() - start, len(self.samples[name])
+                ]
+
+    def estimate(self):
+        """
+        Encode the samples and extrapolate to all rows
+
+        :returns: estimate dict with the rows, output size and seconds of
+        each table and in total, and the peak memory
+        """
+        compiled = compile_schema(self.pfb_schema)
+        writer = PfbWriter(io.BytesIO(), self.pfb_schema, codec=self.codec)
+        packer = RowPacker(self.pfb_schema)
+
+        tables = OrderedDict()
+        for table in sorted(self.rows):
+            sample = self.samples[table]
+            if table not in self.pfb_schema:
+                self.logger.warning(
+                    f'⚠️ Skipping {table}. {table} is not in the PFB schema'
+                )
+                continue
+            if not sample:
+                continue
+            n = len(sample)
+            rows = int(round(self.rows[table]))
+
+            start = time.perf_counter()
+            avro_bytes, output_bytes = self._encode(
+                writer, compiled.tagged_schemas[table], table, sample
+            )
+            encode = (time.perf_counter() - start) / n
+            read_seconds, read_count = self._read[table]
+            read = read_seconds / max(read_count, 1)
+            if self.source == 'payloads':
+                seconds = rows * (read + self._sort_seconds(table, sample) +
+                                  encode)
+            else:
+                # Rows are fetched by parallel slices while the writer
+                # encodes
+                seconds = rows * max(read / self.scan_workers, encode)
+
+            packed = [packer.pack(r, table) for r in sample]
+            lines = [json.dumps(list(p), separators=(',', ':'))
+                     for p in packed]
+            tables[table] = {
+                'rows': rows,
+                'sampled': n,
+                'avro_bytes': int(rows * avro_bytes / n),
+                'output_bytes': int(rows * output_bytes / n),
+                'seconds': round(seconds, 3),
+                # Bytes held per record by the buffers of the export
+                'row_bytes': sum(map(record_size, packed)) / n,
+                'sort_bytes': sum(len(line) for line in lines) / n,
+                'sort_held_bytes': sum(
+                    record_size((str(get_record_id(r)), line))
+                    for r, line in zip(sample, lines)
+                ) / n,
+                'index_bytes': sum(
+                    record_size((table, get_record_id(r) or '', 0, 0))
+                    for r in sample
+                ) / n,
+            }
+
+        total_rows = sum(t['rows'] for t in tables.values())
+        return {
+            'source': self.source,
+            'codec': self.codec,
+            'sample_size': self.sample_size,
+            'tables': OrderedDict(
+                (name, {k: t[k] for k in [
+                    'rows', 'sampled', 'avro_bytes', 'output_bytes', 'seconds'
+                ]})
+                for name, t in tables.items()
+            ),
+            'total': {
+                'rows': total_rows,
+                'output_bytes': sum(
+                    t['output_bytes'] for t in tables.values()
+                ),
+                'seconds': round(
+                    sum(t['seconds'] for t in tables.values()), 3
+                )
+            },
+            'memory': self._memory(tables, total_rows)
+        }
+
+    def _encode(self, writer, schema, table, sample):
+        """
+        Encode the sample into blocks of the writer's size
+
+        :returns: tuple of (encoded bytes, compressed bytes)
+        """
+        avro_bytes = output_bytes = 0
+        buf = io.BytesIO()
+        for i, record in enumerate(sample):
+            schemaless_writer(
+                buf, schema, writer.make_entity(record, entity_type=table)
+            )
+            if buf.tell() >= DEFAULT_SYNC_INTERVAL or i == len(sample) - 1:
+                data = buf.getvalue()
+                avro_bytes += len(data)
+                output_bytes += len(compress(self.codec, data))
+                buf = io.BytesIO()
+        return avro_bytes, output_bytes
+
+    def _sort_seconds(self, table, sample):
+        """
+        Seconds per record to sort the sample, spilling it to a sorted run
+        and merging it back
+        """
+        start = time.perf_counter()
+        with ExternalSorter(
+            tmp_dir=self.tmp_dir, packer=RowPacker(self.pfb_schema)
+        ) as sorter:
+            for record in sample:
+                sorter.add(record, entity_type=table)
+            sorter.spill()
+            for _ in sorter.sorted_partition(table):
+                pass
+        return (time.perf_counter() - start) / len(sample)
+
+    def _memory(self, tables, total_rows):
+        """
+        Estimate the peak memory from the sizes of the export's buffers
+        """
+        row_bytes = max((t['row_bytes'] for t in tables.values()), default=0)
+        buffers = OrderedDict()
+        if self.source == 'payloads':
+            # The sort buffer holds up to DEFAULT_SORT_BUFFER_SIZE bytes of
+            # serialized rows across all tables
+            line_bytes = sum(
+                t['rows'] * t['sort_bytes'] for t in tables.values()
+            )
+            held = min(1, DEFAULT_SORT_BUFFER_SIZE / (line_bytes or 1))
+            buffers['sort buffer'] = held * sum(
+                t['rows'] * t['sort_held_bytes'] for t in tables.values()
+            )
+        else:
+            buffers['scan batches'] = (
+                self.scan_workers * DEFAULT_SCAN_BATCH_SIZE * row_bytes
+            )
+        buffers['prefetch queues'] = (
+            self.workers * DEFAULT_PREFETCH_SIZE * row_bytes
+        )
+        # Encoded and compressed copy of the block being written
+        buffers['avro block'] = 2 * DEFAULT_SYNC_INTERVAL
+        index_bytes = max(
+            (t['index_bytes'] for t in tables.values()), default=0
+        )
+        buffers['index buffer'] = (
+            min(total_rows, DEFAULT_INDEX_BUFFER_SIZE) * index_bytes
+        )
+
+        buffered = sum(buffers.values())
+        if self.max_memory:
+            buffered = min(buffered, self.max_memory)
+        baseline = process_memory()
+        return {
+            'baseline_bytes': baseline,
+            'buffers': OrderedDict(
+                (name, int(nbytes)) for name, nbytes in buffers.items()
+            ),
+            'peak_bytes': int(baseline + buffered)
+        }
+
+    def log_report(self, report):
+        """
+        Log an estimate as a table
+        """
+        lines = [
+            f'  {"table":<30} {"rows":>12} {"output":>12} {"time":>12}'
+        ]
+        for name, t in list(report['tables'].items()) + [
+            ('TOTAL', report['total'])
+        ]:
+            lines.append(
+                f'  {name:<30} {t["rows"]:>12} '
+                f'{format_size(t["output_bytes"]):>12} '
+                f'{format_seconds(t["seconds"]):>12}'
+            )
+        memory = report['memory']
+        lines.append(
+            f'  Peak memory {format_size(memory["peak_bytes"])}: '
+            f'{format_size(memory["baseline_bytes"])} baseline + ' +
+            ', '.join(
+                f'{name} {format_size(nbytes)}'
+                for name, nbytes in memory['buffers'].items()
+            )
+        )
+        self.logger.info(
+            f'Estimate for the {report["source"]} with codec '
+            f'{report["codec"]}:\n' + '\n'.join(lines)
+        )
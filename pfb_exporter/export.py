@@ -24,20 +24,112 @@ is used to inspect the database and autogenerate the SQLAlchemy models
 which are in turn used to create the PFB Schema.
 """
 import os
+import json
 import logging
+import threading
+from contextlib import nullcontext
+from copy import deepcopy
+from pprint import pformat
 
 from pfb_exporter.config import (
+    DEFAULT_ESTIMATE_FILE,
+    DEFAULT_ESTIMATE_SAMPLE_SIZE,
     DEFAULT_OUTPUT_DIR,
     DEFAULT_PFB_FILE,
+    DEFAULT_STATS_FILE,
     DEFAULT_MODELS_PATH,
-    DEFAULT_TRANFORM_MOD
+    DEFAULT_TRANFORM_MOD,
+    DEFAULT_WORKERS,
+    DEFAULT_ENUM_THRESHOLD,
+    DEFAULT_SCAN_WORKERS,
+    DEFAULT_SCAN_SLICES,
+    COLUMNAR_DIR
 )
 from pfb_exporter.utils import (
     import_module_from_file,
     import_subclass_from_module,
     setup_logger
 )
+from pfb_exporter.columnar import ColumnarWriter
+from pfb_exporter.compat import (
+    align_pfb_schema,
+    check_compatibility,
+    fingerprint,
+    pfb_schema_from_avro,
+    rewrite_pfb
+)
+from pfb_exporter.container import read_container
+from pfb_exporter.enums import EnumDetector
+from pfb_exporter.estimate import ExportEstimator
+from pfb_exporter.extract import RangeScanner, create_pooled_engine
+from pfb_exporter.graph import dependency_levels, iter_by_level
+from pfb_exporter.index import index_path
+from pfb_exporter.memory import MemoryGovernor
+from pfb_exporter.payloads import iter_payloads
+from pfb_exporter.profiling import Profiler
+from pfb_exporter.rows import RowPacker
+from pfb_exporter.sort import ExternalSorter
+from pfb_exporter.subgraph import (
+    DatabaseSource,
+    PayloadIndex,
+    Subgraph,
+    select_payloads
+)
 from pfb_exporter.transform.base import Transformer
+from pfb_exporter.writer import PfbWriter, make_avro_schema
+
+
+def create_transformer(
+    transform_module_filepath, models_filepath, output_dir, db_conn_url=None,
+    tables=None, exclude_tables=None, db_schema=None
+):
+    """
+    Create the relational model to PFB Schema transformer implemented in a
+    transform module
+
+    :param transform_module_filepath: path to a Python module with a class
+    which extends pfb_exporter.transform.base.Transformer
+    :type transform_module_filepath: str
+    :param models_filepath: path to where the SQLAlchemy models are stored
+    or will be written if they are generated
+    :type models_filepath: str
+    :param output_dir: path where PFB Schema will be written. If None, the
+    schema is not written
+    :type output_dir: str
+    :param db_conn_url: Connection URL for database
+    :type db_conn_url: str
+    :param tables: if provided, only these tables and the tables they depend
+    on are transformed. See pfb_exporter.graph.select_tables
+    :type tables: list
+    :param exclude_tables: tables which are not transformed
+    :type exclude_tables: list
+    :param db_schema: database schema the models are generated from
+    :type db_schema: str
+    """
+    # Import transformer subclass class from transform module
+    mod = import_module_from_file(transform_module_filepath)
+    child_classes = import_subclass_from_module(Transformer, mod)
+
+    if not child_classes:
+        raise NotImplementedError(
+            f'Transform module {transform_module_filepath} must implement '
+            f'a class which extends the abstract base class '
+            f'{os.path.abspath(mod.__file__)}. + {Transformer.__name__}'
+        )
+
+    # Only passed if set, so transformers which do not select tables
+    # still work without them
+    kwargs = {
+        k: v for k, v in [
+            ('tables', tables),
+            ('exclude_tables', exclude_tables),
+            ('db_schema', db_schema)
+        ]
+        if v
+    }
+    return child_classes[0](
+        models_filepath, output_dir, db_conn_url=db_conn_url, **kwargs
+    )
 
 
 class PfbExporter(object):
@@ -48,35 +140,136 @@ class PfbExporter(object):
         db_conn_url=None,
         models_filepath=DEFAULT_MODELS_PATH,
         transform_module_filepath=DEFAULT_TRANFORM_MOD,
-        output_dir=DEFAULT_OUTPUT_DIR
+        output_dir=DEFAULT_OUTPUT_DIR,
+        workers=DEFAULT_WORKERS,
+        detect_enums=False,
+        enum_threshold=DEFAULT_ENUM_THRESHOLD,
+        enum_overrides=None,
+        columnar_format=None,
+        scan_workers=DEFAULT_SCAN_WORKERS,
+        scan_slices=DEFAULT_SCAN_SLICES,
+        scan_key=None,
+        pool_size=None,
+        scan_slots=None,
+        transformer=None,
+        pfb_schema=None,
+        engine=None,
+        setup_logging=True,
+        profile=False,
+        append=False,
+        root=None,
+        max_memory=None,
+        tables=None,
+        exclude_tables=None,
+        db_schema=None
     ):
-        setup_logger(os.path.join(output_dir, 'logs'))
+        """
+        Constructor
+
+        If data_dir is empty, records are extracted from the database with
+        parallel range scans over scan_slices key ranges (partitioned by
+        scan_key or the primary key), read by scan_workers workers per table
+        over a pool of pool_size connections (defaults to scan_workers)
+
+        A long running process can reuse its resident state across exports
+        by passing a transformer, the PFB schema it already built and a
+        pooled SQLAlchemy engine, with the scan slots of its pool
+
+        :param scan_slots: semaphore with one slot per connection of the
+        engine's pool, shared by all exports which use the engine. Defaults
+        to a semaphore of pool_size slots for this export only
+        :type scan_slots: threading.Semaphore
+        :param transformer: relational model to PFB Schema transformer. If
+        not provided, one is created from transform_module_filepath
+        :type transformer: pfb_exporter.transform.base.Transformer
+        :param pfb_schema: PFB schema built by the transformer. If provided,
+        the relational model is not transformed again
+        :type pfb_schema: dict
+        :param engine: SQLAlchemy engine used to query the database
+        :type engine: sqlalchemy.engine.Engine
+        :param setup_logging: whether to add the root log handlers which
+        write to output_dir/logs and the console
+        :type setup_logging: bool
+        :param profile: whether to profile each phase of the export with
+        cProfile and tracemalloc. Profiles are written to
+        output_dir/profile. See pfb_exporter.profiling
+        :type profile: bool
+        :param append: whether to append the records to an existing PFB file
+        in output_dir instead of overwriting it. The PFB schema must be
+        backward compatible with the file's schema. If it is not identical,
+        the file is rewritten with the new schema first. See
+        pfb_exporter.compat
+        :type append: bool
+        :param root: if provided, only the records connected to this root
+        record are exported, e.g. ('study', 'kf_id', 'SD_00000001'). See
+        pfb_exporter.subgraph
+        :type root: tuple
+        :param max_memory: if provided, budget in bytes for the buffers of
+        the export pipeline. See pfb_exporter.memory
+        :type max_memory: int
+        :param tables: if provided, only these tables and the tables they
+        depend on through foreign keys are reflected, imported and exported.
+        Ignored if a transformer is provided
+        :type tables: list
+        :param exclude_tables: tables which are not reflected, imported or
+        exported. Ignored if a transformer is provided
+        :type exclude_tables: list
+        :param db_schema: database schema the models are generated from.
+        Ignored if a transformer is provided
+        :type db_schema: str
+        """
+        if setup_logging:
+            setup_logger(os.path.join(output_dir, 'logs'))
         self.logger = logging.getLogger(type(self).__name__)
         self.models_filepath = os.path.abspath(
             os.path.expanduser(models_filepath)
         )
-        self.data_dir = os.path.abspath(os.path.expanduser(data_dir))
+        self.data_dir = (
+            os.path.abspath(os.path.expanduser(data_dir)) if data_dir else None
+        )
         self.output_dir = os.path.abspath(os.path.expanduser(output_dir))
+        os.makedirs(self.output_dir, exist_ok=True)
 
         self.pfb_file = os.path.join(output_dir, DEFAULT_PFB_FILE)
+        self.workers = workers
+        self.append = append
+        self.root = root
+        self.memory = MemoryGovernor(max_memory) if max_memory else None
 
-        # Relational model to PFB Schema transformer
-        self.transformer = None
+        # Low-cardinality text column to Avro enum detection
+        self.detect_enums = detect_enums
+        self.enum_threshold = enum_threshold
+        self.enum_overrides = enum_overrides
 
-        # Import transformer subclass class from transform module
-        mod = import_module_from_file(transform_module_filepath)
-        child_classes = import_subclass_from_module(Transformer, mod)
+        # Optional per-table Parquet/Arrow output written alongside the PFB
+        self.columnar_format = columnar_format
 
-        if not child_classes:
-            raise NotImplementedError(
-                f'Transform module {transform_module_filepath} must implement '
-                f'a class which extends the abstract base class '
-                f'{os.path.abspath(mod.__file__)}. + {Transformer.__name__}'
-            )
-        else:
-            self.transformer = child_classes[0](
-                self.models_filepath, self.output_dir, db_conn_url=db_conn_url
-            )
+        # Parallel database range scans
+        self.scan_workers = scan_workers
+        self.scan_slices = scan_slices
+        self.scan_key = scan_key
+        self.pool_size = pool_size or scan_workers
+        self.scan_slots = scan_slots or threading.BoundedSemaphore(
+            self.pool_size
+        )
+
+        # Relational model to PFB Schema transformer
+        self.transformer = transformer or create_transformer(
+            transform_module_filepath,
+            self.models_filepath,
+            self.output_dir,
+            db_conn_url=db_conn_url,
+            tables=tables,
+            exclude_tables=exclude_tables,
+            db_schema=db_schema
+        )
+        self.engine = engine
+        self._pfb_schema = pfb_schema
+        self.pfb_schema = None
+
+        self.profiler = Profiler(self.output_dir) if profile else None
+        if self.profiler:
+            self.transformer.profiler = self.profiler
 
     def export(self, output_to_pfb=True):
         """
@@ -87,28 +280,386 @@ class PfbExporter(object):
         - Transform the data into PFB Entities
         - Create an Avro file with the PFB schema and Entities
 
+        Exits with status 1 if the export fails. See run for a version which
+        raises exceptions instead
+
+        :param output_to_pfb: whether to complete the export after transforming
+        the relational model to the PFB schema
+        :type output_to_pfb: bool
+        """
+        try:
+            self.run(output_to_pfb=output_to_pfb)
+        except Exception:
+            exit(1)
+
+    def run(self, output_to_pfb=True):
+        """
+        Same as export but raises an exception if the export fails
+
         :param output_to_pfb: whether to complete the export after transforming
         the relational model to the PFB schema
         :type output_to_pfb: bool
         """
         try:
-            # Transform relational model to PFB Schema
-            self.transformer.transform()
+            self._transform()
             # Create the PFB file from the PFB Schema and data
             if output_to_pfb:
                 self._create_pfb()
+            elif self.detect_enums:
+                self._detect_enums_in_database()
         except Exception as e:
             self.logger.exception(str(e))
             self.logger.info(f'❌ Export to PFB file {self.pfb_file} failed!')
-            exit(1)
+            raise
         else:
             self.logger.info(
                 f'✅ Export to PFB file {self.pfb_file} succeeded!'
             )
 
+    def estimate(self, sample_size=DEFAULT_ESTIMATE_SAMPLE_SIZE):
+        """
+        Estimate the wall time, output size and peak memory of the export
+        from a sample of each table, without running it. The estimate is
+        written to output_dir. See pfb_exporter.estimate
+
+        :param sample_size: max number of records sampled per payload file
+        or table
+        :type sample_size: int
+        :returns: estimate dict
+        """
+        self._transform()
+        estimator = ExportEstimator(
+            self.pfb_schema,
+            sample_size=sample_size,
+            workers=self.workers,
+            scan_workers=self.scan_workers,
+            max_memory=self.memory.max_memory if self.memory else None,
+            tmp_dir=self.output_dir
+        )
+        if self.data_dir:
+            estimator.sample_payloads(self.data_dir)
+        else:
+            engine = self.engine or self._create_engine()
+            try:
+                estimator.sample_database(engine, self._database_tables())
+            finally:
+                if engine is not self.engine:
+                    engine.dispose()
+        report = estimator.estimate()
+
+        estimate_file = os.path.join(self.output_dir, DEFAULT_ESTIMATE_FILE)
+        self.logger.info(f'✏️ Writing estimate to {estimate_file}')
+        with open(estimate_file, 'w') as json_file:
+            json.dump(report, json_file, indent=4)
+        estimator.log_report(report)
+        return report
+
+    def _transform(self):
+        """
+        Transform the relational model to the PFB Schema, or copy the PFB
+        schema that was provided
+        """
+        if self._pfb_schema is not None:
+            # Enum detection modifies the schema
+            self.pfb_schema = deepcopy(self._pfb_schema)
+            self.transformer.write_pfb_schema(
+                self.pfb_schema, output_dir=self.output_dir
+            )
+        else:
+            self.pfb_schema = self.transformer.transform()
+
+    def _create_engine(self):
+        """
+        Create a pooled engine for the transformer's database
+        """
+        db_conn_url = self.transformer.db_conn_url
+        if not db_conn_url:
+            raise RuntimeError(
+                'A data dir or a database connection URL is required to '
+                'export data'
+            )
+        return create_pooled_engine(db_conn_url, pool_size=self.pool_size)
+
+    def _database_tables(self):
+        """
+        Get the SQLAlchemy tables of the models, by table name
+        """
+        return {
+            model_cls.__tablename__: model_cls.__table__
+            for model_cls in self.transformer.model_dict.values()
+        }
+
     def _create_pfb(self):
         """
-        Create a PFB file from a Gen3 PFB Schema and JSON payloads
+        Create a PFB file from a Gen3 PFB Schema and JSON payloads, or from
+        the database if there is no data_dir
+
+        Records are written in dependency level order so that parent entities
+        are written before their children. The import order is derived from
+        the foreign keys in the PFB schema.
+        """
+        levels = dependency_levels(self.pfb_schema)
+        self.logger.info(
+            f'Import order has {len(levels)} dependency levels:\n'
+            f'{pformat(levels)}'
+        )
+        if self.data_dir:
+            self._create_pfb_from_payloads(levels)
+        else:
+            self._create_pfb_from_database(levels)
+
+    def _create_pfb_from_payloads(self, levels):
+        """
+        Payload records are externally sorted into import order before they
+        are written
+        """
+        enum_detector = self._enum_detector()
+        records = iter_payloads(self.data_dir, memory=self.memory)
+        if self.root:
+            records = self._select_payloads()
+        if getattr(self.transformer, 'selected_tables', None) is not None:
+            # Drop the records of the tables which were not selected
+            records = (
+                r for r in records if r.get('type') in self.pfb_schema
+            )
+        if enum_detector:
+            records = enum_detector.observe_all(records)
+
+        # Records are held as compact rows between the sort and the writers
+        with ExternalSorter(
+            tmp_dir=self.output_dir,
+            packer=RowPacker(self.pfb_schema),
+            memory=self.memory
+        ) as sorter:
+            with self._phase('read'):
+                sorter.add_all(records)
+            self.logger.info(
+                f'Sorted {sorter.record_count} records into import order'
+            )
+            if enum_detector:
+                enum_detector.apply(self.pfb_schema)
+                self.transformer.write_pfb_schema(
+                    self.pfb_schema, output_dir=self.output_dir
+                )
+            self._write_pfb(iter_by_level(
+                sorter.order(levels),
+                self._worker(sorter.sorted_partition),
+                max_workers=self.workers,
+                memory=self.memory
+            ))
+
+    def _create_pfb_from_database(self, levels):
+        """
+        Each table is read with parallel range scans. Tables are read in
+        import order, so no sort is needed. With a root record, only the
+        rows connected to it are looked up
+        """
+        engine = self.engine or self._create_engine()
+        tables = self._database_tables()
+        packer = RowPacker(self.pfb_schema)
+        try:
+            if self.detect_enums:
+                self._detect_enums_in_database(engine=engine)
+
+            if self.root:
+                subgraph = Subgraph(
+                    self.pfb_schema, self.root, memory=self.memory
+                )
+                with self._phase('read'):
+                    subgraph.traverse(
+                        DatabaseSource(engine, tables, packer=packer)
+                    )
+                self._write_pfb(subgraph.records(levels))
+                subgraph.close()
+                return
+
+            def _scan(table_name):
+                scanner = RangeScanner(
+                    engine,
+                    tables[table_name],
+                    key=self.scan_key,
+                    slices=self.scan_slices,
+                    workers=self.scan_workers,
+                    slots=self.scan_slots,
+                    profiler=self.profiler,
+                    packer=packer,
+                    memory=self.memory
+                )
+                return scanner.scan()
+
+            self._write_pfb(iter_by_level(
+                [[t for t in level if t in tables] for level in levels],
+                self._worker(_scan),
+                max_workers=self.workers,
+                memory=self.memory
+            ))
+        finally:
+            if engine is not self.engine:
+                engine.dispose()
+
+    def _select_payloads(self):
+        """
+        Index the payloads by the columns the foreign keys follow, find the
+        records connected to the root record and return a generator which
+        reads the payloads again and yields only those records
+        """
+        subgraph = Subgraph(self.pfb_schema, self.root, memory=self.memory)
+        with self._phase('index'):
+            index = PayloadIndex(
+                iter_payloads(self.data_dir, memory=self.memory),
+                subgraph.index_columns(),
+                memory=self.memory
+            )
+            self.logger.info(f'Indexed {index.record_count} payload records')
+            subgraph.traverse(index)
+        positions = subgraph.identities()
+        index.close()
+        subgraph.close()
+        return select_payloads(
+            iter_payloads(self.data_dir, memory=self.memory), positions
+        )
+
+    def _write_pfb(self, records):
+        """
+        Write records to the PFB file and the optional columnar files
+        """
+        append = self._prepare_append()
+        self.logger.info(
+            f'✏️ {"Appending to" if append else "Writing"} PFB file '
+            f'{self.pfb_file}'
+        )
+        writer = PfbWriter(
+            self.pfb_file, self.pfb_schema, append=append, memory=self.memory,
+            index=True
+        )
+        columnar = self._columnar_writer()
+        try:
+            # Records are converted and Avro encoded into blocks in memory,
+            # which are written out as they fill up
+            with self._phase('encode'):
+                if not append:
+                    writer.write_metadata()
+                for record in records:
+                    writer.write(record)
+                    if columnar:
+                        columnar.write(record)
+        finally:
+            # Flush the last block and the buffered columnar batches
+            with self._phase('write'):
+                writer.close()
+                if columnar:
+                    columnar.close()
+
+        stats_file = os.path.join(self.output_dir, DEFAULT_STATS_FILE)
+        self.logger.info(f'✏️ Writing statistics to {stats_file}')
+        with open(stats_file, 'w') as json_file:
+            json.dump(writer.stats, json_file, indent=4, sort_keys=True)
+
+        self.logger.info(
+            f'Wrote {writer.record_count} entities to {self.pfb_file} and '
+            f'their record id index to {index_path(self.pfb_file)}'
+        )
+        if self.memory:
+            self.memory.log_summary()
+
+    def _prepare_append(self):
+        """
+        Check that the PFB schema is backward compatible with the schema of
+        the existing PFB file and rewrite the file with the new schema if
+        the schemas differ
+
+        :raises IncompatibleSchemaError: if the schema is not compatible
+        :returns: whether records should be appended to the PFB file
         """
-        # Add schema to temporary avro file
-        pass
+        if not (self.append and os.path.isfile(self.pfb_file)):
+            return False
+
+        header, _ = read_container(self.pfb_file)
+        old_pfb_schema = pfb_schema_from_avro(header.schema)
+        self.pfb_schema = align_pfb_schema(old_pfb_schema, self.pfb_schema)
+        changes = check_compatibility(old_pfb_schema, self.pfb_schema)
+        if self.columnar_format:
+            self.logger.warning(
+                f'⚠️ {self.columnar_format} files are not appended to. '
+                'They will only contain the appended records'
+            )
+
+        old_fp = fingerprint(header.schema)
+        new_fp = fingerprint(make_avro_schema(self.pfb_schema))
+        if old_fp == new_fp:
+            self.logger.info(
+                f'PFB schema is unchanged (fingerprint {new_fp})'
+            )
+            return True
+
+        self.logger.info(
+            f'PFB schema changed from fingerprint {old_fp} to {new_fp}:\n'
+            f'{pformat(changes.compatible)}'
+        )
+        self.transformer.write_pfb_schema(
+            self.pfb_schema, output_dir=self.output_dir
+        )
+        rewrite_pfb(self.pfb_file, header, self.pfb_schema)
+        return True
+
+    def _columnar_writer(self):
+        """
+        Create the columnar writer if columnar output is enabled
+        """
+        if not self.columnar_format:
+            return None
+        self.logger.info(
+            f'✏️ Writing {self.columnar_format} files to '
+            f'{os.path.join(self.output_dir, COLUMNAR_DIR)}'
+        )
+        return ColumnarWriter(
+            self.output_dir, self.pfb_schema, fmt=self.columnar_format,
+            memory=self.memory
+        )
+
+    def _phase(self, name):
+        """
+        Context manager which profiles a phase of the export if profiling
+        is enabled
+        """
+        if self.profiler:
+            return self.profiler.phase(name)
+        return nullcontext()
+
+    def _worker(self, func):
+        """
+        Wrap a function which runs on worker threads so it is profiled if
+        profiling is enabled
+        """
+        return self.profiler.worker(func) if self.profiler else func
+
+    def _enum_detector(self):
+        """
+        Create the enum detector if enum detection is enabled
+        """
+        if not self.detect_enums:
+            return None
+        return EnumDetector(
+            self.pfb_schema,
+            threshold=self.enum_threshold,
+            overrides=self.enum_overrides
+        )
+
+    def _detect_enums_in_database(self, engine=None):
+        """
+        Detect enum attributes by profiling the database columns and update
+        the PFB schema file
+        """
+        engine = engine or self.engine or self.transformer.db_conn_url
+        if not engine:
+            self.logger.warning(
+                '⚠️ Enum detection without payloads requires a database '
+                'connection URL. Skipping enum detection'
+            )
+            return
+        enum_detector = self._enum_detector()
+        enum_detector.profile_database(engine, self.transformer.model_dict)
+        enum_detector.apply(self.pfb_schema)
+        self.transformer.write_pfb_schema(
+            self.pfb_schema, output_dir=self.output_dir
+        )
@@ -0,0 +1,361 @@
+"""
+Extract records from the database with parallel range scans
+
+A single cursor per table caps extraction at one core and one connection.
+Large tables are partitioned into slices by ranges of a key column (the
+primary key by default, or e.g. created_at). The slice boundaries are
+computed in one query with the ntile window function, so each slice holds
+about the same number of rows. Slices are read concurrently over a bounded
+connection pool, and their rows are merged into a single stream in whatever
+order they arrive.
+
+There are more slices than workers, so a slow or stalled slice only ties up
+one worker while the other workers carry on with the remaining slices.
+Workers which make no progress for stall_timeout seconds are logged.
+
+Scans of several tables share a number of slots, one per pooled connection.
+A slice reads its rows in pages ordered by primary key (keyset pagination),
+with one query per page. It only holds a slot and a connection while it
+runs that query, never while it waits for the consumer. So a table which
+is read ahead of the consumer can't keep the table being consumed from
+getting a slot, and the number of open connections stays within the pool.
+"""
+import time
+import uuid
+import queue
+import logging
+import datetime
+import threading
+from contextlib import nullcontext
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import and_, create_engine, func, select, tuple_
+
+from pfb_exporter.config import (
+    DEFAULT_DB_POOL_SIZE,
+    DEFAULT_SCAN_BATCH_SIZE,
+    DEFAULT_SCAN_MIN_ROWS,
+    DEFAULT_SCAN_SLICES,
+    DEFAULT_SCAN_STALL_TIMEOUT,
+    DEFAULT_SCAN_WORKERS
+)
+from pfb_exporter.memory import record_size
+from pfb_exporter.utils import in_log_context
+
+
+def create_pooled_engine(db_conn_url, pool_size=DEFAULT_DB_POOL_SIZE):
+    """
+    Create a SQLAlchemy engine with a connection pool of at most pool_size
+    connections. Dialects which don't support a sized pool (e.g. SQLite) get
+    their default pool.
+
+    Scan slices check out a connection for one page at a time and hold a
+    scan slot while they do, so with pool_size slots they never wait on a
+    checkout.
+    """
+    try:
+        return create_engine(
+            db_conn_url, pool_size=pool_size, max_overflow=0,
+            pool_pre_ping=True
+        )
+    except TypeError:
+        return create_engine(db_conn_url, pool_pre_ping=True)
+
+
+def json_value(value):
+    """
+    Convert a database value to a JSON serializable payload value
+    """
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def _put(q, item, stop):
+    """
+    Put an item on a bounded queue unless the consumer has stopped
+    """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+class _SliceDone(object):
+    def __init__(self, index, error=None):
+        self.index = index
+        self.error = error
+
+
+class RangeScanner(object):
+
+    def __init__(
+        self,
+        engine,
+        table,
+        key=None,
+        slices=DEFAULT_SCAN_SLICES,
+        workers=DEFAULT_SCAN_WORKERS,
+        batch_size=DEFAULT_SCAN_BATCH_SIZE,
+        min_rows=DEFAULT_SCAN_MIN_ROWS,
+        stall_timeout=DEFAULT_SCAN_STALL_TIMEOUT,
+        slots=None,
+        profiler=None,
+        packer=None,
+        memory=None
+    ):
+        """
+        Constructor
+
+        :param engine: SQLAlchemy engine. Its pool should have at least
+        `workers` connections
+        :type engine: sqlalchemy.engine.Engine
+        :param table: table to scan
+        :type table: sqlalchemy.Table
+        :param key: name of the column to partition by. Defaults to the
+        table's (first) primary key column
+        :type key: str
+        :param slices: number of slices to partition the table into
+        :type slices: int
+        :param workers: number of slices read concurrently
+        :type workers: int
+        :param batch_size: number of rows fetched at a time per slice
+        :type batch_size: int
+        :param min_rows: tables with fewer rows are read with a single query
+        :type min_rows: int
+        :param stall_timeout: seconds without progress after which a slice is
+        reported as stalled
+        :type stall_timeout: float
+        :param slots: semaphore shared by all scanners using the same
+        connection pool, with one slot per pooled connection. It is held
+        around each page query, so concurrent scans never wait on a pool
+        checkout
+        :type slots: threading.Semaphore
+        :param profiler: if provided, the scan workers are profiled
+        :type profiler: pfb_exporter.profiling.Profiler
+        :param packer: if provided, rows are yielded as compact rows instead
+        of dicts
+        :type packer: pfb_exporter.rows.RowPacker
+        :param memory: if provided, the batches read ahead of the consumer
+        are registered with this memory governor, and the slices wait while
+        the budget is used up
+        :type memory: pfb_exporter.memory.MemoryGovernor
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.engine = engine
+        self.table = table
+        if key and key in table.c:
+            self.key = table.c[key]
+        else:
+            self.key = list(table.primary_key.columns)[0]
+            if key:
+                self.logger.warning(
+                    f'⚠️ {table.name} has no column {key}. Partitioning it '
+                    f'by {self.key.name} instead'
+                )
+        self.slices = slices
+        self.workers = workers
+        self.batch_size = batch_size
+        self.min_rows = min_rows
+        self.stall_timeout = stall_timeout
+        self.slots = slots or nullcontext()
+        self.profiler = profiler
+        self.packer = packer
+        self.memory = memory
+
+    def row_count(self):
+        with self.engine.connect() as conn:
+            return conn.execute(
+                select([func.count()]).select_from(self.table)
+            ).scalar()
+
+    def boundaries(self):
+        """
+        Compute the lower bound of each slice
+
+        :returns: sorted list of distinct key values
+        """
+        bucket = func.ntile(self.slices).over(order_by=self.key)
+        sub = select(
+            [self.key.label('k'), bucket.label('bucket')]
+        ).where(self.key.isnot(None)).alias('buckets')
+        query = select([func.min(sub.c.k)]).group_by(
+            sub.c.bucket
+        ).order_by(sub.c.bucket)
+
+        with self.engine.connect() as conn:
+            lows = [row[0] for row in conn.execute(query)]
+        return sorted(set(lows))
+
+    def slice_clauses(self):
+        """
+        Create the WHERE clause of each slice. Slices are half open ranges
+        between consecutive boundaries, plus a slice for null keys if the key
+        column is nullable
+        """
+        if self.slices <= 1 or self.row_count() < self.min_rows:
+            return [None]
+
+        bounds = self.boundaries()[1:]
+        if bounds:
+            clauses = [self.key < bounds[0]]
+            clauses.extend(
+                and_(self.key >= lo, self.key < hi)
+                for lo, hi in zip(bounds, bounds[1:])
+            )
+            clauses.append(self.key >= bounds[-1])
+        else:
+            clauses = [self.key.isnot(None)]
+        if self.key.nullable:
+            clauses.append(self.key.is_(None))
+        return clauses
+
+    def _page_query(self, clause, last):
+        """
+        Create the query for the page of a slice after the row whose primary
+        key is last, or for the first page if last is None
+        """
+        pk = list(self.table.primary_key.columns)
+        query = select([self.table]).order_by(*pk).limit(self.batch_size)
+        if clause is not None:
+            query = query.where(clause)
+        if last is not None and len(pk) == 1:
+            query = query.where(pk[0] > last[0])
+        elif last is not None:
+            query = query.where(tuple_(*pk) > tuple_(*last))
+        return query
+
+    def _scan_slice(self, index, clause, out, stop, progress, consumer):
+        columns = [c.key for c in self.table.columns]
+        pk = [c.key for c in self.table.primary_key.columns]
+        to_batch = self._batch_converter(columns)
+        error = None
+        last = None
+        try:
+            while not stop.is_set():
+                # The slot and the connection are released while the slice
+                # waits for the memory budget or the consumer
+                with self.slots:
+                    progress[index] = time.monotonic()
+                    with self.engine.connect() as conn:
+                        rows = conn.execute(
+                            self._page_query(clause, last)
+                        ).fetchall()
+                if not rows:
+                    break
+                progress[index] = time.monotonic()
+                last = [rows[-1][c] for c in pk]
+                batch = to_batch(rows)
+                size = 0
+                if consumer:
+                    size = sum(map(record_size, batch))
+                    if not consumer.reserve(size, stop):
+                        break
+                _put(out, (size, batch), stop)
+                if len(rows) < self.batch_size:
+                    break
+        except Exception as e:
+            error = e
+        finally:
+            _put(out, _SliceDone(index, error), stop)
+
+    def _batch_converter(self, columns):
+        """
+        Create the function which converts a batch of result rows to dicts,
+        or to compact rows if there is a packer for the table
+        """
+        table = self.table.name
+        fields = self.packer.fields(table) if self.packer else None
+        if fields is None:
+            return lambda rows: [
+                {c: json_value(v) for c, v in zip(columns, row)}
+                for row in rows
+            ]
+
+        index = {c: i for i, c in enumerate(columns)}
+        positions = [index.get(f) for f in fields]
+        pack_values = self.packer.pack_values
+        return lambda rows: [
+            pack_values(table, [
+                None if i is None else json_value(row[i])
+                for i in positions
+            ])
+            for row in rows
+        ]
+
+    def scan(self):
+        """
+        Generator which yields every row of the table as a dict of column
+        name -> JSON serializable value, or as a compact row if the scanner
+        has a packer. Rows are yielded in no particular order.
+        """
+        clauses = self.slice_clauses()
+        self.logger.info(
+            f'Scanning {self.table.name} in {len(clauses)} slices '
+            f'with {min(self.workers, len(clauses))} workers'
+        )
+        out = queue.Queue(maxsize=self.workers * 2)
+        stop = threading.Event()
+        # slice index -> time of last progress, for slices in flight
+        progress = {}
+        consumer = (
+            self.memory.consumer('scan batches') if self.memory else None
+        )
+
+        def _run(index, clause):
+            self._scan_slice(index, clause, out, stop, progress, consumer)
+
+        if self.profiler:
+            _run = self.profiler.worker(_run)
+        _run = in_log_context(_run)
+
+        with ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix=f'scan-{self.table.name}'
+        ) as pool:
+            for i, clause in enumerate(clauses):
+                pool.submit(_run, i, clause)
+            remaining = len(clauses)
+            try:
+                while remaining:
+                    try:
+                        item = out.get(timeout=self.stall_timeout)
+                    except queue.Empty:
+                        self._log_stalled(progress)
+                        continue
+                    if isinstance(item, _SliceDone):
+                        progress.pop(item.index, None)
+                        remaining -= 1
+                        if item.error:
+                            raise item.error
+                        continue
+                    size, batch = item
+                    if consumer:
+                        consumer.release(size)
+                    yield from batch
+            finally:
+                stop.set()
+                if consumer:
+                    # Release the batches left in the queue once the slices
+                    # have stopped
+                    pool.shutdown(wait=True)
+                    consumer.close()
+
+    def _log_stalled(self, progress):
+        now = time.monotonic()
+        stalled = sorted(
+            i for i, t in list(progress.items())
+            if now - t >= self.stall_timeout
+        )
+        if stalled:
+            self.logger.warning(
+                f'⚠️ Slices {stalled} of {self.table.name} have made no '
+                f'progress for {self.stall_timeout}s'
+            )
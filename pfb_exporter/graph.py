@@ -0,0 +1,320 @@
+"""
+Table dependency graph built from the foreign keys in the PFB schema
+
+A table depends on (is a child of) every table its foreign keys point to.
+Tables are grouped into dependency levels: level 0 holds the tables with no
+parents, level N holds the tables whose parents are all in levels < N.
+Writing the levels in order writes parents before children, and all tables
+within a level are independent of each other so they can be processed
+concurrently.
+"""
+import queue
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from pfb_exporter.config import DEFAULT_WORKERS, DEFAULT_PREFETCH_SIZE
+from pfb_exporter.memory import record_size
+from pfb_exporter.utils import in_log_context
+
+logger = logging.getLogger(__name__)
+
+
+class DependencyCycleError(Exception):
+    """
+    Raised when the foreign keys between tables form a cycle
+    """
+
+    def __init__(self, cycle):
+        self.cycle = cycle
+        super().__init__(
+            'Foreign keys form a dependency cycle: '
+            f'{" -> ".join(cycle + cycle[:1])}'
+        )
+
+
+def self_references(pfb_schema):
+    """
+    Find the foreign keys which point back to the table they belong to
+
+    :param pfb_schema: table name -> attributes and foreign keys
+    :type pfb_schema: dict
+    :returns: list of (table name, foreign key column name) tuples
+    """
+    return [
+        (table, fk['name'])
+        for table, node in pfb_schema.items()
+        for fk in node.get('foreign_keys', [])
+        if fk['table'] == table
+    ]
+
+
+def dependency_graph(pfb_schema):
+    """
+    Build the table dependency graph from the foreign keys in the PFB schema
+
+    Self references and foreign keys to tables outside of the schema do not
+    constrain the order, so they are left out of the graph
+
+    :param pfb_schema: table name -> attributes and foreign keys
+    :type pfb_schema: dict
+    :returns: dict of table name -> set of parent table names
+    """
+    return {
+        table: {
+            fk['table'] for fk in node.get('foreign_keys', [])
+            if fk['table'] != table and fk['table'] in pfb_schema
+        }
+        for table, node in pfb_schema.items()
+    }
+
+
+def _find_cycle(graph):
+    """
+    Find one cycle in a graph which is known to contain a cycle
+    """
+    visited, stack = set(), []
+    on_stack = set()
+
+    def _visit(node):
+        visited.add(node)
+        stack.append(node)
+        on_stack.add(node)
+        for parent in sorted(graph[node]):
+            if parent in on_stack:
+                return stack[stack.index(parent):]
+            if parent not in visited:
+                cycle = _visit(parent)
+                if cycle:
+                    return cycle
+        stack.pop()
+        on_stack.discard(node)
+        return None
+
+    for node in sorted(graph):
+        if node not in visited:
+            cycle = _visit(node)
+            if cycle:
+                return cycle
+    return sorted(graph)
+
+
+def dependency_levels(pfb_schema):
+    """
+    Group the tables in the PFB schema into dependency levels
+
+    Tables within a level are sorted by name so the order is deterministic
+
+    :param pfb_schema: table name -> attributes and foreign keys
+    :type pfb_schema: dict
+    :raises DependencyCycleError: if the foreign keys form a cycle
+    :returns: list of lists of table names, parents first
+    """
+    for table, column in self_references(pfb_schema):
+        logger.warning(
+            f'⚠️ {table}.{column} references its own table. Records in '
+            f'{table} are not ordered by this foreign key'
+        )
+
+    graph = dependency_graph(pfb_schema)
+    children = defaultdict(set)
+    for table, parents in graph.items():
+        for parent in parents:
+            children[parent].add(table)
+
+    in_degree = {table: len(parents) for table, parents in graph.items()}
+    level = sorted(t for t, n in in_degree.items() if n == 0)
+    levels = []
+    while level:
+        levels.append(level)
+        next_level = set()
+        for table in level:
+            for child in children[table]:
+                in_degree[child] -= 1
+                if in_degree[child] == 0:
+                    next_level.add(child)
+        level = sorted(next_level)
+
+    remaining = {t: graph[t] for t, n in in_degree.items() if n > 0}
+    if remaining:
+        raise DependencyCycleError(_find_cycle(remaining))
+
+    return levels
+
+
+def import_order(pfb_schema):
+    """
+    Get a topological ordering of the tables in the PFB schema
+
+    :param pfb_schema: table name -> attributes and foreign keys
+    :type pfb_schema: dict
+    :returns: list of table names, parents first
+    """
+    return [table for level in dependency_levels(pfb_schema)
+            for table in level]
+
+
+def select_tables(tables, parents, include=None, exclude=None):
+    """
+    Select tables by name and pull in the tables they depend on
+
+    The parents of a selected table are selected too, and their parents, and
+    so on, so every foreign key of a selected table points to a selected
+    table. Excluded tables are never selected, even if a selected table
+    depends on them
+
+    :param tables: names of all tables
+    :type tables: list
+    :param parents: function which takes a table name and returns the names
+    of the tables its foreign keys point to. Only called for tables which
+    are selected, so it may query the database lazily
+    :type parents: function
+    :param include: names of the tables to select. Defaults to all tables
+    :type include: list
+    :param exclude: names of the tables to leave out
+    :type exclude: list
+    :raises ValueError: if an included or excluded table does not exist
+    :returns: set of selected table names
+    """
+    tables = set(tables)
+    include = set(tables if include is None else include)
+    exclude = set(exclude or [])
+    unknown = (include | exclude) - tables
+    if unknown:
+        raise ValueError(
+            f'Tables {sorted(unknown)} do not exist. Tables: {sorted(tables)}'
+        )
+
+    selected = set()
+    pending = sorted(include - exclude)
+    while pending:
+        table = pending.pop()
+        if table in selected:
+            continue
+        selected.add(table)
+        for parent in sorted(set(parents(table)) & tables):
+            if parent in exclude:
+                logger.warning(
+                    f'⚠️ {table} depends on {parent}, which is excluded. '
+                    f'Its foreign keys to {parent} are left out'
+                )
+            elif parent not in selected:
+                pending.append(parent)
+
+    pulled_in = selected - include
+    if pulled_in:
+        logger.info(
+            f'Selected {sorted(pulled_in)} because selected tables depend '
+            'on them'
+        )
+    return selected
+
+
+class _Failure(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+
+_DONE = object()
+
+
+def _put(q, item, stop):
+    """
+    Put an item on a bounded queue unless the consumer has stopped
+    """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def iter_by_level(
+    levels,
+    produce,
+    max_workers=DEFAULT_WORKERS,
+    prefetch_size=DEFAULT_PREFETCH_SIZE,
+    memory=None
+):
+    """
+    Generator which yields the items produced for each table, one table at a
+    time, in level order
+
+    The tables within a level are produced concurrently on a thread pool. Each
+    table is buffered in a bounded queue, so a table's producer runs at most
+    prefetch_size items ahead of the consumer.
+
+    :param levels: list of lists of table names, parents first
+    :type levels: list
+    :param produce: function which takes a table name and returns an
+    iterable of items for that table
+    :type produce: function
+    :param max_workers: max number of tables produced concurrently
+    :type max_workers: int
+    :param prefetch_size: max number of items buffered per table
+    :type prefetch_size: int
+    :param memory: if provided, each table's queue is registered with this
+    memory governor, and its producer waits while the budget is used up
+    :type memory: pfb_exporter.memory.MemoryGovernor
+    """
+    for level in levels:
+        if max_workers <= 1 or len(level) <= 1:
+            for table in level:
+                yield from produce(table)
+            continue
+
+        queues = {table: queue.Queue(maxsize=prefetch_size) for table in level}
+        consumers = {
+            table: memory.consumer('prefetch queues') if memory else None
+            for table in level
+        }
+        stop = threading.Event()
+
+        def _fill(table):
+            q = queues[table]
+            consumer = consumers[table]
+            try:
+                for item in produce(table):
+                    if consumer:
+                        size = record_size(item)
+                        if not consumer.reserve(size, stop):
+                            return
+                        item = (size, item)
+                    if not _put(q, item, stop):
+                        return
+            except Exception as e:
+                _put(q, _Failure(e), stop)
+            finally:
+                _put(q, _DONE, stop)
+
+        with ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='level'
+        ) as pool:
+            for table in level:
+                pool.submit(in_log_context(_fill), table)
+            try:
+                # Tables are consumed in the order they were submitted, so the
+                # table being consumed always has a worker or is done
+                for table in level:
+                    consumer = consumers[table]
+                    while True:
+                        item = queues[table].get()
+                        if item is _DONE:
+                            break
+                        if isinstance(item, _Failure):
+                            raise item.exc
+                        if consumer:
+                            size, item = item
+                            consumer.release(size)
+                        yield item
+            finally:
+                stop.set()
+                if memory:
+                    # Release what is left in the queues once the producers
+                    # have stopped
+                    pool.shutdown(wait=True)
+                    for consumer in consumers.values():
+                        consumer.close()
@@ -0,0 +1,450 @@
+"""
+Record id index for point lookups in a PFB file
+
+Finding one record in a PFB file otherwise means decoding the whole file.
+The index is a sidecar file (<pfb file>.idx) with one fixed width entry per
+data Entity, sorted by entity type and id:
+
+    entity type  uint16  position of the entity type in the header's types
+    id           bytes   UTF-8 id, padded with NUL bytes to the header's
+                         id_size
+    block        uint64  offset of the Avro block the Entity is in
+    ordinal      uint32  position of the Entity in its block
+
+All integers are big endian, so entries sort the same way as their bytes.
+The entries follow a JSON header and are found by binary search over the
+memory mapped file, so no part of the index is loaded before a lookup and a
+lookup reads about log2(entries) entries. Only the block of each record is
+decoded.
+
+The header also stores the sync marker and the size of the PFB file the
+index was written for. A PFB file that was rewritten or appended to since
+has a different size, and its index must be rebuilt (see build_index).
+
+Entries are collected while the PFB file is written (see
+pfb_exporter.writer.PfbWriter) and sorted externally, so building the index
+of a file with hundreds of millions of records holds at most
+max_buffer_size entries in memory.
+"""
+import os
+import json
+import mmap
+import heapq
+import shutil
+import struct
+import logging
+import tempfile
+from collections import defaultdict
+
+from fastavro import parse_schema
+
+from pfb_exporter.config import DEFAULT_INDEX_BUFFER_SIZE, INDEX_FILE_EXT
+from pfb_exporter.container import Header, iter_blocks
+from pfb_exporter.memory import record_size
+
+INDEX_MAGIC = b'PFBIDX1\n'
+INDEX_VERSION = 1
+_HEADER_SIZE = struct.Struct('>I')
+_TYPE = struct.Struct('>H')
+_LOCATION = struct.Struct('>QI')
+# Entries start at a multiple of this offset
+_ALIGNMENT = 8
+
+# Reader schema which decodes only the id and name of an Entity
+ENTITY_KEY_SCHEMA = {
+    'type': 'record',
+    'name': 'Entity',
+    'fields': [
+        {'name': 'id', 'type': ['null', 'string'], 'default': None},
+        {'name': 'name', 'type': 'string'}
+    ]
+}
+
+
+class RecordIndexError(Exception):
+    """
+    Raised when a record id index is missing, not valid or out of date
+    """
+
+
+def index_path(pfb_filepath):
+    """
+    Get the path of the record id index of a PFB file
+    """
+    return f'{pfb_filepath}{INDEX_FILE_EXT}'
+
+
+def iter_entity_keys(fo, header):
+    """
+    Generator which yields (entity type, id, block offset, ordinal) of the
+    data Entities in an Avro file, decoding only their ids and names
+
+    :param fo: binary file-like object positioned after the header
+    :type fo: file-like object
+    :param header: the file's header
+    :type header: pfb_exporter.container.Header
+    """
+    writer_schema = parse_schema(header.schema)
+    reader_schema = parse_schema(ENTITY_KEY_SCHEMA)
+    for block in iter_blocks(fo, header):
+        records = block.records(header.codec, writer_schema, reader_schema)
+        for ordinal, record in enumerate(records):
+            if record['id'] is not None and record['name'] != 'Metadata':
+                yield record['name'], record['id'], block.offset, ordinal
+
+
+class IndexBuilder(object):
+
+    def __init__(
+        self, max_buffer_size=DEFAULT_INDEX_BUFFER_SIZE, tmp_dir=None,
+        memory=None
+    ):
+        """
+        Constructor
+
+        :param max_buffer_size: max number of entries held in memory before
+        a sorted run is spilled to disk
+        :type max_buffer_size: int
+        :param tmp_dir: dir where the temporary run dir is created. Defaults
+        to the system temp dir
+        :type tmp_dir: str
+        :param memory: if provided, the buffer is registered with this
+        memory governor
+        :type memory: pfb_exporter.memory.MemoryGovernor
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.max_buffer_size = max_buffer_size
+        self.tmp_dir = tmp_dir
+        self.count = 0
+        self.id_size = 0
+        self.types = set()
+        # list of (entity type, id, block offset, ordinal)
+        self._buffer = []
+        self._runs = []
+        self._run_dir = None
+        # Indexes whose entries are merged into the new index
+        self._indexes = []
+        self._memory = (
+            memory.consumer('index buffer', spillable=True)
+            if memory else None
+        )
+
+    def add(self, entity_type, record_id, offset, ordinal):
+        """
+        Add the location of a data Entity
+        """
+        entry = (entity_type, record_id, offset, ordinal)
+        self._buffer.append(entry)
+        self.count += 1
+        self.id_size = max(self.id_size, len(record_id.encode('utf-8')))
+        self.types.add(entity_type)
+        if self._memory and self._memory.add(record_size(entry)):
+            self._spill()
+            self._memory.spilled()
+        elif len(self._buffer) >= self.max_buffer_size:
+            self._spill()
+
+    def add_index(self, index):
+        """
+        Add all entries of an existing index, e.g. the index of a PFB file
+        which is appended to. The index is closed once the new index is
+        written
+
+        :param index: the existing index
+        :type index: PfbIndex
+        """
+        self._indexes.append(index)
+        self.count += len(index)
+        self.id_size = max(self.id_size, index.id_size)
+        self.types.update(index.types)
+
+    def _spill(self):
+        """
+        Sort the buffer and write it to disk as a sorted run
+        """
+        if not self._buffer:
+            return
+        if not self._run_dir:
+            self._run_dir = tempfile.mkdtemp(
+                prefix='pfb-index-', dir=self.tmp_dir
+            )
+        self._buffer.sort()
+        filepath = os.path.join(self._run_dir, f'{len(self._runs)}.jsonl')
+        with open(filepath, 'w') as run_file:
+            for entry in self._buffer:
+                run_file.write(json.dumps(entry))
+                run_file.write('\n')
+        self._runs.append(filepath)
+        self._buffer = []
+
+    @staticmethod
+    def _read_run(filepath):
+        with open(filepath) as run_file:
+            for line in run_file:
+                yield tuple(json.loads(line))
+
+    def write(self, filepath, sync, pfb_size, shift=0):
+        """
+        Merge the entries and write the index
+
+        :param filepath: path to the index
+        :type filepath: str
+        :param sync: sync marker of the PFB file
+        :type sync: bytes
+        :param pfb_size: size of the PFB file in bytes
+        :type pfb_size: int
+        :param shift: number of bytes the blocks moved by since their
+        offsets were added, e.g. when the Metadata block was rewritten with
+        a different size
+        :type shift: int
+        """
+        types = sorted(self.types)
+        type_index = {t: i for i, t in enumerate(types)}
+        id_size = self.id_size
+        header = json.dumps({
+            'version': INDEX_VERSION,
+            'types': types,
+            'id_size': id_size,
+            'count': self.count,
+            'sync': sync.hex(),
+            'pfb_size': pfb_size
+        }).encode('utf-8')
+        start = len(INDEX_MAGIC) + _HEADER_SIZE.size + len(header)
+        padding = -start % _ALIGNMENT
+
+        self._buffer.sort()
+        sources = [iter(self._buffer)] + [
+            self._read_run(fp) for fp in self._runs
+        ] + [index.entries() for index in self._indexes]
+
+        tmp_filepath = f'{filepath}.tmp'
+        with open(tmp_filepath, 'wb') as index_file:
+            index_file.write(INDEX_MAGIC)
+            index_file.write(_HEADER_SIZE.pack(len(header)))
+            index_file.write(header)
+            index_file.write(b'\0' * padding)
+            for entity_type, record_id, offset, ordinal in heapq.merge(
+                *sources
+            ):
+                index_file.write(_TYPE.pack(type_index[entity_type]))
+                index_file.write(
+                    record_id.encode('utf-8').ljust(id_size, b'\0')
+                )
+                index_file.write(_LOCATION.pack(offset + shift, ordinal))
+        self.close()
+        os.replace(tmp_filepath, filepath)
+        self.logger.debug(
+            f'Wrote {self.count} entries to record id index {filepath}'
+        )
+
+    def close(self):
+        """
+        Delete the sorted runs and close the merged indexes
+        """
+        for index in self._indexes:
+            index.close()
+        self._indexes = []
+        if self._run_dir:
+            shutil.rmtree(self._run_dir, ignore_errors=True)
+            self._run_dir = None
+        self._runs = []
+        self._buffer = []
+        if self._memory:
+            self._memory.close()
+
+
+class PfbIndex(object):
+
+    def __init__(self, filepath):
+        """
+        Constructor. Memory maps the index
+
+        :param filepath: path to the index
+        :type filepath: str
+        :raises RecordIndexError: if the file is not a record id index
+        """
+        self.filepath = filepath
+        try:
+            self._file = open(filepath, 'rb')
+        except FileNotFoundError:
+            raise RecordIndexError(
+                f'Record id index {filepath} does not exist. Build it with: '
+                'pfbe index <pfb file>'
+            )
+        try:
+            if self._file.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise RecordIndexError(
+                    f'{filepath} is not a record id index'
+                )
+            size, = _HEADER_SIZE.unpack(self._file.read(_HEADER_SIZE.size))
+            header = json.loads(self._file.read(size).decode('utf-8'))
+            if header['version'] != INDEX_VERSION:
+                raise RecordIndexError(
+                    f'Record id index {filepath} has version '
+                    f'{header["version"]}. Expected {INDEX_VERSION}'
+                )
+            self._mm = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_READ
+            )
+        except Exception:
+            self._file.close()
+            raise
+        self.types = header['types']
+        self._type_index = {t: i for i, t in enumerate(self.types)}
+        self.id_size = header['id_size']
+        self.count = header['count']
+        self.sync = bytes.fromhex(header['sync'])
+        self.pfb_size = header['pfb_size']
+        self.key_size = _TYPE.size + self.id_size
+        self.entry_size = self.key_size + _LOCATION.size
+        start = len(INDEX_MAGIC) + _HEADER_SIZE.size + size
+        self._start = start + (-start % _ALIGNMENT)
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def matches(self, pfb_filepath, header):
+        """
+        Whether the index was written for the PFB file as it is now
+        """
+        return (
+            self.sync == header.sync and
+            self.pfb_size == os.path.getsize(pfb_filepath)
+        )
+
+    def _key(self, i):
+        start = self._start + i * self.entry_size
+        return self._mm[start:start + self.key_size]
+
+    def find(self, entity_type, record_id):
+        """
+        Find the locations of the Entities with an entity type and id
+
+        :returns: list of (block offset, ordinal). Usually one location,
+        more if several Entities have the same id
+        """
+        t = self._type_index.get(entity_type)
+        id_bytes = str(record_id).encode('utf-8')
+        if t is None or len(id_bytes) > self.id_size:
+            return []
+        key = _TYPE.pack(t) + id_bytes.ljust(self.id_size, b'\0')
+
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        locations = []
+        while lo < self.count and self._key(lo) == key:
+            start = self._start + lo * self.entry_size + self.key_size
+            locations.append(_LOCATION.unpack_from(self._mm, start))
+            lo += 1
+        return locations
+
+    def entries(self):
+        """
+        Generator which yields all (entity type, id, block offset, ordinal)
+        in index order
+        """
+        for i in range(self.count):
+            start = self._start + i * self.entry_size
+            t, = _TYPE.unpack_from(self._mm, start)
+            record_id = self._mm[
+                start + _TYPE.size:start + self.key_size
+            ].rstrip(b'\0').decode('utf-8')
+            offset, ordinal = _LOCATION.unpack_from(
+                self._mm, start + self.key_size
+            )
+            yield self.types[t], record_id, offset, ordinal
+
+    def close(self):
+        if not self._file.closed:
+            self._mm.close()
+            self._file.close()
+
+
+def build_index(pfb_filepath, index_filepath=None, memory=None):
+    """
+    Build the record id index of an existing PFB file, decoding only the ids
+    and names of its Entities
+
+    :param pfb_filepath: path to the PFB file
+    :type pfb_filepath: str
+    :param index_filepath: path to the index. Defaults to the PFB file's
+    index path
+    :type index_filepath: str
+    :param memory: memory governor the buffered entries are registered with
+    :type memory: pfb_exporter.memory.MemoryGovernor
+    :returns: number of indexed Entities
+    """
+    index_filepath = index_filepath or index_path(pfb_filepath)
+    builder = IndexBuilder(
+        tmp_dir=os.path.dirname(os.path.abspath(index_filepath)),
+        memory=memory
+    )
+    try:
+        with open(pfb_filepath, 'rb') as pfb_file:
+            header = Header.read(pfb_file)
+            for entry in iter_entity_keys(pfb_file, header):
+                builder.add(*entry)
+        builder.write(
+            index_filepath, header.sync, os.path.getsize(pfb_filepath)
+        )
+    finally:
+        builder.close()
+    return builder.count
+
+
+def get_records(pfb_filepath, entity_type, record_ids, index_filepath=None):
+    """
+    Get Entities from a PFB file by id, decoding only the blocks they are in
+
+    :param pfb_filepath: path to the PFB file
+    :type pfb_filepath: str
+    :param entity_type: table of the Entities
+    :type entity_type: str
+    :param record_ids: ids of the Entities
+    :type record_ids: list
+    :param index_filepath: path to the index. Defaults to the PFB file's
+    index path
+    :type index_filepath: str
+    :raises RecordIndexError: if the index is missing or out of date
+    :returns: list of Entity dicts, in the order of record_ids. Ids which
+    are not in the file are left out
+    """
+    index_filepath = index_filepath or index_path(pfb_filepath)
+    with PfbIndex(index_filepath) as index, open(
+        pfb_filepath, 'rb'
+    ) as pfb_file:
+        header = Header.read(pfb_file)
+        if not index.matches(pfb_filepath, header):
+            raise RecordIndexError(
+                f'Record id index {index_filepath} is out of date. '
+                f'{pfb_filepath} changed since it was written. Rebuild it '
+                'with: pfbe index <pfb file>'
+            )
+        # block offset -> list of (ordinal, position in record_ids)
+        blocks = defaultdict(list)
+        for i, record_id in enumerate(record_ids):
+            for offset, ordinal in index.find(entity_type, record_id):
+                blocks[offset].append((ordinal, i))
+
+        schema = parse_schema(header.schema)
+        found = []
+        for offset in sorted(blocks):
+            pfb_file.seek(offset)
+            block = next(iter_blocks(pfb_file, header))
+            records = block.records(header.codec, schema)
+            found.extend(
+                (i, ordinal, records[ordinal])
+                for ordinal, i in blocks[offset]
+            )
+    return [entity for _, _, entity in sorted(found, key=lambda f: f[:2])]
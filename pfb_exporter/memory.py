@@ -0,0 +1,309 @@
+"""
+Memory budget shared by the buffers of the export pipeline
+
+An export holds several buffers at once: the external sort buffer, the
+per-table prefetch queues, decompressed payload chunks, range scan batches,
+columnar record batches and the Avro block being encoded. Each of them is
+bounded on its own, but nothing bounds their sum.
+
+With a memory governor, every buffer registers as a consumer and reports
+the bytes it holds. When the total reaches the budget:
+
+- Spillable consumers (the sort buffer, columnar batches, the Avro block)
+  are asked to spill: the largest one, or one large enough to bring the
+  total back under budget, writes its buffer to disk the next time it grows.
+  A consumer which holds less than min_spill_share of the budget is never
+  asked to spill, since spilling it would free next to nothing and write
+  one tiny block or run file per record
+- Queues block their producers until the consumers of the queue have
+  drained it (backpressure). A queue which is empty may always take one
+  item, so a producer that is being waited on is never blocked
+
+Tracking-only consumers (e.g. the records collected for a subgraph) can
+neither spill nor wait. Their memory counts towards the peak and is logged,
+but it does not make other consumers spill or wait, since neither would
+free any of it.
+
+Sizes are estimates of the Python objects held (see record_size), not
+measured process memory, so the budget should leave room for the
+interpreter, the PFB schema and other fixed state.
+
+Memory use per consumer is logged every log_interval seconds and the peak
+use per consumer is logged at the end of the export.
+"""
+import re
+import sys
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from pfb_exporter.config import (
+    DEFAULT_MEMORY_LOG_INTERVAL,
+    DEFAULT_MIN_SPILL_SHARE
+)
+
+SIZE_UNITS = {
+    '': 1,
+    'K': 1024,
+    'M': 1024 ** 2,
+    'G': 1024 ** 3,
+    'T': 1024 ** 4,
+}
+
+
+def parse_size(value):
+    """
+    Parse a size in bytes with an optional unit
+
+    8G, 8GB, 8GiB, 512m, 1.5G, 1048576
+
+    :param value: size
+    :type value: str
+    :raises ValueError: if the size is not valid
+    :returns: number of bytes as an int
+    """
+    match = re.fullmatch(
+        r'\s*(\d+(?:\.\d+)?)\s*([kmgt]?)(?:i?b)?\s*', str(value), re.I
+    )
+    if not match:
+        raise ValueError(
+            f'Invalid size {value}. Expected a number of bytes with an '
+            f'optional unit: {", ".join(u for u in SIZE_UNITS if u)}'
+        )
+    number, unit = match.groups()
+    return int(float(number) * SIZE_UNITS[unit.upper()])
+
+
+def format_size(nbytes):
+    """
+    Format a number of bytes for logs, e.g. 1.5 GiB
+    """
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if abs(nbytes) < 1024:
+            return f'{nbytes:.1f} {unit}' if unit != 'B' else f'{nbytes} B'
+        nbytes /= 1024
+    return f'{nbytes:.1f} TiB'
+
+
+def record_size(record):
+    """
+    Estimate the memory held by a payload record or row: the container and
+    its values. Values shared between records (e.g. interned strings) are
+    counted for every record, so this overestimates compact rows
+    """
+    values = record.values() if isinstance(record, dict) else record
+    return sys.getsizeof(record) + sum(map(sys.getsizeof, values))
+
+
+class MemoryConsumer(object):
+    """
+    A buffer registered with the memory governor
+    """
+
+    def __init__(self, governor, name, spillable=False, tracking=False):
+        self.governor = governor
+        self.name = name
+        self.spillable = spillable
+        self.tracking = tracking
+        self.used = 0
+        self.peak = 0
+        self.spills = 0
+        self.waits = 0
+
+    def add(self, nbytes):
+        """
+        Account for nbytes more held by the consumer, without blocking
+
+        :returns: whether the consumer should spill its buffer now. Only
+        spillable consumers are asked to spill
+        """
+        return self.governor._add(self, nbytes)
+
+    def reserve(self, nbytes, stop=None):
+        """
+        Account for nbytes more held by the consumer, blocking while the
+        budget is used up and the consumer holds anything
+
+        :param nbytes: number of bytes
+        :type nbytes: int
+        :param stop: event which stops the wait, e.g. when the reader of a
+        queue has stopped
+        :type stop: threading.Event
+        :returns: False if stop was set while waiting, else True
+        """
+        return self.governor._reserve(self, nbytes, stop)
+
+    def release(self, nbytes=None):
+        """
+        Account for nbytes (or everything) no longer held by the consumer
+        """
+        self.governor._release(self, self.used if nbytes is None else nbytes)
+
+    def spilled(self):
+        """
+        Release everything after the consumer's buffer was spilled to disk
+        """
+        self.spills += 1
+        self.release()
+
+    def close(self):
+        self.release()
+
+
+class MemoryGovernor(object):
+
+    def __init__(
+        self, max_memory, log_interval=DEFAULT_MEMORY_LOG_INTERVAL,
+        min_spill_share=DEFAULT_MIN_SPILL_SHARE
+    ):
+        """
+        Constructor
+
+        :param max_memory: budget in bytes for all registered buffers
+        :type max_memory: int
+        :param log_interval: seconds between logs of the memory used per
+        consumer
+        :type log_interval: float
+        :param min_spill_share: share of the budget a spillable consumer
+        must hold before it is asked to spill
+        :type min_spill_share: float
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.max_memory = max_memory
+        self.log_interval = log_interval
+        self.min_spill = max_memory * min_spill_share
+        self.consumers = []
+        self._spillable = []
+        self.used = 0
+        # Bytes held by tracking-only consumers
+        self.tracked = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+        self._waiting = 0
+        self._last_log = time.monotonic()
+
+    def consumer(self, name, spillable=False, tracking=False):
+        """
+        Register a buffer
+
+        :param name: name of the buffer in the logs. Consumers with the
+        same name are logged together
+        :type name: str
+        :param spillable: whether the buffer can be spilled to disk when the
+        budget is used up
+        :type spillable: bool
+        :param tracking: whether the buffer can neither spill nor wait, so
+        it is only tracked and does not make other consumers spill or wait
+        :type tracking: bool
+        :returns: MemoryConsumer
+        """
+        consumer = MemoryConsumer(
+            self, name, spillable=spillable, tracking=tracking
+        )
+        with self._cond:
+            self.consumers.append(consumer)
+            if spillable:
+                self._spillable.append(consumer)
+        return consumer
+
+    @property
+    def over_budget(self):
+        return self._overrun > 0
+
+    @property
+    def _overrun(self):
+        """
+        Bytes over budget, not counting tracking-only consumers
+        """
+        return self.used - self.tracked - self.max_memory
+
+    def _account(self, consumer, nbytes):
+        consumer.used += nbytes
+        consumer.peak = max(consumer.peak, consumer.used)
+        self.used += nbytes
+        self.peak = max(self.peak, self.used)
+        if consumer.tracking:
+            self.tracked += nbytes
+
+    def _add(self, consumer, nbytes):
+        with self._cond:
+            self._account(consumer, nbytes)
+            overrun = self._overrun
+            spill = (
+                consumer.spillable and overrun > 0 and
+                consumer.used >= self.min_spill and (
+                    consumer.used >= overrun or
+                    consumer is self._largest_spillable()
+                )
+            )
+        self._maybe_log()
+        return spill
+
+    def _largest_spillable(self):
+        return max(self._spillable, key=lambda c: c.used, default=None)
+
+    def _reserve(self, consumer, nbytes, stop):
+        with self._cond:
+            waited = False
+            while consumer.used and self._overrun + nbytes > 0:
+                if stop is not None and stop.is_set():
+                    return False
+                if not waited:
+                    waited = True
+                    consumer.waits += 1
+                self._waiting += 1
+                self._cond.wait(timeout=0.1)
+                self._waiting -= 1
+            self._account(consumer, nbytes)
+        self._maybe_log()
+        return True
+
+    def _release(self, consumer, nbytes):
+        with self._cond:
+            self._account(consumer, -nbytes)
+            if self._waiting:
+                self._cond.notify_all()
+
+    def _usage(self, attr):
+        """
+        Sum (or max for peaks) an attribute of the consumers by name
+        """
+        usage = OrderedDict()
+        for c in list(self.consumers):
+            value = getattr(c, attr)
+            if attr == 'peak':
+                usage[c.name] = max(usage.get(c.name, 0), value)
+            else:
+                usage[c.name] = usage.get(c.name, 0) + value
+        return usage
+
+    def _maybe_log(self):
+        now = time.monotonic()
+        if now - self._last_log < self.log_interval:
+            return
+        self._last_log = now
+        used = ', '.join(
+            f'{name} {format_size(n)}'
+            for name, n in self._usage('used').items() if n
+        )
+        self.logger.info(
+            f'Memory {format_size(self.used)} of '
+            f'{format_size(self.max_memory)}: {used or "-"}'
+        )
+
+    def log_summary(self):
+        """
+        Log the peak memory use, spills and waits per consumer
+        """
+        spills = self._usage('spills')
+        waits = self._usage('waits')
+        lines = [
+            f'  {name}: peak {format_size(peak)}, {spills[name]} spills, '
+            f'{waits[name]} waits'
+            for name, peak in self._usage('peak').items()
+        ]
+        self.logger.info(
+            f'Peak memory {format_size(self.peak)} of '
+            f'{format_size(self.max_memory)}:\n' + '\n'.join(lines)
+        )
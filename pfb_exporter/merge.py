@@ -0,0 +1,220 @@
+"""
+Merge PFB files at the Avro block level
+
+Per-study PFB files are combined for release without decoding the records
+in them. The input schemas must be identical or compatible (see
+pfb_exporter.compat), in which case the merged file gets the union of the
+schemas.
+
+The merged file gets a new sync marker. Data blocks are copied from the
+inputs with only their sync marker replaced, as long as their records have
+the same encoding under the merged schema and the input has the same codec.
+Blocks from an input with another codec are decompressed and recompressed,
+still without decoding records. Only blocks from inputs whose records encode
+differently under the merged schema are decoded and re-encoded.
+
+Each input's Metadata Entity is decoded and the merged file gets a single
+Metadata Entity with the union of their nodes, links and properties.
+"""
+import os
+import logging
+
+from fastavro import parse_schema
+
+from pfb_exporter.compat import (
+    binary_compatible,
+    fingerprint,
+    merge_pfb_schemas,
+    pfb_schema_from_avro
+)
+from pfb_exporter.container import (
+    Block,
+    Header,
+    compress,
+    decompress,
+    iter_blocks,
+    read_container
+)
+from pfb_exporter.stats import STATS_KEY, dump_stats, load_stats, merge_stats
+from pfb_exporter.writer import make_avro_schema
+
+
+def merge_metadata(metadatas):
+    """
+    Merge the objects of the Metadata Entities of several PFB files. Nodes
+    with the same name are merged into one with the union of their links
+    and properties, and the statistics of the files are added up
+
+    :param metadatas: list of Metadata objects
+    :type metadatas: list
+    :returns: Metadata object
+    """
+    nodes = {}
+    misc = {}
+    for metadata in metadatas:
+        for node in metadata['nodes']:
+            merged = nodes.get(node['name'])
+            if merged is None:
+                nodes[node['name']] = {
+                    'name': node['name'],
+                    'ontology_reference': node['ontology_reference'],
+                    'values': dict(node['values']),
+                    'links': list(node['links']),
+                    'properties': list(node['properties'])
+                }
+                continue
+            merged['values'].update(node['values'])
+            merged['links'].extend(
+                link for link in node['links']
+                if link not in merged['links']
+            )
+            names = {p['name'] for p in merged['properties']}
+            merged['properties'].extend(
+                p for p in node['properties'] if p['name'] not in names
+            )
+        for key, value in metadata['misc'].items():
+            misc.setdefault(key, value)
+    stats = [load_stats(m['misc'].get(STATS_KEY)) for m in metadatas]
+    if any(stats):
+        misc[STATS_KEY] = dump_stats(merge_stats(stats))
+    return {'nodes': list(nodes.values()), 'misc': misc}
+
+
+class PfbMerger(object):
+
+    def __init__(self, filepaths, output_filepath):
+        """
+        Constructor
+
+        :param filepaths: paths to the PFB files to merge
+        :type filepaths: list
+        :param output_filepath: path to the merged PFB file
+        :type output_filepath: str
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.filepaths = [os.path.abspath(fp) for fp in filepaths]
+        self.output_filepath = os.path.abspath(output_filepath)
+        if self.output_filepath in self.filepaths:
+            raise ValueError(
+                f'Output file {self.output_filepath} is one of the inputs'
+            )
+        # Number of blocks copied, recompressed and re-encoded
+        self.stats = {'copied': 0, 'recompressed': 0, 'reencoded': 0}
+
+    def merge(self):
+        """
+        Merge the PFB files
+
+        :raises pfb_exporter.compat.IncompatibleSchemaError: if the schemas
+        of the files are not compatible
+        :returns: number of data records in the merged file
+        """
+        inputs = [read_container(fp) for fp in self.filepaths]
+        headers = [header for header, _ in inputs]
+
+        if len({fingerprint(h.schema) for h in headers}) == 1:
+            avro_schema = headers[0].schema
+            self.logger.info(
+                f'Merging {len(headers)} PFB files with identical schemas'
+            )
+        else:
+            avro_schema = make_avro_schema(merge_pfb_schemas(
+                [pfb_schema_from_avro(h.schema) for h in headers]
+            ))
+            self.logger.info(
+                f'Merging {len(headers)} PFB files into the union of their '
+                'schemas'
+            )
+        parsed = parse_schema(avro_schema)
+        out_header = Header(avro_schema, codec=headers[0].codec)
+
+        metadatas = [
+            self._read_metadata(fp, header, schema)
+            for fp, (header, schema) in zip(self.filepaths, inputs)
+        ]
+        metadata_block = Block.from_records(
+            [{
+                'id': None,
+                'name': 'Metadata',
+                'object': ('Metadata', merge_metadata(metadatas)),
+                'relations': []
+            }],
+            out_header.codec,
+            parsed
+        )
+
+        count = 0
+        tmp_filepath = f'{self.output_filepath}.tmp'
+        with open(tmp_filepath, 'wb') as dst:
+            dst.write(out_header.encode())
+            dst.write(metadata_block.encode(out_header.sync))
+            for fp, (header, schema) in zip(self.filepaths, inputs):
+                self.logger.info(f'✏️ Copying blocks from {fp}')
+                count += self._copy(
+                    fp, header, schema, out_header, parsed, dst
+                )
+        os.replace(tmp_filepath, self.output_filepath)
+
+        self.logger.info(
+            f'✅ Merged {count} records into {self.output_filepath}. '
+            f'Blocks copied: {self.stats["copied"]}, recompressed: '
+            f'{self.stats["recompressed"]}, re-encoded: '
+            f'{self.stats["reencoded"]}'
+        )
+        return count
+
+    @staticmethod
+    def _read_metadata(filepath, header, schema):
+        with open(filepath, 'rb') as src:
+            src.seek(header.size)
+            for block in iter_blocks(src, header):
+                records = block.records(header.codec, schema)
+                if records and records[0]['name'] == 'Metadata':
+                    return records[0]['object']
+                break
+        return {'nodes': [], 'misc': {}}
+
+    def _copy(self, filepath, header, schema, out_header, parsed, dst):
+        """
+        Copy the data blocks of one input to the merged file
+        """
+        raw = binary_compatible(header.schema, out_header.schema)
+        same_codec = header.codec == out_header.codec
+        count = 0
+        with open(filepath, 'rb') as src:
+            src.seek(header.size)
+            for i, block in enumerate(iter_blocks(src, header)):
+                if i == 0:
+                    # The first block starts with the Metadata Entity, which
+                    # is replaced by the merged one
+                    records = block.records(
+                        header.codec, schema, parsed, return_record_name=True
+                    )
+                    if records and records[0]['name'] == 'Metadata':
+                        records = records[1:]
+                    if not records:
+                        continue
+                    block = Block.from_records(
+                        records, out_header.codec, parsed
+                    )
+                    self.stats['reencoded'] += 1
+                elif not raw:
+                    block = Block.from_records(
+                        block.records(
+                            header.codec, schema, parsed,
+                            return_record_name=True
+                        ),
+                        out_header.codec,
+                        parsed
+                    )
+                    self.stats['reencoded'] += 1
+                elif not same_codec:
+                    block.data = compress(
+                        out_header.codec, decompress(header.codec, block.data)
+                    )
+                    self.stats['recompressed'] += 1
+                else:
+                    self.stats['copied'] += 1
+                dst.write(block.encode(out_header.sync))
+                count += block.count
+        return count
@@ -0,0 +1,130 @@
+"""
+Read the JSON payloads which conform to the SQLAlchemy models
+
+A payload file may contain a single JSON object, a JSON array of objects or
+one JSON object per line (.jsonl/.ndjson). Every record must have a `type`
+field with the name of the table it belongs to. If it doesn't, the name of the
+payload file (minus the extension) is used.
+
+Payload files may be gzip or zstd compressed (e.g. participant.json.gz). They
+are decompressed on background threads while the records of the previous
+files are parsed. See pfb_exporter.compression
+"""
+import os
+import json
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from pfb_exporter.config import DEFAULT_DECOMPRESS_WORKERS, PAYLOAD_FILE_EXTS
+from pfb_exporter.compression import open_payload_file, strip_compression_ext
+
+logger = logging.getLogger(__name__)
+
+
+def payload_type_from_filename(filepath):
+    """
+    Get the default entity type for the records in a payload file
+
+    participant.json -> participant
+    """
+    return os.path.basename(filepath).split('.')[0]
+
+
+def _payload_ext(filepath):
+    return os.path.splitext(strip_compression_ext(filepath))[-1]
+
+
+def _is_payload_file(filepath):
+    return _payload_ext(filepath) in PAYLOAD_FILE_EXTS
+
+
+def list_payload_files(data_dir):
+    """
+    List the payload files in data_dir, sorted by file path
+
+    :param data_dir: path to a payload file or a dir containing payload files
+    :type data_dir: str
+    :returns: list of file paths
+    """
+    if os.path.isfile(data_dir):
+        return [data_dir]
+
+    return sorted(
+        os.path.join(root, fn)
+        for root, dirs, files in os.walk(data_dir)
+        for fn in files
+        if _is_payload_file(fn)
+    )
+
+
+def read_payload_file(filepath, json_file=None):
+    """
+    Generator which yields the records in a payload file one at a time
+
+    JSON lines files are streamed. JSON documents must be parsed as a whole,
+    so only one of them is held in memory at a time.
+
+    :param filepath: path to payload file
+    :type filepath: str
+    :param json_file: the payload file already opened with
+    open_payload_file. It is closed when the generator is done
+    :type json_file: file object
+    """
+    default_type = payload_type_from_filename(filepath)
+    if json_file is None:
+        json_file = open_payload_file(filepath)
+
+    with json_file:
+        if _payload_ext(filepath) in ('.jsonl', '.ndjson'):
+            records = (json.loads(line) for line in json_file if line.strip())
+        else:
+            records = json.load(json_file)
+            if isinstance(records, dict):
+                records = [records]
+
+        for record in records:
+            record.setdefault('type', default_type)
+            yield record
+
+
+def iter_payloads(
+    data_dir, workers=DEFAULT_DECOMPRESS_WORKERS, memory=None
+):
+    """
+    Generator which yields all records from all payload files in data_dir
+
+    Up to `workers` files are opened at a time: the file being parsed and
+    the next ones, so that compressed files are already being decompressed
+    when the parser gets to them
+
+    :param data_dir: path to a payload file or a dir containing payload files
+    :type data_dir: str
+    :param workers: number of compressed files decompressed at once
+    :type workers: int
+    :param memory: memory governor the decompressed chunks are registered
+    with
+    :type memory: pfb_exporter.memory.MemoryGovernor
+    """
+    filepaths = deque(list_payload_files(data_dir))
+    logger.info(f'Reading records from {len(filepaths)} payload files')
+
+    opened = deque()
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix='decompress'
+    ) as pool:
+        try:
+            while filepaths or opened:
+                while filepaths and len(opened) < workers:
+                    fp = filepaths.popleft()
+                    opened.append(
+                        (fp, open_payload_file(fp, pool, memory=memory))
+                    )
+                fp, json_file = opened.popleft()
+                logger.debug(f'Reading payload file {fp}')
+                yield from read_payload_file(fp, json_file)
+        finally:
+            # Stop decompressing the files that were opened ahead
+            for _, json_file in opened:
+                json_file.close()
+
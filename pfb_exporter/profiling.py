@@ -0,0 +1,244 @@
+"""
+Profile the phases of an export
+
+Each phase (model generation, model import, schema creation, reading
+records, encoding records and writing files) runs under cProfile and
+tracemalloc. For each phase the profiler writes to the profile dir:
+
+    <phase>.pstats            cProfile stats, load with pstats or snakeviz
+    <phase>.collapsed         collapsed stacks for flamegraph.pl, speedscope
+                              or inferno
+    <phase>-allocations.txt   top allocation sites during the phase
+    summary.json              wall time and peak traced memory per phase
+
+cProfile only profiles the thread it is enabled in. Functions that run on
+worker threads or processes are profiled by wrapping them with
+Profiler.worker. Each worker call writes its own stats to
+profile/workers/, and these are merged into <phase>-workers.pstats and
+<phase>-workers.collapsed when the phase ends.
+"""
+import os
+import glob
+import json
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+from pfb_exporter.config import PROFILE_DIR, PROFILE_TOP_ALLOCATIONS
+
+# Max depth of the stacks written to collapsed stack files
+MAX_STACK_DEPTH = 64
+
+
+def _frame_name(func):
+    filename, lineno, name = func
+    return f'{os.path.basename(filename)}:{lineno}:{name}'.replace(';', ':')
+
+
+def write_collapsed_stacks(stats, filepath):
+    """
+    Write cProfile stats as collapsed stacks ("a;b;c <microseconds>")
+
+    cProfile only records caller -> callee edges, not full stacks. Stacks are
+    rebuilt by walking the call graph down from the root functions, and each
+    function's own time is split across the paths that reach it in
+    proportion to the cumulative time of each call edge.
+
+    :param stats: cProfile stats
+    :type stats: pstats.Stats
+    :param filepath: path to the collapsed stack file
+    :type filepath: str
+    """
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+
+    roots = [
+        func for func, (cc, nc, tt, ct, callers) in stats.stats.items()
+        if not callers
+    ]
+
+    lines = []
+
+    def _walk(func, path, weight):
+        cc, nc, tt, ct, callers = stats.stats[func]
+        path = path + [_frame_name(func)]
+        value = int(tt * weight * 1e6)
+        if value:
+            lines.append(f'{";".join(path)} {value}')
+        if len(path) >= MAX_STACK_DEPTH:
+            return
+        for callee, edge_ct in callees.get(func, []):
+            callee_ct = stats.stats[callee][3]
+            # Paths below a microsecond would not add to any stack, and
+            # skipping them keeps the walk from exploding on large graphs
+            if (
+                edge_ct * weight < 1e-6 or callee_ct <= 0 or
+                _frame_name(callee) in path
+            ):
+                continue
+            _walk(callee, path, weight * min(1.0, edge_ct / callee_ct))
+
+    for root in roots:
+        _walk(root, [], 1.0)
+
+    with open(filepath, 'w') as collapsed_file:
+        collapsed_file.write('\n'.join(lines) + '\n')
+
+
+def write_allocations(snapshot, start_snapshot, filepath):
+    """
+    Write the top allocation sites that grew during a phase
+    """
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ])
+    diffs = snapshot.compare_to(start_snapshot, 'lineno')
+    with open(filepath, 'w') as alloc_file:
+        for diff in diffs[:PROFILE_TOP_ALLOCATIONS]:
+            alloc_file.write(f'{diff}\n')
+
+
+class _Worker(object):
+    """
+    Picklable wrapper which profiles a function on a worker thread or
+    process. Generator functions are profiled until they are exhausted.
+    Stats are attributed to the phase that is running when the function is
+    called (or pickled, for worker processes)
+    """
+
+    def __init__(self, func, profiler):
+        self.func = func
+        self.profiler = profiler
+
+    def _dump(self, prof, phase):
+        worker_dir = self.profiler.worker_dir
+        os.makedirs(worker_dir, exist_ok=True)
+        prof.dump_stats(os.path.join(
+            worker_dir,
+            f'{phase}-{os.getpid()}-{threading.get_ident()}-'
+            f'{time.monotonic_ns()}.pstats'
+        ))
+
+    def _enable(self):
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            # Another profiler is already active. On Python >= 3.12 the
+            # phase profiler sees all threads
+            return None
+        return prof
+
+    def __call__(self, *args, **kwargs):
+        phase = self.profiler.current_phase or 'worker'
+        prof = self._enable()
+        try:
+            result = self.func(*args, **kwargs)
+        finally:
+            if prof:
+                prof.disable()
+
+        if not hasattr(result, '__next__'):
+            if prof:
+                self._dump(prof, phase)
+            return result
+        return self._profile_generator(result, prof, phase)
+
+    def _profile_generator(self, gen, prof, phase):
+        if prof:
+            prof.enable()
+        try:
+            yield from gen
+        finally:
+            if prof:
+                prof.disable()
+                self._dump(prof, phase)
+
+
+class Profiler(object):
+
+    def __init__(self, output_dir):
+        """
+        Constructor
+
+        :param output_dir: dir where the profile dir is created
+        :type output_dir: str
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.profile_dir = os.path.join(output_dir, PROFILE_DIR)
+        self.worker_dir = os.path.join(self.profile_dir, 'workers')
+        self.summary = {}
+        self.current_phase = None
+        os.makedirs(self.profile_dir, exist_ok=True)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Context manager which profiles a phase of the export
+        """
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        start_snapshot = tracemalloc.take_snapshot()
+
+        self.current_phase = name
+        prof = cProfile.Profile()
+        start = time.perf_counter()
+        prof.enable()
+        try:
+            yield self
+        finally:
+            prof.disable()
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            snapshot = tracemalloc.take_snapshot()
+            if started_tracing:
+                tracemalloc.stop()
+            self.current_phase = None
+            self._write(name, prof, snapshot, start_snapshot)
+            self.summary[name] = {
+                'seconds': round(elapsed, 6),
+                'peak_traced_bytes': peak
+            }
+            self._write_summary()
+            self.logger.info(
+                f'⏱ Phase {name} took {elapsed:.3f}s, peak traced memory '
+                f'{peak / 1024 ** 2:.1f} MiB'
+            )
+
+    def worker(self, func):
+        """
+        Wrap a function which runs on worker threads or processes so each
+        call is profiled as part of the current phase
+        """
+        return _Worker(func, self)
+
+    def _write(self, name, prof, snapshot, start_snapshot):
+        base = os.path.join(self.profile_dir, name)
+        prof.dump_stats(f'{base}.pstats')
+        write_collapsed_stacks(pstats.Stats(prof), f'{base}.collapsed')
+        write_allocations(
+            snapshot, start_snapshot, f'{base}-allocations.txt'
+        )
+
+        worker_files = glob.glob(
+            os.path.join(self.worker_dir, f'{name}-*.pstats')
+        )
+        if worker_files:
+            stats = pstats.Stats(*worker_files)
+            stats.dump_stats(f'{base}-workers.pstats')
+            write_collapsed_stacks(stats, f'{base}-workers.collapsed')
+
+    def _write_summary(self):
+        with open(
+            os.path.join(self.profile_dir, 'summary.json'), 'w'
+        ) as summary_file:
+            json.dump(self.summary, summary_file, indent=4)
@@ -0,0 +1,159 @@
+"""
+Compact row representation of records inside the export pipeline
+
+Payload records are parsed as dicts, and every dict carries its own copy of
+every key string plus a hash table sized for its keys. For records in flight
+between parsing and encoding (sort buffers, prefetch queues, scan batches)
+that overhead is most of the memory per record.
+
+Inside the pipeline a record is held as a row: a tuple of its values in the
+fixed field order of its table. Each table gets a generated tuple subclass
+with no per-instance storage besides the tuple itself, which knows its
+table and field names. Rows support the read-only part of the dict interface
+that the writers use (get and to_dict), so they can be passed anywhere a
+payload record is read.
+
+String values are interned per column, up to a limit of distinct values per
+column, so the values of low-cardinality columns (e.g. gender, data_type)
+are shared by all rows instead of being stored once per row.
+"""
+from pfb_exporter.config import DEFAULT_INTERN_POOL_SIZE, RECORD_ID_FIELDS
+
+
+class Row(tuple):
+    """
+    Base class of the generated row classes
+    """
+    __slots__ = ()
+    _table = None
+    _fields = ()
+    # field name -> position in the row
+    _index = {}
+
+    def get(self, name, default=None):
+        """
+        Get the value of a field, like dict.get. The `type` field is the
+        row's table
+        """
+        i = self._index.get(name)
+        if i is None:
+            return self._table if name == 'type' else default
+        return self[i]
+
+    def to_dict(self):
+        """
+        Convert the row back to a payload record
+        """
+        record = dict(zip(self._fields, self))
+        record['type'] = self._table
+        return record
+
+    def __repr__(self):
+        return f'{type(self).__name__}{tuple.__repr__(self)}'
+
+
+def row_fields(node):
+    """
+    Get the field names of a table's rows: the table's attributes followed by
+    the record id fields it does not have as attributes
+
+    :param node: table schema from the PFB schema
+    :type node: dict
+    :returns: tuple of field names
+    """
+    fields = [attr['name'] for attr in node.get('attributes', [])]
+    fields.extend(f for f in RECORD_ID_FIELDS if f not in fields)
+    return tuple(fields)
+
+
+def make_row_class(table, node):
+    """
+    Generate the row class of a table
+
+    :param table: table name
+    :type table: str
+    :param node: table schema from the PFB schema
+    :type node: dict
+    :returns: subclass of Row
+    """
+    fields = row_fields(node)
+    return type(f'{table}_row', (Row,), {
+        '__slots__': (),
+        '_table': table,
+        '_fields': fields,
+        '_index': {name: i for i, name in enumerate(fields)},
+    })
+
+
+class RowPacker(object):
+
+    def __init__(self, pfb_schema, intern_pool_size=DEFAULT_INTERN_POOL_SIZE):
+        """
+        Constructor
+
+        :param pfb_schema: table name -> attributes and foreign keys
+        :type pfb_schema: dict
+        :param intern_pool_size: max number of distinct string values
+        interned per column. Once a column's pool is full its other values
+        are stored as is
+        :type intern_pool_size: int
+        """
+        self.intern_pool_size = intern_pool_size
+        # table -> row class
+        self.row_classes = {
+            table: make_row_class(table, node)
+            for table, node in pfb_schema.items()
+        }
+        # table -> list of value -> interned value, one per field
+        self._pools = {
+            table: [{} for _ in row_cls._fields]
+            for table, row_cls in self.row_classes.items()
+        }
+
+    def fields(self, table):
+        """
+        Get the field names of a table's rows or None if the table is not in
+        the PFB schema
+        """
+        row_cls = self.row_classes.get(table)
+        return row_cls._fields if row_cls else None
+
+    def pack_values(self, table, values):
+        """
+        Create a row from a sequence of values in the table's field order
+
+        :param table: table name
+        :type table: str
+        :param values: field values
+        :type values: list
+        :returns: row
+        """
+        limit = self.intern_pool_size
+        packed = []
+        for pool, value in zip(self._pools[table], values):
+            if type(value) is str:
+                interned = pool.get(value)
+                if interned is not None:
+                    value = interned
+                elif len(pool) < limit:
+                    pool[value] = value
+            packed.append(value)
+        return self.row_classes[table](packed)
+
+    def pack(self, record, entity_type=None):
+        """
+        Create a row from a payload record. Keys which are not fields of
+        the table are dropped
+
+        :param record: payload record
+        :type record: dict
+        :param entity_type: table the record belongs to. Defaults to the
+        record's `type` field
+        :type entity_type: str
+        :returns: row or None if the table is not in the PFB schema
+        """
+        table = entity_type or record.get('type')
+        fields = self.fields(table)
+        if fields is None:
+            return None
+        return self.pack_values(table, [record.get(f) for f in fields])
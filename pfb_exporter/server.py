@@ -0,0 +1,374 @@
+"""
+Long running export server
+
+Every CLI run re-imports the SQLAlchemy models, rebuilds the PFB schema and,
+with a database URL, regenerates the models before doing any real work. For
+many small exports that cold start costs more than the exports themselves.
+
+The export server loads the transformer state and builds the PFB schema once,
+keeps a pooled SQLAlchemy engine and then runs export jobs submitted over a
+local HTTP API, on a TCP port or a Unix socket. Jobs wait in a bounded queue
+and at most max_jobs of them run at once.
+
+API:
+
+    POST /jobs          Submit a job. JSON body:
+                        {
+                            "data_dir": "/path/to/payloads",    (required)
+                            "output_dir": "/path/to/output",
+                            "detect_enums": false,
+                            "enum_threshold": 50,
+                            "enum_overrides": ["table.column=enum"],
+                            "columnar": "parquet"
+                        }
+                        Responds 202 with the job or 503 if the queue is full
+    GET /jobs           List all jobs
+    GET /jobs/<id>      Get a job
+    GET /health         Server status
+"""
+import os
+import json
+import uuid
+import queue
+import logging
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pfb_exporter.config import (
+    DEFAULT_DB_POOL_SIZE,
+    DEFAULT_ENUM_THRESHOLD,
+    DEFAULT_JOB_QUEUE_SIZE,
+    DEFAULT_LOG_FILENAME,
+    DEFAULT_MAX_JOBS,
+    DEFAULT_MODELS_PATH,
+    DEFAULT_OUTPUT_DIR,
+    DEFAULT_SERVER_HOST,
+    DEFAULT_SERVER_PORT,
+    DEFAULT_TRANFORM_MOD,
+    DEFAULT_WORKERS
+)
+from pfb_exporter.enums import parse_overrides
+from pfb_exporter.export import PfbExporter, create_transformer
+from pfb_exporter.extract import create_pooled_engine
+from pfb_exporter.utils import (
+    add_thread_log_handler,
+    remove_log_handler,
+    timestamp
+)
+
+
+class JobQueueFull(Exception):
+    """
+    Raised when a job is submitted while the job queue is full
+    """
+
+
+class ExportJob(object):
+
+    def __init__(self, params, output_dir):
+        self.id = uuid.uuid4().hex
+        self.params = params
+        self.data_dir = params['data_dir']
+        self.output_dir = params.get('output_dir') or os.path.join(
+            output_dir, self.id
+        )
+        self.status = 'queued'
+        self.error = None
+        self.created_at = timestamp()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'data_dir': self.data_dir,
+            'output_dir': self.output_dir,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class ExportServer(object):
+
+    def __init__(
+        self,
+        models_filepath=DEFAULT_MODELS_PATH,
+        transform_module_filepath=DEFAULT_TRANFORM_MOD,
+        output_dir=DEFAULT_OUTPUT_DIR,
+        db_conn_url=None,
+        max_jobs=DEFAULT_MAX_JOBS,
+        queue_size=DEFAULT_JOB_QUEUE_SIZE,
+        pool_size=DEFAULT_DB_POOL_SIZE,
+        workers=DEFAULT_WORKERS
+    ):
+        """
+        Constructor. Builds the PFB schema and starts the job workers
+
+        :param models_filepath: path to where the SQLAlchemy models are stored
+        or will be written if they are generated
+        :type models_filepath: str
+        :param transform_module_filepath: path to transform module
+        :type transform_module_filepath: str
+        :param output_dir: dir where the PFB schema, server logs and the
+        output of jobs without an output_dir are written
+        :type output_dir: str
+        :param db_conn_url: Connection URL for database
+        :type db_conn_url: str
+        :param max_jobs: max number of jobs that run at once
+        :type max_jobs: int
+        :param queue_size: max number of jobs waiting to run
+        :type queue_size: int
+        :param pool_size: number of pooled database connections
+        :type pool_size: int
+        :param workers: max number of tables processed concurrently per job
+        :type workers: int
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.output_dir = os.path.abspath(os.path.expanduser(output_dir))
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.workers = workers
+        self.jobs = {}
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._httpd = None
+
+        self.transformer = create_transformer(
+            transform_module_filepath,
+            os.path.abspath(os.path.expanduser(models_filepath)),
+            self.output_dir,
+            db_conn_url=db_conn_url
+        )
+        self.pfb_schema = self.transformer.transform()
+        self.engine = (
+            create_pooled_engine(db_conn_url, pool_size)
+            if db_conn_url else None
+        )
+        # One scan slot per pooled connection, shared by all exports so
+        # together they never run more queries than the pool holds
+        self.scan_slots = threading.BoundedSemaphore(pool_size)
+
+        self._workers = [
+            threading.Thread(
+                target=self._work, name=f'job-worker-{i}', daemon=True
+            )
+            for i in range(max_jobs)
+        ]
+        for t in self._workers:
+            t.start()
+
+        self.logger.info(
+            f'Export server ready with {len(self.pfb_schema)} tables, '
+            f'{max_jobs} job workers and a queue of {queue_size} jobs'
+        )
+
+    def submit(self, params):
+        """
+        Queue an export job
+
+        :param params: job parameters, see module docstring
+        :type params: dict
+        :raises ValueError: if the parameters are invalid
+        :raises JobQueueFull: if the job queue is full
+        :returns: the job
+        """
+        if not isinstance(params, dict) or not params.get('data_dir'):
+            raise ValueError('data_dir is required')
+        if not os.path.exists(params['data_dir']):
+            raise ValueError(f'data_dir {params["data_dir"]} does not exist')
+        parse_overrides(params.get('enum_overrides'))
+
+        job = ExportJob(params, self.output_dir)
+        with self._lock:
+            self.jobs[job.id] = job
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                del self.jobs[job.id]
+            raise JobQueueFull(
+                f'Job queue is full ({self._queue.maxsize} jobs)'
+            )
+        self.logger.info(f'Queued job {job.id} for {job.data_dir}')
+        return job
+
+    def get(self, job_id):
+        """
+        Get a job by id or None if it does not exist
+        """
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            try:
+                self._run(job)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job):
+        """
+        Run an export job on the current worker thread using the resident
+        transformer, PFB schema and engine
+        """
+        job.status = 'running'
+        job.started_at = timestamp()
+        handler = add_thread_log_handler(
+            os.path.join(job.output_dir, 'logs', DEFAULT_LOG_FILENAME)
+        )
+        try:
+            params = job.params
+            PfbExporter(
+                job.data_dir,
+                output_dir=job.output_dir,
+                workers=self.workers,
+                detect_enums=params.get('detect_enums', False),
+                enum_threshold=params.get(
+                    'enum_threshold', DEFAULT_ENUM_THRESHOLD
+                ),
+                enum_overrides=parse_overrides(params.get('enum_overrides')),
+                columnar_format=params.get('columnar'),
+                transformer=self.transformer,
+                pfb_schema=self.pfb_schema,
+                engine=self.engine,
+                scan_slots=self.scan_slots,
+                setup_logging=False
+            ).run()
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+        else:
+            job.status = 'succeeded'
+        finally:
+            job.finished_at = timestamp()
+            remove_log_handler(handler)
+            self.logger.info(f'Job {job.id} {job.status}')
+
+    def make_http_server(
+        self, host=DEFAULT_SERVER_HOST, port=DEFAULT_SERVER_PORT,
+        socket_path=None
+    ):
+        """
+        Create the HTTP server for the job API
+
+        :param host: host to listen on
+        :type host: str
+        :param port: port to listen on
+        :type port: int
+        :param socket_path: if provided, listen on this Unix socket instead
+        of host and port
+        :type socket_path: str
+        """
+        handler = type(
+            'BoundExportRequestHandler', (ExportRequestHandler,),
+            {'export_server': self}
+        )
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self._httpd = UnixHTTPServer(socket_path, handler)
+        else:
+            self._httpd = ThreadingHTTPServer((host, port), handler)
+        return self._httpd
+
+    def serve_forever(self, **kwargs):
+        """
+        Serve the job API until interrupted. Keyword args are forwarded to
+        make_http_server
+        """
+        httpd = self.make_http_server(**kwargs)
+        self.logger.info(
+            f'Export server listening on {httpd.server_address}'
+        )
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        """
+        Stop the HTTP server and the job workers once the running jobs
+        are done
+        """
+        if self._httpd:
+            self._httpd.server_close()
+        for _ in self._workers:
+            self._queue.put(None)
+        for t in self._workers:
+            t.join()
+        if self.engine:
+            self.engine.dispose()
+
+
+class UnixHTTPServer(
+    socketserver.ThreadingMixIn, socketserver.UnixStreamServer
+):
+    daemon_threads = True
+
+
+class ExportRequestHandler(BaseHTTPRequestHandler):
+    """
+    Request handler for the job API. Subclassed with an export_server
+    attribute by ExportServer.make_http_server
+    """
+    export_server = None
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logging.getLogger(type(self).__name__).debug(format % args)
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        server = self.export_server
+        path = self.path.rstrip('/')
+        if path == '/health':
+            self._send_json(200, {
+                'status': 'ok',
+                'tables': len(server.pfb_schema),
+                'queued': server._queue.qsize(),
+            })
+        elif path == '/jobs':
+            with server._lock:
+                jobs = [job.to_dict() for job in server.jobs.values()]
+            self._send_json(200, jobs)
+        elif path.startswith('/jobs/'):
+            job = server.get(path.split('/')[-1])
+            if job:
+                self._send_json(200, job.to_dict())
+            else:
+                self._send_json(404, {'error': 'Job not found'})
+        else:
+            self._send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            self._send_json(404, {'error': 'Not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            params = json.loads(self.rfile.read(length) or b'{}')
+            job = self.export_server.submit(params)
+        except JobQueueFull as e:
+            self._send_json(503, {'error': str(e)})
+        except ValueError as e:
+            self._send_json(400, {'error': str(e)})
+        else:
+            self._send_json(202, job.to_dict())
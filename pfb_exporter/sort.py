@@ -0,0 +1,250 @@
+"""
+External merge sort of payload records
+
+Payload records may arrive in any order, spread across any number of files.
+A PFB file should have parent entities written before their children, so
+records are partitioned by entity type and sorted by a key within each entity
+type. Records are buffered in memory as serialized JSON until the buffer
+reaches its size limit, at which point each partition is sorted and spilled
+to disk as a sorted run. When all records have been added, the runs for each
+entity type are merged lazily in dependency level order (see
+pfb_exporter.graph). Entity types within a level are merged concurrently.
+
+At most the in-memory buffer plus one record per open run are held in memory.
+
+With a RowPacker (see pfb_exporter.rows), records of tables in the PFB schema
+are serialized as JSON arrays in their table's field order instead of JSON
+objects, so neither the buffer nor the runs repeat the keys of every record,
+and they are yielded as compact rows instead of dicts.
+
+With a memory governor (see pfb_exporter.memory), the buffer is also spilled
+when the governor asks for it, and once all records have been added.
+"""
+import os
+import sys
+import json
+import heapq
+import shutil
+import logging
+import tempfile
+from collections import defaultdict
+
+from pfb_exporter.config import DEFAULT_SORT_BUFFER_SIZE, DEFAULT_WORKERS
+from pfb_exporter.graph import iter_by_level
+from pfb_exporter.utils import get_record_id
+
+# Separates the serialized sort key from the serialized record in a run.
+# json.dumps escapes tabs inside strings so the first tab is always the
+# separator
+RUN_SEP = '\t'
+
+
+class ExternalSorter(object):
+
+    def __init__(
+        self,
+        sort_key=get_record_id,
+        max_buffer_size=DEFAULT_SORT_BUFFER_SIZE,
+        tmp_dir=None,
+        packer=None,
+        memory=None
+    ):
+        """
+        Constructor
+
+        :param sort_key: function which takes a record and returns the value
+        used to order records within an entity type
+        :type sort_key: function
+        :param max_buffer_size: max number of bytes of serialized records to
+        hold in memory before spilling sorted runs to disk
+        :type max_buffer_size: int
+        :param tmp_dir: dir where the temporary run dir is created. Defaults
+        to the system temp dir
+        :type tmp_dir: str
+        :param packer: if provided, records are stored and yielded as rows
+        :type packer: pfb_exporter.rows.RowPacker
+        :param memory: if provided, the buffer is registered with this
+        memory governor
+        :type memory: pfb_exporter.memory.MemoryGovernor
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.sort_key = sort_key
+        self.max_buffer_size = max_buffer_size
+        self.packer = packer
+        self.run_dir = tempfile.mkdtemp(prefix='pfb-sort-', dir=tmp_dir)
+        self._memory = (
+            memory.consumer('sort buffer', spillable=True) if memory else None
+        )
+
+        # entity type -> list of (key, serialized record)
+        self._buffers = defaultdict(list)
+        self._buffer_size = 0
+        # entity type -> list of sorted run file paths
+        self._runs = defaultdict(list)
+        self.record_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def entity_types(self):
+        """
+        All entity types that have been added to the sorter
+        """
+        return set(self._buffers.keys()) | set(self._runs.keys())
+
+    def add(self, record, entity_type=None):
+        """
+        Add a record to the sorter
+
+        :param record: payload record
+        :type record: dict
+        :param entity_type: partition to add the record to. Defaults to
+        the record's `type` field
+        :type entity_type: str
+        """
+        entity_type = entity_type or record['type']
+        key = self.sort_key(record)
+        fields = self._fields(entity_type)
+        if fields is not None:
+            record = [record.get(f) for f in fields]
+        line = json.dumps(record, separators=(',', ':'))
+
+        self._buffers[entity_type].append(
+            ('' if key is None else str(key), line)
+        )
+        self._buffer_size += len(line)
+        self.record_count += 1
+
+        spill = self._buffer_size >= self.max_buffer_size
+        if self._memory and self._memory.add(sys.getsizeof(line)):
+            spill = True
+        if spill:
+            self.spill()
+
+    def add_all(self, records):
+        """
+        Add all records from an iterable of records
+
+        With a memory governor, the buffer is spilled at the end so it is
+        not held while the records are merged and written
+        """
+        for record in records:
+            self.add(record)
+        if self._memory and self._buffer_size:
+            self.spill()
+
+    def spill(self):
+        """
+        Sort each in-memory partition and write it to disk as a sorted run
+        """
+        for entity_type, buf in self._buffers.items():
+            if not buf:
+                continue
+            buf.sort()
+            filepath = os.path.join(
+                self.run_dir,
+                f'{entity_type}-{len(self._runs[entity_type]):06d}.run'
+            )
+            with open(filepath, 'w') as run_file:
+                for key, line in buf:
+                    run_file.write(f'{json.dumps(key)}{RUN_SEP}{line}\n')
+            self._runs[entity_type].append(filepath)
+
+        self.logger.debug(
+            f'Spilled {self._buffer_size} bytes of records to sorted runs in '
+            f'{self.run_dir}'
+        )
+        self._buffers.clear()
+        self._buffer_size = 0
+        if self._memory:
+            self._memory.spilled()
+
+    def order(self, levels):
+        """
+        Order the entity types in the sorter by dependency level. Entity types
+        which are not in any level are put in a final level.
+
+        :param levels: list of lists of entity types, parents first
+        :type levels: list
+        :returns: list of lists of entity types
+        """
+        present = self.entity_types
+        ordered = [
+            [et for et in level if et in present] for level in levels
+        ]
+        ordered = [level for level in ordered if level]
+        missing = sorted(
+            present - {et for level in ordered for et in level}
+        )
+        if missing:
+            self.logger.warning(
+                f'⚠️ Entity types {missing} are not in the import order. '
+                'They will be written last'
+            )
+            ordered.append(missing)
+        return ordered
+
+    def sorted_records(self, levels=None, max_workers=DEFAULT_WORKERS):
+        """
+        Generator which yields all records, grouped by entity type in
+        dependency level order and sorted by key within each entity type
+
+        :param levels: list of lists of entity types, parents first
+        :type levels: list
+        :param max_workers: max number of entity types in a level merged
+        concurrently
+        :type max_workers: int
+        """
+        yield from iter_by_level(
+            self.order(levels or []),
+            self.sorted_partition,
+            max_workers=max_workers
+        )
+
+    def sorted_partition(self, entity_type):
+        """
+        Generator which merges the sorted runs and in-memory buffer of
+        one entity type and yields its records in key order
+        """
+        fields = self._fields(entity_type)
+        run_files = [open(fp) for fp in self._runs.get(entity_type, [])]
+        try:
+            streams = [self._read_run(f) for f in run_files]
+            streams.append(iter(sorted(self._buffers.get(entity_type, []))))
+            for key, line in heapq.merge(*streams):
+                if fields is None:
+                    yield json.loads(line)
+                else:
+                    yield self.packer.pack_values(
+                        entity_type, json.loads(line)
+                    )
+        finally:
+            for f in run_files:
+                f.close()
+
+    def _fields(self, entity_type):
+        """
+        Get the row fields of an entity type or None if its records are
+        stored as dicts
+        """
+        return self.packer.fields(entity_type) if self.packer else None
+
+    @staticmethod
+    def _read_run(run_file):
+        for row in run_file:
+            key, line = row.rstrip('\n').split(RUN_SEP, 1)
+            yield json.loads(key), line
+
+    def close(self):
+        """
+        Remove all sorted runs from disk
+        """
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+        self._buffers.clear()
+        self._runs.clear()
+        if self._memory:
+            self._memory.close()
@@ -0,0 +1,297 @@
+"""
+Per-entity statistics of a PFB file
+
+The PFB writer collects statistics while it writes, in the same pass:
+
+- Number of records and encoded bytes per table, and in total
+- Number of null values per attribute
+- Min and max of numeric and date-time attributes
+
+The statistics are stored as JSON in the `stats` entry of the Metadata
+Entity's misc map, and written to output_dir/stats.json, so a consumer can
+learn what a PFB file contains by reading only its first record:
+
+    {
+        "count": 3,
+        "bytes": 512,
+        "tables": {
+            "participant": {
+                "count": 2,
+                "bytes": 400,
+                "attributes": {
+                    "is_proband": {"null_count": 0},
+                    "days_to_lost_to_followup": {
+                        "null_count": 1, "min": 20, "max": 20
+                    },
+                    ...
+                }
+            },
+            ...
+        }
+    }
+
+Attributes which are always null have null_count == count.
+
+Date and date-time values are compared as points in time, not as strings:
+values with a UTC offset are converted to UTC, values without one are taken
+to be in UTC, and dates are midnight. Min and max keep the values as they
+were written. Values which can't be parsed are left out of min and max.
+"""
+import re
+import json
+import datetime
+
+from fastavro import parse_schema
+
+from pfb_exporter.container import Header, iter_blocks
+
+# Key of the statistics in the Metadata Entity's misc map
+STATS_KEY = 'stats'
+
+NUMERIC_TYPES = {'int', 'long', 'float', 'double'}
+
+# Lenient ISO 8601 date or date-time, e.g. 2019-5-1 or 2019-05-01 7:00+02:00
+TEMPORAL_RE = re.compile(
+    r'(\d{4})-(\d{1,2})-(\d{1,2})'
+    r'(?:[T ](\d{1,2}):(\d{1,2})(?::(\d{1,2})(?:\.(\d{1,6})\d*)?)?)?'
+    r'\s*(Z|[+-]\d{1,2}(?::?\d{2})?)?$'
+)
+
+
+def is_ranged(attr):
+    """
+    Whether min and max are collected for an attribute
+    """
+    return (
+        attr.get('type') in NUMERIC_TYPES or
+        attr.get('format') in ('date-time', 'date')
+    )
+
+
+def parse_temporal(value):
+    """
+    Parse a date or date-time string to a naive UTC datetime, for comparing
+
+    :param value: date or date-time string
+    :type value: str
+    :returns: datetime.datetime or None if the value can't be parsed
+    """
+    try:
+        dt = datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        match = TEMPORAL_RE.match(value) if isinstance(value, str) else None
+        if not match:
+            return None
+        (year, month, day, hour, minute, second, fraction,
+         offset) = match.groups()
+        tz = None
+        if offset == 'Z':
+            tz = datetime.timezone.utc
+        elif offset:
+            digits = offset[1:].replace(':', '')
+            delta = datetime.timedelta(
+                hours=int(digits[:-2] if len(digits) > 2 else digits),
+                minutes=int(digits[-2:]) if len(digits) > 2 else 0
+            )
+            tz = datetime.timezone(-delta if offset[0] == '-' else delta)
+        try:
+            dt = datetime.datetime(
+                int(year), int(month), int(day), int(hour or 0),
+                int(minute or 0), int(second or 0),
+                int((fraction or '0').ljust(6, '0')), tzinfo=tz
+            )
+        except ValueError:
+            return None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def range_key(value):
+    """
+    Get the key min and max compare a value of a ranged attribute by
+    """
+    if isinstance(value, str):
+        return parse_temporal(value)
+    return value
+
+
+class StatsCollector(object):
+
+    def __init__(self, pfb_schema):
+        """
+        Constructor
+
+        :param pfb_schema: table name -> attributes and foreign keys
+        :type pfb_schema: dict
+        """
+        # table -> list of attribute names
+        self._attributes = {}
+        # table -> set of attribute names min and max are collected for
+        self._ranged = {}
+        # table -> attribute name -> [min key, max key]
+        self._ranges = {}
+        self.tables = {}
+        for table, node in pfb_schema.items():
+            attrs = [a for a in node.get('attributes', []) if a.get('type')]
+            self._attributes[table] = [a['name'] for a in attrs]
+            self._ranged[table] = {a['name'] for a in attrs if is_ranged(a)}
+            self._ranges[table] = {}
+
+    def _table(self, table):
+        stats = self.tables.get(table)
+        if stats is None:
+            stats = self.tables[table] = {
+                'count': 0,
+                'bytes': 0,
+                'attributes': {
+                    name: {'null_count': 0}
+                    for name in self._attributes[table]
+                }
+            }
+        return stats
+
+    def add(self, table, obj, size):
+        """
+        Add a written entity to the statistics
+
+        :param table: table of the entity
+        :type table: str
+        :param obj: the entity's object, with values as they were encoded
+        :type obj: dict
+        :param size: encoded size of the entity in bytes
+        :type size: int
+        """
+        stats = self._table(table)
+        stats['count'] += 1
+        stats['bytes'] += size
+        attr_stats = stats['attributes']
+        ranged = self._ranged[table]
+        ranges = self._ranges[table]
+        for name, value in obj.items():
+            if value is None:
+                attr_stats[name]['null_count'] += 1
+            elif name in ranged:
+                key = range_key(value)
+                if key is None:
+                    continue
+                s = attr_stats[name]
+                r = ranges.get(name)
+                if r is None:
+                    ranges[name] = [key, key]
+                    s['min'] = s['max'] = value
+                elif key < r[0]:
+                    r[0] = key
+                    s['min'] = value
+                elif key > r[1]:
+                    r[1] = key
+                    s['max'] = value
+
+    def to_dict(self):
+        """
+        Get the statistics as a JSON serializable dict
+        """
+        return {
+            'count': sum(t['count'] for t in self.tables.values()),
+            'bytes': sum(t['bytes'] for t in self.tables.values()),
+            'tables': self.tables
+        }
+
+
+def merge_stats(stats_list):
+    """
+    Merge the statistics of several PFB files, e.g. of a file and the
+    records appended to it
+
+    :param stats_list: list of statistics dicts. None values are skipped
+    :type stats_list: list
+    :returns: statistics dict
+    """
+    tables = {}
+    for stats in filter(None, stats_list):
+        for table, table_stats in stats['tables'].items():
+            merged = tables.setdefault(
+                table, {'count': 0, 'bytes': 0, 'attributes': {}}
+            )
+            merged['count'] += table_stats['count']
+            merged['bytes'] += table_stats['bytes']
+            for name, attr_stats in table_stats['attributes'].items():
+                m = merged['attributes'].setdefault(name, {'null_count': 0})
+                m['null_count'] += attr_stats['null_count']
+                if 'min' in attr_stats:
+                    m['min'] = min(m.get('min', attr_stats['min']),
+                                   attr_stats['min'], key=_merge_key)
+                    m['max'] = max(m.get('max', attr_stats['max']),
+                                   attr_stats['max'], key=_merge_key)
+    return {
+        'count': sum(t['count'] for t in tables.values()),
+        'bytes': sum(t['bytes'] for t in tables.values()),
+        'tables': tables
+    }
+
+
+def _merge_key(value):
+    key = range_key(value)
+    return datetime.datetime.min if key is None else key
+
+
+def stats_reserve(pfb_schema):
+    """
+    Get the number of characters reserved for the statistics JSON in the
+    Metadata Entity of a new PFB file: the size of the statistics with the
+    largest counts and min/max values that are expected
+    """
+    big = 10 ** 18
+    tables = {}
+    for table, node in pfb_schema.items():
+        attributes = {}
+        for attr in node.get('attributes', []):
+            if not attr.get('type'):
+                continue
+            attributes[attr['name']] = {'null_count': big}
+            if is_ranged(attr):
+                # e.g. 2019-05-13T17:51:34.457937+00:00 or a float repr
+                attributes[attr['name']].update(
+                    {'min': 'x' * 40, 'max': 'x' * 40}
+                )
+        tables[table] = {'count': big, 'bytes': big, 'attributes': attributes}
+    return len(dump_stats({'count': big, 'bytes': big, 'tables': tables}))
+
+
+def dump_stats(stats):
+    return json.dumps(stats, separators=(',', ':'))
+
+
+def load_stats(value):
+    """
+    Parse the statistics from the Metadata Entity's misc map. Reserved but
+    not yet written statistics are blank
+
+    :returns: statistics dict or None
+    """
+    if not value or not value.strip():
+        return None
+    return json.loads(value)
+
+
+def read_stats(filepath):
+    """
+    Read the statistics of a PFB file from its Metadata Entity, without
+    reading any other records
+
+    :param filepath: path to the PFB file
+    :type filepath: str
+    :returns: statistics dict or None if the file has none
+    """
+    with open(filepath, 'rb') as pfb_file:
+        header = Header.read(pfb_file)
+        for block in iter_blocks(pfb_file, header):
+            records = block.records(
+                header.codec, parse_schema(header.schema)
+            )
+            if records and records[0]['name'] == 'Metadata':
+                return load_stats(
+                    records[0]['object']['misc'].get(STATS_KEY)
+                )
+            break
+    return None
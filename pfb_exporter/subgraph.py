@@ -0,0 +1,356 @@
+"""
+Export the subgraph of records connected to one root record
+
+A full dump reads every row of every table even when only one study or
+project is wanted. A subgraph export starts from a root record, given as
+table:key=value (e.g. study:kf_id=SD_00000001), and follows the foreign keys
+in the PFB schema to collect only the records connected to it:
+
+1. Down: the records whose foreign keys point to a collected record, i.e.
+   the root's children, their children and so on
+2. Up: the records that collected records point to but which are not under
+   the root (e.g. the sequencing center of a sequencing experiment), and
+   their parents, so that every relation in the exported PFB resolves
+
+Parents collected on the way up do not pull in their other children.
+
+Each step looks records up by a column and a set of values. The database
+source runs one indexed `WHERE column IN (...)` query per batch of values,
+so the time an export takes depends on the size of the subgraph, not of the
+database. Payload files cannot be queried, so they are read once to build an
+in-memory index of the columns the traversal follows, and read a second time
+to emit the selected records.
+"""
+import logging
+from collections import defaultdict
+
+from sqlalchemy import select
+
+from pfb_exporter.config import DEFAULT_SUBGRAPH_BATCH_SIZE, RECORD_ID_FIELDS
+from pfb_exporter.extract import json_value
+from pfb_exporter.memory import record_size
+from pfb_exporter.writer import coerce_value
+
+
+def parse_root(root):
+    """
+    Parse a root record given as table:key=value
+
+    :param root: the root record
+    :type root: str
+    :raises ValueError: if root is not in the expected format
+    :returns: tuple of (table, key, value)
+    """
+    table, sep, rest = root.partition(':')
+    key, eq, value = rest.partition('=')
+    if not (sep and eq and table and key and value):
+        raise ValueError(
+            f'Invalid root {root}. Format: <table>:<key>=<value>, e.g. '
+            'study:kf_id=SD_00000001'
+        )
+    return table, key, value
+
+
+def fk_column(fk):
+    """
+    Get the column of the parent table that a foreign key points to.
+    PFB schemas created before the column was recorded point to the first
+    record id field
+    """
+    return fk.get('column') or RECORD_ID_FIELDS[0]
+
+
+class DatabaseSource(object):
+
+    def __init__(
+        self, engine, tables, packer=None,
+        batch_size=DEFAULT_SUBGRAPH_BATCH_SIZE
+    ):
+        """
+        Constructor
+
+        :param engine: SQLAlchemy engine
+        :type engine: sqlalchemy.engine.Engine
+        :param tables: table name -> sqlalchemy.Table
+        :type tables: dict
+        :param packer: if provided, rows are returned as compact rows
+        instead of dicts
+        :type packer: pfb_exporter.rows.RowPacker
+        :param batch_size: max number of values in one IN (...) clause
+        :type batch_size: int
+        """
+        self.engine = engine
+        self.tables = tables
+        self.packer = packer
+        self.batch_size = batch_size
+
+    def has_column(self, table, column):
+        return table in self.tables and column in self.tables[table].c
+
+    def find(self, table, column, values):
+        """
+        Find the rows of a table whose column has one of the values
+
+        :returns: list of (primary key, row) tuples
+        """
+        t = self.tables[table]
+        col = t.c[column]
+        pk = [c.key for c in t.primary_key.columns] or [c.key for c in t.c]
+        values = list(values)
+        found = []
+        with self.engine.connect() as conn:
+            for i in range(0, len(values), self.batch_size):
+                query = select([t]).where(
+                    col.in_(values[i:i + self.batch_size])
+                )
+                for row in conn.execute(query):
+                    record = {k: json_value(v) for k, v in row.items()}
+                    if self.packer:
+                        record = self.packer.pack(record, table) or record
+                    found.append(
+                        (tuple(record.get(k) for k in pk), record)
+                    )
+        return found
+
+
+class PayloadIndex(object):
+
+    def __init__(self, records, columns, memory=None):
+        """
+        Build the index of payload records by the values of their columns
+
+        Records are identified by their position in the payload stream, so
+        the payloads must be read in the same order again to select them
+
+        :param records: iterable of payload records
+        :type records: iterable
+        :param columns: table -> columns to index
+        :type columns: dict
+        :param memory: if provided, the index is registered with this
+        memory governor
+        :type memory: pfb_exporter.memory.MemoryGovernor
+        """
+        self.columns = {t: sorted(cols) for t, cols in columns.items()}
+        # (table, column) -> value -> list of record positions
+        self._lookup = defaultdict(lambda: defaultdict(list))
+        # record position -> tuple of indexed values
+        self._values = {}
+        self.record_count = 0
+        self._memory = consumer = (
+            memory.consumer('subgraph index', tracking=True)
+            if memory else None
+        )
+        for i, record in enumerate(records):
+            self.record_count += 1
+            table = record.get('type')
+            cols = self.columns.get(table)
+            if not cols:
+                continue
+            values = tuple(record.get(c) for c in cols)
+            self._values[i] = values
+            if consumer:
+                consumer.add(record_size(values))
+            for c, v in zip(cols, values):
+                if v is not None:
+                    self._lookup[(table, c)][v].append(i)
+
+    def has_column(self, table, column):
+        return column in self.columns.get(table, [])
+
+    def find(self, table, column, values):
+        """
+        Find the records of a table whose column has one of the values
+
+        :returns: list of (record position, indexed values dict) tuples
+        """
+        lookup = self._lookup.get((table, column), {})
+        cols = self.columns[table]
+        return [
+            (i, dict(zip(cols, self._values[i])))
+            for v in values
+            for i in lookup.get(v, [])
+        ]
+
+    def close(self):
+        """
+        Drop the index
+        """
+        self._lookup.clear()
+        self._values.clear()
+        if self._memory:
+            self._memory.close()
+
+
+class Subgraph(object):
+
+    def __init__(self, pfb_schema, root, memory=None):
+        """
+        Constructor
+
+        :param pfb_schema: table name -> attributes and foreign keys
+        :type pfb_schema: dict
+        :param root: (table, key, value) of the root record. See parse_root
+        :type root: tuple
+        :param memory: if provided, the collected records are registered
+        with this memory governor
+        :type memory: pfb_exporter.memory.MemoryGovernor
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.pfb_schema = pfb_schema
+        self.table, self.key, self.value = root
+        if self.table not in pfb_schema:
+            raise ValueError(
+                f'Root table {self.table} is not in the PFB schema'
+            )
+        # parent table -> list of (child table, fk column, parent column)
+        self.children = defaultdict(list)
+        # child table -> list of (fk column, parent table, parent column)
+        self.parents = defaultdict(list)
+        for table, node in pfb_schema.items():
+            for fk in node.get('foreign_keys', []):
+                if fk['table'] not in pfb_schema:
+                    continue
+                column = fk_column(fk)
+                self.children[fk['table']].append(
+                    (table, fk['name'], column)
+                )
+                self.parents[table].append((fk['name'], fk['table'], column))
+        # table -> identity -> row of the collected records
+        self.rows = defaultdict(dict)
+        self._memory = (
+            memory.consumer('subgraph records', tracking=True)
+            if memory else None
+        )
+
+    def index_columns(self):
+        """
+        Get the columns of each table that the traversal looks records up
+        by or follows
+
+        :returns: dict of table -> set of columns
+        """
+        columns = defaultdict(set)
+        columns[self.table].add(self.key)
+        for parent, children in self.children.items():
+            for child, fk_col, column in children:
+                columns[child].add(fk_col)
+                columns[parent].add(column)
+        return columns
+
+    def _root_value(self):
+        """
+        Coerce the root value to the type of the key attribute, since it is
+        given as a str
+        """
+        for attr in self.pfb_schema[self.table].get('attributes', []):
+            if attr['name'] == self.key and attr.get('type'):
+                return coerce_value(self.value, attr['type'])
+        return self.value
+
+    def _add(self, table, found):
+        """
+        Collect found rows and return the ones not already collected
+        """
+        collected = self.rows[table]
+        new = []
+        for identity, row in found:
+            if identity not in collected:
+                collected[identity] = row
+                new.append(row)
+                if self._memory:
+                    self._memory.add(record_size(row))
+        return new
+
+    def traverse(self, source):
+        """
+        Collect the records connected to the root record
+
+        :param source: DatabaseSource or PayloadIndex
+        :raises ValueError: if the root record does not exist
+        :returns: self
+        """
+        if not source.has_column(self.table, self.key):
+            raise ValueError(f'Root table {self.table} has no {self.key}')
+        root = self._add(
+            self.table,
+            source.find(self.table, self.key, [self._root_value()])
+        )
+        if not root:
+            raise ValueError(
+                f'Root record {self.table}:{self.key}={self.value} '
+                'does not exist'
+            )
+
+        # Down to the children of collected records
+        pending = [(self.table, root)]
+        while pending:
+            table, rows = pending.pop()
+            for child, fk_col, column in self.children[table]:
+                values = {r.get(column) for r in rows} - {None}
+                if not values:
+                    continue
+                new = self._add(child, source.find(child, fk_col, values))
+                if new:
+                    pending.append((child, new))
+
+        # Up to the parents the collected records point to
+        pending = [(t, list(rows.values())) for t, rows in self.rows.items()]
+        while pending:
+            table, rows = pending.pop()
+            for fk_col, parent, column in self.parents[table]:
+                values = {r.get(fk_col) for r in rows} - {None}
+                values -= {
+                    r.get(column) for r in self.rows[parent].values()
+                }
+                if not values:
+                    continue
+                new = self._add(parent, source.find(parent, column, values))
+                if new:
+                    pending.append((parent, new))
+
+        counts = {t: len(rows) for t, rows in self.rows.items()}
+        self.logger.info(
+            f'Subgraph of {self.table}:{self.key}={self.value} has '
+            f'{self.record_count} records: {counts}'
+        )
+        return self
+
+    @property
+    def record_count(self):
+        return sum(len(rows) for rows in self.rows.values())
+
+    def identities(self):
+        """
+        Get the identities of all collected records, i.e. primary keys for
+        the database source and record positions for the payload index
+        """
+        return {i for rows in self.rows.values() for i in rows}
+
+    def records(self, levels):
+        """
+        Generator which yields the collected records in import order
+
+        :param levels: dependency levels of the tables
+        :type levels: list
+        """
+        for level in levels:
+            for table in level:
+                yield from self.rows.get(table, {}).values()
+
+    def close(self):
+        """
+        Drop the collected records
+        """
+        self.rows.clear()
+        if self._memory:
+            self._memory.close()
+
+
+def select_payloads(records, positions):
+    """
+    Generator which yields the payload records at the given positions of
+    the payload stream
+    """
+    for i, record in enumerate(records):
+        if i in positions:
+            yield record
@@ -6,6 +6,7 @@ from abc import ABC, abstractmethod
 import os
 import json
 import logging
+from contextlib import nullcontext
 
 from pfb_exporter.config import DEFAULT_PFB_SCHEMA_FILE
 
@@ -16,6 +17,17 @@ class Transformer(ABC):
         self.logger = logging.getLogger(type(self).__name__)
         self.models_filepath = models_filepath
         self.output_dir = output_dir
+        # Set to a pfb_exporter.profiling.Profiler to profile each phase
+        self.profiler = None
+
+    def _phase(self, name):
+        """
+        Context manager which profiles a phase of the transformation if
+        profiling is enabled
+        """
+        if self.profiler:
+            return self.profiler.phase(name)
+        return nullcontext()
 
     @abstractmethod
     def _transform(self, *args, **kwargs):
@@ -28,6 +40,8 @@ class Transformer(ABC):
 
         Positional and keyword args get forwarded to child class's
         _build_data_dict method
+
+        :returns: the PFB schema
         """
         self.logger.info(
             'BEGIN transformation from relational model to Gen3 '
@@ -39,20 +53,26 @@ class Transformer(ABC):
             'END transformation from relational model to Gen3 '
             'data dictionary'
         )
+        return pfb_schema
 
-    def write_pfb_schema(self, data):
+    def write_pfb_schema(self, data, output_dir=None):
         """
         Write the Gen3 data dictionary created by self.transform to the
         output_dir as a set of yaml files. There will be one YAML file per
         entity
 
+        Nothing is written if the transformer has no output_dir
+
         :param data: data needed to write out the Gen3 data dict files
         :type data: dict
+        :param output_dir: dir to write to. Defaults to self.output_dir
+        :type output_dir: str
         :returns: path to directory containing data dict files
         """
-        self.pfb_schema = os.path.join(
-            self.output_dir, DEFAULT_PFB_SCHEMA_FILE
-        )
+        output_dir = output_dir or self.output_dir
+        if not output_dir:
+            return
+        self.pfb_schema = os.path.join(output_dir, DEFAULT_PFB_SCHEMA_FILE)
         if data:
             self.logger.info(
                 f'✏️ Writing PFB schema to {self.pfb_schema}'
@@ -2,6 +2,7 @@
 Transform SQLAlchemy Models to PFB Schema
 """
 import os
+import shlex
 import logging
 import inspect
 import subprocess
@@ -9,12 +10,14 @@ from collections import defaultdict
 import timeit
 from pprint import pformat
 
+from sqlalchemy import create_engine
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.inspection import inspect as sqla_inspect
 from sqlalchemy.orm.properties import ColumnProperty
 from sqlalchemy.ext.declarative.api import DeclarativeMeta
 from sqlalchemy.exc import NoInspectionAvailable
 
+from pfb_exporter.graph import select_tables
 from pfb_exporter.utils import import_module_from_file, seconds_to_hms
 from pfb_exporter.transform.base import Transformer
 
@@ -31,13 +34,21 @@ SQLA_AVRO_TYPE_MAP = {
     'logical': {
         'UUID': 'uuid',
         'DateTime': None
+    },
+    # String formats which are not Avro logical types. Used to collect
+    # min/max statistics, see pfb_exporter.stats
+    'format': {
+        'DateTime': 'date-time'
     }
 }
 
 
 class SqlaTransformer(Transformer):
 
-    def __init__(self, models_filepath, output_dir, db_conn_url=None):
+    def __init__(
+        self, models_filepath, output_dir, db_conn_url=None, tables=None,
+        exclude_tables=None, db_schema=None
+    ):
         """
         Constructor
 
@@ -48,14 +59,32 @@ class SqlaTransformer(Transformer):
         :type output_dir: str
         :param db_conn_url: Connection URL for database. Format depends on
         database. See SQLAlchemy documentation for supported databases
+        :param tables: if provided, only these tables and the tables they
+        depend on through foreign keys are reflected, imported and exported
+        :type tables: list
+        :param exclude_tables: tables which are not reflected, imported or
+        exported. Foreign keys to them are left out of the PFB schema
+        :type exclude_tables: list
+        :param db_schema: database schema the models are generated from.
+        Defaults to the database's default schema
+        :type db_schema: str
         """
 
         super().__init__(models_filepath, output_dir)
         self.logger = logging.getLogger(type(self).__name__)
         self.db_conn_url = db_conn_url
+        self.tables = tables
+        self.exclude_tables = exclude_tables
+        self.db_schema = db_schema
+        # Names of the selected tables or None if all tables are selected
+        self.selected_tables = None
         self.data_dict = {}
         self.model_dict = {}
 
+    @property
+    def selects_tables(self):
+        return bool(self.tables or self.exclude_tables)
+
     def _transform(self):
         """
         Entry point for PFB schema generation.
@@ -69,9 +98,11 @@ class SqlaTransformer(Transformer):
         self.logger.info('Build PFB Schema from SqlAlchemy models')
 
         if self.db_conn_url:
-            self._generate_models()
+            with self._phase('generate_models'):
+                self._generate_models()
 
-        self._import_models()
+        with self._phase('import_models'):
+            self._import_models()
 
         if not (self.db_conn_url or self.model_dict):
             raise RuntimeError(
@@ -81,7 +112,8 @@ class SqlaTransformer(Transformer):
                 'provide a dir or file path to where the models reside'
             )
 
-        return self._create_pfb_schema()
+        with self._phase('create_schema'):
+            return self._create_pfb_schema()
 
     def _generate_models(self):
         """
@@ -96,10 +128,19 @@ class SqlaTransformer(Transformer):
                 self.models_filepath, 'models.py'
             )
 
-        # Generate SQLAlchemy models
-        cmd_str = (
-            f'sqlacodegen {self.db_conn_url} --outfile {self.models_filepath}'
-        )
+        # Generate SQLAlchemy models. The command runs in a shell, so every
+        # value is quoted
+        cmd = [
+            'sqlacodegen', self.db_conn_url,
+            '--outfile', self.models_filepath
+        ]
+        if self.db_schema:
+            cmd.extend(['--schema', self.db_schema])
+        if self.selects_tables:
+            # Only reflect the selected tables instead of the whole database
+            self.selected_tables = self._select_database_tables()
+            cmd.extend(['--tables', ','.join(sorted(self.selected_tables))])
+        cmd_str = ' '.join(shlex.quote(arg) for arg in cmd)
         self.logger.debug(f'Building SQLAlchemy models:\n{cmd_str}')
 
         start_time = timeit.default_timer()
@@ -112,6 +153,33 @@ class SqlaTransformer(Transformer):
 
         self.logger.debug(f'Time elapsed: {seconds_to_hms(total_time)}')
 
+    def _select_database_tables(self):
+        """
+        Select the tables in the database, following the foreign keys of
+        the selected tables only
+        """
+        engine = create_engine(self.db_conn_url)
+        try:
+            inspector = sqla_inspect(engine)
+
+            def _parents(table):
+                return {
+                    fk['referred_table']
+                    for fk in inspector.get_foreign_keys(
+                        table, schema=self.db_schema
+                    )
+                    if fk.get('referred_schema') in (None, self.db_schema)
+                }
+
+            return select_tables(
+                inspector.get_table_names(schema=self.db_schema),
+                _parents,
+                include=self.tables,
+                exclude=self.exclude_tables
+            )
+        finally:
+            engine.dispose()
+
     def _import_models(self):
         """
         Import the SQLAlchemy model classes from the Python modules
@@ -167,11 +235,44 @@ class SqlaTransformer(Transformer):
             for cls in classes:
                 self.model_dict[cls.__name__] = cls
 
+        if self.selects_tables:
+            self._select_models()
+
         self.logger.info(
             f'Imported {len(self.model_dict)} SQLAlchemy models:'
             f'\n{pformat(list(self.model_dict.keys()))}'
         )
 
+    def _select_models(self):
+        """
+        Keep the models of the selected tables only
+        """
+        models = {
+            cls.__tablename__: cls for cls in self.model_dict.values()
+        }
+
+        def _parents(table):
+            return {
+                fk.target_fullname.split('.')[-2]
+                for fk in models[table].__table__.foreign_keys
+            }
+
+        if self.selected_tables is not None:
+            # The tables were selected in the database the models were
+            # generated from. Reflection may have generated the models of
+            # excluded tables which selected tables reference
+            include = self.selected_tables & set(models)
+            exclude = set(self.exclude_tables or []) & set(models)
+        else:
+            include, exclude = self.tables, self.exclude_tables
+        self.selected_tables = select_tables(
+            models, _parents, include=include, exclude=exclude
+        )
+        self.model_dict = {
+            name: cls for name, cls in self.model_dict.items()
+            if cls.__tablename__ in self.selected_tables
+        }
+
     def _create_pfb_schema(self):
         """
         Transform SQLAlchemy models into PFB schema
@@ -183,10 +284,9 @@ class SqlaTransformer(Transformer):
             self.logger.info(
                 f'Building schema for {model_name} ...'
             )
+            model_schema = defaultdict(list)
             # Inspect model columns and types
             for p in sqla_inspect(model_cls).iterate_properties:
-                model_schema = defaultdict(list)
-
                 if not isinstance(p, ColumnProperty):
                     continue
 
@@ -197,10 +297,17 @@ class SqlaTransformer(Transformer):
 
                 # Check if foreign key
                 if column_obj.foreign_keys:
-                    fkname = column_obj.foreign_keys.pop().target_fullname
-                    model_schema['foreign_keys'].append(
-                        {'table': fkname.split('.')[0], 'name': p.key}
-                    )
+                    fkname = next(
+                        iter(column_obj.foreign_keys)
+                    ).target_fullname
+                    # [schema.]table.column
+                    table, column = fkname.split('.')[-2:]
+                    if self.selected_tables is None or (
+                        table in self.selected_tables
+                    ):
+                        model_schema['foreign_keys'].append(
+                            {'table': table, 'name': p.key, 'column': column}
+                        )
 
                 # Convert SQLAlchemy column type to avro type
                 stype = type(column_obj.type).__name__
@@ -218,6 +325,10 @@ class SqlaTransformer(Transformer):
                 if ltype:
                     attr_dict.update({'logicalType': ltype})
 
+                fmt = SQLA_AVRO_TYPE_MAP['format'].get(stype)
+                if fmt:
+                    attr_dict.update({'format': fmt})
+
                 # Get default value for attr
                 # if column_obj.default:
                 #     attr_dict.update({'default': column_obj.default})
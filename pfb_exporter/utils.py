@@ -3,6 +3,8 @@ import logging
 import logging.handlers
 import importlib
 import inspect
+import functools
+import contextvars
 import time
 import os
 
@@ -10,6 +12,7 @@ from pfb_exporter.config import (
     DEFAULT_LOG_FILENAME,
     DEFAULT_LOG_LEVEL,
     DEFAULT_LOG_OVERWRITE_OPT,
+    RECORD_ID_FIELDS,
 )
 
 
@@ -63,6 +66,82 @@ def setup_logger(
     return log_filepath
 
 
+# Tag of the job whose log file the current thread logs to. Threads which
+# work for the job inherit it through in_log_context
+_LOG_TAG = contextvars.ContextVar('log_tag', default=None)
+
+
+class _TagFilter(logging.Filter):
+    """
+    Only pass log records emitted by threads working for one job
+    """
+
+    def __init__(self, tag):
+        super().__init__()
+        self.tag = tag
+
+    def filter(self, record):
+        # Handlers are called on the thread which emitted the record
+        return _LOG_TAG.get() is self.tag
+
+
+def in_log_context(func):
+    """
+    Wrap a function which is run on another thread, e.g. a prefetch,
+    scan or decompression worker, so its log messages go to the log file of
+    the job the calling thread works for
+
+    :param func: function to run on another thread
+    :type func: function
+    :returns: wrapped function
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def _run(*args, **kwargs):
+        # A context can't be entered by several threads at once
+        return context.copy().run(func, *args, **kwargs)
+
+    return _run
+
+
+def add_thread_log_handler(log_filepath, log_level=DEFAULT_LOG_LEVEL):
+    """
+    Add a root log handler which writes the log messages emitted by the
+    calling thread, and by the threads it starts with in_log_context, to a
+    log file. Used to give each job that runs on a worker thread its own log
+    file.
+
+    Remove the handler with remove_log_handler on the same thread when the
+    job is done
+
+    :param log_filepath: path to the log file
+    :type log_filepath: str
+    :returns: the log handler
+    """
+    os.makedirs(os.path.dirname(log_filepath), exist_ok=True)
+    handler = logging.FileHandler(log_filepath, mode="w")
+    handler.setFormatter(DEFAULT_FORMATTER)
+    handler.setLevel(log_level)
+    tag = object()
+    handler.addFilter(_TagFilter(tag))
+    handler.log_tag_token = _LOG_TAG.set(tag)
+    logging.getLogger().addHandler(handler)
+    return handler
+
+
+def remove_log_handler(handler):
+    """
+    Remove and close a root log handler
+    """
+    logging.getLogger().removeHandler(handler)
+    handler.close()
+    token = getattr(handler, 'log_tag_token', None)
+    if token is not None:
+        # The worker thread may run another job next
+        _LOG_TAG.reset(token)
+
+
 def timestamp():
     """
     Helper to create an ISO 8601 formatted string that represents local time
@@ -124,3 +203,21 @@ def import_subclass_from_module(parent_cls, imported_module):
                 child_classes.append(child_cls)
 
     return child_classes
+
+
+def get_record_id(record):
+    """
+    Get the identifier of a payload record
+
+    The first non-null value of the fields in
+    pfb_exporter.config.RECORD_ID_FIELDS is used
+
+    :param record: payload record
+    :type record: dict
+    :returns: the record id as a str or None if the record has no id
+    """
+    for field in RECORD_ID_FIELDS:
+        value = record.get(field)
+        if value is not None:
+            return str(value)
+    return None
@@ -0,0 +1,713 @@
+"""
+Write PFB Entities to an Avro file
+
+The PFB Avro schema wraps every table in the relational model in a generic
+Entity record. The first record in the file is the Metadata Entity which
+describes the nodes (tables), their properties (columns) and links (foreign
+keys). All other records are data Entities.
+
+See https://github.com/uc-cdis/pypfb for the reference implementation
+"""
+import io
+import os
+import json
+import shutil
+import logging
+from functools import lru_cache
+
+from fastavro import parse_schema, schemaless_writer
+
+from pfb_exporter.config import (
+    DEFAULT_AVRO_CODEC,
+    DEFAULT_SCHEMA_CACHE_SIZE,
+    DEFAULT_SYNC_INTERVAL
+)
+from pfb_exporter.container import (
+    CODECS,
+    Block,
+    Header,
+    compress,
+    iter_blocks
+)
+from pfb_exporter.enums import encode_enum
+from pfb_exporter.index import (
+    IndexBuilder,
+    PfbIndex,
+    RecordIndexError,
+    index_path,
+    iter_entity_keys
+)
+from pfb_exporter.stats import (
+    STATS_KEY,
+    StatsCollector,
+    dump_stats,
+    load_stats,
+    merge_stats,
+    stats_reserve
+)
+from pfb_exporter.utils import get_record_id
+
+METADATA_SCHEMA = {
+    'type': 'record',
+    'name': 'Metadata',
+    'fields': [
+        {
+            'name': 'nodes',
+            'type': {
+                'type': 'array',
+                'items': {
+                    'type': 'record',
+                    'name': 'Node',
+                    'fields': [
+                        {'name': 'name', 'type': 'string'},
+                        {'name': 'ontology_reference', 'type': 'string'},
+                        {
+                            'name': 'values',
+                            'type': {'type': 'map', 'values': 'string'}
+                        },
+                        {
+                            'name': 'links',
+                            'type': {
+                                'type': 'array',
+                                'items': {
+                                    'type': 'record',
+                                    'name': 'Link',
+                                    'fields': [
+                                        {
+                                            'name': 'multiplicity',
+                                            'type': {
+                                                'type': 'enum',
+                                                'name': 'Multiplicity',
+                                                'symbols': [
+                                                    'ONE_TO_ONE',
+                                                    'ONE_TO_MANY',
+                                                    'MANY_TO_ONE',
+                                                    'MANY_TO_MANY'
+                                                ]
+                                            }
+                                        },
+                                        {'name': 'dst', 'type': 'string'},
+                                        {'name': 'name', 'type': 'string'}
+                                    ]
+                                }
+                            }
+                        },
+                        {
+                            'name': 'properties',
+                            'type': {
+                                'type': 'array',
+                                'items': {
+                                    'type': 'record',
+                                    'name': 'Property',
+                                    'fields': [
+                                        {'name': 'name', 'type': 'string'},
+                                        {
+                                            'name': 'ontology_reference',
+                                            'type': 'string'
+                                        },
+                                        {
+                                            'name': 'values',
+                                            'type': {
+                                                'type': 'map',
+                                                'values': 'string'
+                                            }
+                                        }
+                                    ]
+                                }
+                            }
+                        }
+                    ]
+                }
+            }
+        },
+        {'name': 'misc', 'type': {'type': 'map', 'values': 'string'}}
+    ]
+}
+
+RELATION_SCHEMA = {
+    'type': 'record',
+    'name': 'Relation',
+    'fields': [
+        {'name': 'dst_id', 'type': 'string'},
+        {'name': 'dst_name', 'type': 'string'}
+    ]
+}
+
+# Size of the buffer used to copy blocks when the file is rewritten
+COPY_BUFFER_SIZE = 1024 ** 2
+
+# Python types that payload values are coerced to before encoding
+AVRO_PYTHON_TYPES = {
+    'string': str,
+    'boolean': bool,
+    'float': float,
+    'double': float,
+    'int': int,
+    'long': int,
+}
+
+
+def avro_attributes(node_schema):
+    """
+    Get the attributes of a table in the PFB schema which have an avro type
+    """
+    return [a for a in node_schema.get('attributes', []) if a.get('type')]
+
+
+def make_node_schema(node_name, node_schema):
+    """
+    Create the Avro record schema for one table in the PFB schema
+
+    All fields are nullable since payloads may omit any attribute
+
+    :param node_name: name of the table
+    :type node_name: str
+    :param node_schema: the table's entry in the PFB schema
+    :type node_schema: dict
+    """
+    fields = []
+    for attr in avro_attributes(node_schema):
+        atype = attr['type']
+        if atype == 'enum':
+            atype = {
+                'type': 'enum',
+                'name': f'{node_name}_{attr["name"]}',
+                'symbols': [encode_enum(v) for v in attr['symbols']]
+            }
+        elif attr.get('logicalType'):
+            atype = {'type': atype, 'logicalType': attr['logicalType']}
+        fields.append(
+            {'name': attr['name'], 'type': ['null', atype], 'default': None}
+        )
+    return {'type': 'record', 'name': node_name, 'fields': fields}
+
+
+def make_avro_schema(pfb_schema):
+    """
+    Create the PFB Entity Avro schema from the PFB schema created by
+    pfb_exporter.transform.sqla.SqlaTransformer
+
+    :param pfb_schema: table name -> attributes and foreign keys
+    :type pfb_schema: dict
+    :returns: Avro schema dict
+    """
+    return {
+        'type': 'record',
+        'name': 'Entity',
+        'fields': [
+            {'name': 'id', 'type': ['null', 'string'], 'default': None},
+            {'name': 'name', 'type': 'string'},
+            {
+                'name': 'object',
+                'type': [METADATA_SCHEMA] + [
+                    make_node_schema(name, node)
+                    for name, node in pfb_schema.items()
+                ]
+            },
+            {
+                'name': 'relations',
+                'type': {'type': 'array', 'items': RELATION_SCHEMA},
+                'default': []
+            }
+        ]
+    }
+
+
+def make_tagged_schemas(avro_schema):
+    """
+    Create one Entity schema per branch of the union in the Entity's object
+    field, which encodes Entities with that branch already chosen
+
+    In Avro binary, a union is encoded as the index of its branch followed
+    by the value. Given the Entity schema, the encoder has to find the branch
+    of every object by validating it against the union's record schemas in
+    turn, which is slow with dozens of tables sharing most of their fields.
+    A tagged schema replaces the union with a long field whose default is the
+    branch index, followed by the branch's record schema. A long is encoded
+    the same way as a union index, so it encodes the same bytes as the Entity
+    schema without trying any branch
+
+    :param avro_schema: PFB Entity Avro schema
+    :type avro_schema: dict
+    :returns: dict of branch record name -> parsed tagged Entity schema
+    """
+    fields = {f['name']: f for f in avro_schema['fields']}
+    tagged = {}
+    for i, branch in enumerate(fields['object']['type']):
+        tagged[branch['name']] = parse_schema({
+            'type': 'record',
+            'name': 'Entity',
+            'fields': [
+                fields['id'],
+                fields['name'],
+                {'name': '_branch', 'type': 'long', 'default': i},
+                {'name': 'object', 'type': branch},
+                fields['relations']
+            ]
+        })
+    return tagged
+
+
+def make_metadata(pfb_schema):
+    """
+    Create the PFB Metadata object from the PFB schema
+
+    :param pfb_schema: table name -> attributes and foreign keys
+    :type pfb_schema: dict
+    :returns: Metadata dict
+    """
+    nodes = []
+    for name, node in pfb_schema.items():
+        nodes.append({
+            'name': name,
+            'ontology_reference': '',
+            'values': {},
+            'links': [
+                {
+                    'multiplicity': 'MANY_TO_ONE',
+                    'dst': fk['table'],
+                    'name': fk['name']
+                }
+                for fk in node.get('foreign_keys', [])
+            ],
+            'properties': [
+                {'name': a['name'], 'ontology_reference': '', 'values': {}}
+                for a in avro_attributes(node)
+            ]
+        })
+    return {'nodes': nodes, 'misc': {}}
+
+
+def coerce_value(value, avro_type):
+    """
+    Coerce a payload value to the Python type expected by the Avro type.
+    Values which cannot be coerced are nulled out.
+    """
+    if value is None:
+        return None
+    pytype = AVRO_PYTHON_TYPES.get(avro_type)
+    if not pytype or isinstance(value, pytype):
+        return value
+    if pytype is bool and isinstance(value, str):
+        return value.strip().lower() in ('true', 'yes', '1')
+    try:
+        return pytype(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def make_converter(node_name, attr):
+    """
+    Create the function which converts a payload value to the value encoded
+    for an attribute. Enum values are looked up in a precomputed value ->
+    symbol table.
+    """
+    if attr['type'] != 'enum':
+        avro_type = attr['type']
+        return lambda value: coerce_value(value, avro_type)
+
+    symbols = {v: encode_enum(v) for v in attr['symbols']}
+
+    def _to_symbol(value):
+        if value is None:
+            return None
+        try:
+            return symbols[str(value)]
+        except KeyError:
+            raise ValueError(
+                f'{value!r} is not one of the enum values of '
+                f'{node_name}.{attr["name"]}'
+            )
+
+    return _to_symbol
+
+
+class CompiledSchema(object):
+    """
+    What a writer derives from the PFB schema before it can encode: the Avro
+    schema, the parsed Avro schema, the tagged Entity schema and the value
+    converters of each table
+    """
+
+    def __init__(self, pfb_schema):
+        self.avro_schema = make_avro_schema(pfb_schema)
+        self.parsed_schema = parse_schema(self.avro_schema)
+        self.tagged_schemas = make_tagged_schemas(self.avro_schema)
+        # table -> list of (attribute name, value converter)
+        self.converters = {
+            name: [(a['name'], make_converter(name, a))
+                   for a in avro_attributes(node)]
+            for name, node in pfb_schema.items()
+        }
+
+
+@lru_cache(maxsize=DEFAULT_SCHEMA_CACHE_SIZE)
+def _compile_schema(pfb_schema_json):
+    return CompiledSchema(json.loads(pfb_schema_json))
+
+
+def compile_schema(pfb_schema):
+    """
+    Get the compiled form of a PFB schema. It is compiled once per process
+    and shared by all writers of the same schema, e.g. the exports of a
+    batch (see pfb_exporter.batch). Compiled schemas are read only, so
+    writers on different threads can share them
+
+    :param pfb_schema: table name -> attributes and foreign keys
+    :type pfb_schema: dict
+    :returns: CompiledSchema
+    """
+    return _compile_schema(json.dumps(pfb_schema))
+
+
+class PfbWriter(object):
+
+    def __init__(
+        self, fo, pfb_schema, codec=DEFAULT_AVRO_CODEC, append=False,
+        sync_interval=DEFAULT_SYNC_INTERVAL, memory=None, index=False
+    ):
+        """
+        Constructor
+
+        The writer encodes Entities into blocks of about sync_interval bytes
+        and writes the Avro container itself, so it knows the encoded size of
+        every Entity. See pfb_exporter.container
+
+        :param fo: path to the PFB file or a binary file-like object
+        :type fo: str or file-like object
+        :param pfb_schema: table name -> attributes and foreign keys, as
+        created by pfb_exporter.transform.sqla.SqlaTransformer
+        :type pfb_schema: dict
+        :param codec: Avro compression codec, one of
+        pfb_exporter.container.CODECS
+        :type codec: str
+        :param append: whether to append to an existing PFB file at fo
+        instead of overwriting it. The file must have been written with the
+        same Avro schema (see pfb_exporter.compat) and its codec is used.
+        The Metadata Entity must not be written again
+        :type append: bool
+        :param sync_interval: size in bytes of the uncompressed data after
+        which a block is written
+        :type sync_interval: int
+        :param memory: if provided, the current block is registered with
+        this memory governor and written early when the governor asks for it
+        :type memory: pfb_exporter.memory.MemoryGovernor
+        :param index: whether to write the record id index of the file next
+        to it when the writer is closed (see pfb_exporter.index). Only
+        supported when fo is a path
+        :type index: bool
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.pfb_schema = pfb_schema
+        compiled = compile_schema(pfb_schema)
+        self.avro_schema = compiled.avro_schema
+        self.codec = codec
+        self.sync_interval = sync_interval
+        self.record_count = 0
+        self._skipped = set()
+        self._stats = StatsCollector(pfb_schema)
+        self._final_stats = None
+        # table -> list of (attribute name, value converter)
+        self._converters = compiled.converters
+        # Encoded Entities of the current block
+        self._buf = io.BytesIO()
+        self._block_count = 0
+        self._memory = (
+            memory.consumer('avro block', spillable=True) if memory else None
+        )
+
+        self.filepath = fo if isinstance(fo, str) else None
+        if index and not self.filepath:
+            raise ValueError('A record id index requires a PFB file path')
+        self._index = (
+            IndexBuilder(
+                tmp_dir=os.path.dirname(os.path.abspath(fo)), memory=memory
+            )
+            if index else None
+        )
+        # (entity type, id, ordinal) of the indexed Entities in the block
+        self._block_keys = []
+        # Number of bytes the data blocks moved by when the Metadata block
+        # was rewritten
+        self._offset_shift = 0
+        if self.filepath and append and os.path.isfile(fo) and (
+            os.path.getsize(fo)
+        ):
+            self._fo = open(fo, 'r+b')
+            self.header = Header.read(self._fo)
+            self.codec = self.header.codec
+            if self._index:
+                self._index_existing()
+            self._fo.seek(0, os.SEEK_END)
+        else:
+            if codec not in CODECS:
+                raise ValueError(
+                    f'Unsupported codec {codec}. Supported: {CODECS}'
+                )
+            self._fo = open(fo, 'w+b') if self.filepath else fo
+            self.header = Header(self.avro_schema, codec=codec)
+            encoded = self.header.encode()
+            self.header.size = len(encoded)
+            self._fo.write(encoded)
+        # Union branches are numbered by the schema of the file, which may
+        # be an earlier compatible version of the PFB schema when appending
+        if self.header.schema == self.avro_schema:
+            self._parsed_schema = compiled.parsed_schema
+            self._tagged_schemas = compiled.tagged_schemas
+        else:
+            self._parsed_schema = parse_schema(self.header.schema)
+            self._tagged_schemas = make_tagged_schemas(self.header.schema)
+
+    def _index_existing(self):
+        """
+        Add the Entities already in an appended file to the record id index,
+        from its index if it is up to date or else from its blocks
+        """
+        try:
+            index = PfbIndex(index_path(self.filepath))
+        except RecordIndexError:
+            index = None
+        if index and index.matches(self.filepath, self.header):
+            self._index.add_index(index)
+            return
+        if index:
+            index.close()
+        self.logger.info(
+            f'Indexing the records already in {self.filepath}'
+        )
+        self._fo.seek(self.header.size)
+        for entry in iter_entity_keys(self._fo, self.header):
+            self._index.add(*entry)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def stats(self):
+        """
+        Statistics of the written Entities, see pfb_exporter.stats. Once the
+        writer is closed, these include the statistics of the records that
+        were already in an appended file
+        """
+        return self._final_stats or self._stats.to_dict()
+
+    def write_metadata(self):
+        """
+        Write the PFB Metadata Entity. Must be the first record in the file
+
+        The Metadata Entity is flushed in a block of its own, so it can be
+        read or replaced without decoding any data Entities. When writing to
+        a path with the null codec, space is reserved in it for the
+        statistics, which are filled in when the writer is closed
+        """
+        metadata = make_metadata(self.pfb_schema)
+        if self.filepath and self.codec == 'null':
+            metadata['misc'][STATS_KEY] = ' ' * stats_reserve(
+                self.pfb_schema
+            )
+        self._write_entity({
+            'id': None,
+            'name': 'Metadata',
+            'object': ('Metadata', metadata),
+            'relations': []
+        })
+        self.flush()
+
+    def make_entity(self, record, entity_type=None):
+        """
+        Transform a payload record into a PFB Entity
+
+        :param record: payload record
+        :type record: dict or pfb_exporter.rows.Row
+        :param entity_type: table the record belongs to. Defaults to the
+        record's `type` field
+        :type entity_type: str
+        :returns: Entity dict or None if the entity type is not in the schema
+        """
+        entity_type = entity_type or record.get('type')
+        node = self.pfb_schema.get(entity_type)
+        if node is None:
+            return None
+
+        return {
+            'id': get_record_id(record),
+            'name': entity_type,
+            'object': {
+                name: convert(record.get(name))
+                for name, convert in self._converters[entity_type]
+            },
+            'relations': [
+                {
+                    'dst_id': str(record.get(fk['name'])),
+                    'dst_name': fk['table']
+                }
+                for fk in node.get('foreign_keys', [])
+                if record.get(fk['name']) is not None
+            ]
+        }
+
+    def write(self, record, entity_type=None):
+        """
+        Transform a payload record into a PFB Entity and write it
+
+        Records whose entity type is not in the PFB schema are skipped
+
+        :returns: True if the record was written, False if it was skipped
+        """
+        entity = self.make_entity(record, entity_type=entity_type)
+        if entity is None:
+            entity_type = entity_type or record.get('type')
+            if entity_type not in self._skipped:
+                self._skipped.add(entity_type)
+                self.logger.warning(
+                    f'⚠️ Skipping {entity_type} records. {entity_type} is '
+                    'not in the PFB schema'
+                )
+            return False
+        if self._index and entity['id'] is not None:
+            self._block_keys.append(
+                (entity['name'], entity['id'], self._block_count)
+            )
+        size = self._write_entity(
+            entity, self._tagged_schemas.get(entity['name'])
+        )
+        self._stats.add(entity['name'], entity['object'], size)
+        self.record_count += 1
+        return True
+
+    def write_all(self, records):
+        """
+        Write all records from an iterable of payload records
+        """
+        for record in records:
+            self.write(record)
+
+    def _write_entity(self, entity, schema=None):
+        """
+        Encode an Entity into the current block
+
+        :param entity: Entity dict
+        :type entity: dict
+        :param schema: parsed schema to encode the Entity with, e.g. the
+        tagged schema of its table. Defaults to the file's schema
+        :type schema: dict
+        :returns: encoded size of the Entity in bytes
+        """
+        start = self._buf.tell()
+        schemaless_writer(self._buf, schema or self._parsed_schema, entity)
+        size = self._buf.tell() - start
+        self._block_count += 1
+        if self._memory and self._memory.add(size):
+            self.flush()
+            self._memory.spilled()
+        elif self._buf.tell() >= self.sync_interval:
+            self.flush()
+        return size
+
+    def flush(self):
+        """
+        Write the current block
+        """
+        if not self._block_count:
+            return
+        block = Block(
+            self._block_count, compress(self.codec, self._buf.getvalue())
+        )
+        if self._index:
+            offset = self._fo.tell()
+            for entity_type, record_id, ordinal in self._block_keys:
+                self._index.add(entity_type, record_id, offset, ordinal)
+            self._block_keys = []
+        self._fo.write(block.encode(self.header.sync))
+        self._buf = io.BytesIO()
+        self._block_count = 0
+        if self._memory:
+            self._memory.release()
+
+    def close(self):
+        """
+        Flush buffered records, store the statistics in the Metadata Entity,
+        close the file if the writer opened it and write the record id index
+        """
+        self.flush()
+        if self.filepath:
+            try:
+                self._write_stats()
+            except Exception:
+                if self._index:
+                    self._index.close()
+                raise
+            finally:
+                self._fo.close()
+            if self._index:
+                self._write_index()
+        elif hasattr(self._fo, 'flush'):
+            self._fo.flush()
+
+    def _write_stats(self):
+        """
+        Store the statistics in the Metadata Entity. With the null codec the
+        statistics are padded to the space reserved for them, and the
+        Metadata block is overwritten in place if they fit. A compressed
+        Metadata block can't keep its length, so compressed outputs always
+        take the rewrite path: the file is rewritten with the unpadded
+        statistics, copying all other blocks as is
+        """
+        self._fo.seek(self.header.size)
+        block = next(iter_blocks(self._fo, self.header), None)
+        block_end = self._fo.tell()
+        if block is None:
+            return
+        records = block.records(
+            self.codec, self._parsed_schema, return_record_name=True
+        )
+        name, metadata = records[0]['object']
+        if name != 'Metadata':
+            return
+
+        reserved = metadata['misc'].get(STATS_KEY, '')
+        self._final_stats = merge_stats(
+            [load_stats(reserved), self._stats.to_dict()]
+        )
+        value = dump_stats(self._final_stats)
+        if self.codec == 'null':
+            value = value.ljust(len(reserved))
+        metadata['misc'][STATS_KEY] = value
+        data = Block.from_records(
+            records, self.codec, self._parsed_schema
+        ).encode(self.header.sync)
+
+        if len(data) == block_end - block.offset:
+            self._fo.seek(block.offset)
+            self._fo.write(data)
+            return
+
+        tmp_filepath = f'{self.filepath}.tmp'
+        with open(tmp_filepath, 'wb') as dst:
+            dst.write(self.header.encode())
+            dst.write(data)
+            self._offset_shift = dst.tell() - block_end
+            self._fo.seek(block_end)
+            shutil.copyfileobj(self._fo, dst, COPY_BUFFER_SIZE)
+        os.replace(tmp_filepath, self.filepath)
+        self.logger.debug(
+            f'Rewrote {self.filepath} to store the statistics in the '
+            'Metadata Entity'
+        )
+
+    def _write_index(self):
+        """
+        Write the record id index of the file
+        """
+        try:
+            self._index.write(
+                index_path(self.filepath),
+                self.header.sync,
+                os.path.getsize(self.filepath),
+                shift=self._offset_shift
+            )
+        finally:
+            self._index.close()
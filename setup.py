@@ -19,5 +19,9 @@ setup(
         ],
     },
     include_package_data=True,
-    install_requires=requirements
+    install_requires=requirements,
+    extras_require={
+        'columnar': ['pyarrow'],
+        'zstd': ['zstandard>=0.16.0'],
+    }
 )
@@ -0,0 +1,76 @@
+import os
+import io
+import asyncio
+
+import pytest
+from fastavro import reader
+
+from conftest import TEST_DATA_DIR
+from pfb_exporter.api import (
+    PfbExportError,
+    build_pfb_schema,
+    export_records,
+    export_records_async
+)
+
+DATA_DIR = os.path.join(TEST_DATA_DIR, 'input')
+
+
+class Stream(object):
+    """
+    Write-only stream, e.g. a socket
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data.extend(data)
+
+
+def _records():
+    return {
+        'participant': [
+            {'kf_id': 'PT_00000001', 'family_id': 'FM_00000001'}
+        ],
+        'family': [{'kf_id': 'FM_00000001'}],
+    }
+
+
+def test_export_records():
+    """
+    Test pfb_exporter.api.export_records writes parents first to a stream
+    """
+    pfb_schema = build_pfb_schema(models_filepath=DATA_DIR)
+    stream = Stream()
+    counts = export_records(_records(), stream, pfb_schema)
+    assert counts == {'family': 1, 'participant': 1}
+
+    entities = list(reader(io.BytesIO(bytes(stream.data))))
+    assert [e['name'] for e in entities] == [
+        'Metadata', 'family', 'participant'
+    ]
+    assert entities[2]['relations'] == [
+        {'dst_id': 'FM_00000001', 'dst_name': 'family'}
+    ]
+
+
+def test_export_records_async():
+    """
+    Test pfb_exporter.api.export_records_async with async iterables
+    """
+    pfb_schema = build_pfb_schema(models_filepath=DATA_DIR)
+
+    async def _participants():
+        for i in range(3):
+            await asyncio.sleep(0)
+            yield {'kf_id': f'PT_{i}'}
+
+    buf = io.BytesIO()
+    counts = asyncio.run(export_records_async(
+        {'participant': _participants(), 'family': []}, buf, pfb_schema
+    ))
+    assert counts == {'participant': 3}
+
+    with pytest.raises(PfbExportError):
+        export_records({'project': []}, io.BytesIO(), pfb_schema)
@@ -0,0 +1,164 @@
+import os
+import json
+import shutil
+import logging
+import threading
+
+import pytest
+from click.testing import CliRunner
+
+from conftest import TEST_DATA_DIR
+from pfb_exporter import batch, cli
+from pfb_exporter.batch import BatchExporter, ManifestError, load_manifest
+from pfb_exporter.utils import (
+    add_thread_log_handler,
+    in_log_context,
+    remove_log_handler
+)
+from pfb_exporter.writer import _compile_schema
+
+DATA_DIR = os.path.join(TEST_DATA_DIR, 'input')
+
+
+def _write_manifest(tmpdir, text):
+    filepath = str(tmpdir.join('manifest.yaml'))
+    with open(filepath, 'w') as manifest_file:
+        manifest_file.write(text)
+    return filepath
+
+
+def test_load_manifest(tmpdir):
+    """
+    Test pfb_exporter.batch.load_manifest resolves paths and rejects
+    invalid studies
+    """
+    filepath = _write_manifest(tmpdir, """
+studies:
+  - data_dir: data/a
+    output_dir: out/a
+  - name: b
+    root: study:kf_id=SD_1
+    output_dir: out/b
+    max_memory: 1G
+""")
+    a, b = load_manifest(filepath)
+    assert a['name'] == 'a'
+    assert a['data_dir'] == str(tmpdir.join('data', 'a'))
+    assert b['root'] == ('study', 'kf_id', 'SD_1')
+    assert b['max_memory'] == 1024 ** 3
+
+    for study in [
+        'output_dir: out/a',
+        'data_dir: a',
+        '{data_dir: a, root: "study:kf_id=SD_1", output_dir: out/a}',
+        '{data_dir: a, output_dir: out/a, colour: blue}',
+        '{root: study, output_dir: out/a}',
+    ]:
+        filepath = _write_manifest(tmpdir, f'studies:\n  - {study}\n')
+        with pytest.raises(ManifestError):
+            load_manifest(filepath)
+
+
+def test_batch(tmpdir):
+    """
+    Test pfb_exporter.cli.batch exports every study and a failing study
+    does not stop the others
+    """
+    for name in ['SD_1', 'SD_2']:
+        shutil.copytree(DATA_DIR, str(tmpdir.join('data', name)))
+    tmpdir.join('data').mkdir('SD_3').join('participant.json').write(
+        '{not json'
+    )
+
+    manifest = _write_manifest(tmpdir, """
+studies:
+  - {data_dir: data/SD_1, output_dir: out/SD_1}
+  - {data_dir: data/SD_2, output_dir: out/SD_2, detect_enums: true}
+  - {data_dir: data/SD_3, output_dir: out/SD_3}
+""")
+    output_dir = str(tmpdir.join('batch'))
+    hits = _compile_schema.cache_info().hits
+    result = CliRunner().invoke(
+        cli.batch, [manifest, '-m', DATA_DIR, '-o', output_dir, '-j', '2']
+    )
+    assert result.exit_code == 1
+
+    with open(os.path.join(output_dir, 'status.json')) as json_file:
+        status = json.load(json_file)
+    assert {n: s['status'] for n, s in status.items()} == {
+        'SD_1': 'succeeded', 'SD_2': 'succeeded', 'SD_3': 'failed'
+    }
+    assert status['SD_3']['error']
+
+    for name in ['SD_1', 'SD_2']:
+        study_dir = str(tmpdir.join('out', name))
+        assert os.path.isfile(os.path.join(study_dir, 'pfb.avro'))
+        with open(status[name]['log']) as log_file:
+            log = log_file.read()
+        assert f'{study_dir}/pfb.avro succeeded' in log
+        assert 'SD_3' not in log
+    # Both studies without enum detection share one compiled schema, so
+    # at least one of them found it in the cache
+    assert _compile_schema.cache_info().hits > hits
+
+
+def test_batch_shares_scan_slots(tmpdir, monkeypatch):
+    """
+    Test all studies of a batch share the scan slots of the engine's pool
+    """
+    manifest = _write_manifest(tmpdir, """
+studies:
+  - {data_dir: data/SD_1, output_dir: out/SD_1}
+  - {data_dir: data/SD_2, output_dir: out/SD_2}
+""")
+    slots = []
+
+    class _Exporter(object):
+        def __init__(self, *args, **kwargs):
+            slots.append(kwargs['scan_slots'])
+
+        def run(self):
+            pass
+
+    monkeypatch.setattr(batch, 'PfbExporter', _Exporter)
+    exporter = BatchExporter(
+        manifest, models_filepath=DATA_DIR,
+        output_dir=str(tmpdir.join('batch')), jobs=2, pool_size=3
+    )
+    assert exporter.run() == []
+    assert len(slots) == 2 and slots[0] is slots[1] is exporter.scan_slots
+
+
+def test_study_log_threads(tmpdir):
+    """
+    Test a study's log file gets the messages of the threads started for
+    the study, and not those of other threads
+    """
+    logger = logging.getLogger('test_study_log_threads')
+
+    def _study(name):
+        handler = add_thread_log_handler(str(tmpdir.join(f'{name}.log')))
+        logger.warning(f'{name} started')
+        workers = [
+            threading.Thread(target=in_log_context(logger.warning),
+                             args=(f'{name} worker',)),
+            threading.Thread(target=logger.warning, args=(f'{name} other',))
+        ]
+        for t in workers:
+            t.start()
+            t.join()
+        remove_log_handler(handler)
+
+    studies = [
+        threading.Thread(target=_study, args=(name,))
+        for name in ['SD_1', 'SD_2']
+    ]
+    for t in studies:
+        t.start()
+    for t in studies:
+        t.join()
+
+    for name, other in [('SD_1', 'SD_2'), ('SD_2', 'SD_1')]:
+        log = tmpdir.join(f'{name}.log').read()
+        assert f'{name} started' in log and f'{name} worker' in log
+        assert f'{name} other' not in log and other not in log
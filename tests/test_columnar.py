@@ -0,0 +1,67 @@
+import os
+
+import pytest
+from click.testing import CliRunner
+
+from conftest import TEST_DATA_DIR
+from pfb_exporter import cli
+from pfb_exporter.columnar import ColumnarWriter
+
+pa = pytest.importorskip('pyarrow')
+pq = pytest.importorskip('pyarrow.parquet')
+
+DATA_DIR = os.path.join(TEST_DATA_DIR, 'input')
+
+
+def test_columnar_writer(tmpdir):
+    """
+    Test pfb_exporter.columnar.ColumnarWriter writes record batches with
+    the column types from the PFB schema
+    """
+    schema = {
+        'genomic_file': {
+            'attributes': [
+                {'name': 'kf_id', 'type': 'string'},
+                {'name': 'data_type', 'type': 'enum',
+                 'symbols': ['gVCF', 'Aligned Reads']},
+                {'name': 'size', 'type': 'int'},
+                {'name': 'duo_ids', 'type': None},
+            ]
+        }
+    }
+    records = [
+        {'type': 'genomic_file', 'kf_id': f'GF_{i}',
+         'data_type': ['gVCF', 'Aligned Reads'][i % 2], 'size': str(i)}
+        for i in range(25)
+    ]
+    for fmt in ['parquet', 'arrow']:
+        out = str(tmpdir.join(fmt))
+        with ColumnarWriter(out, schema, fmt=fmt, batch_size=10) as writer:
+            for r in records:
+                writer.write(r)
+            filepath = writer.filepath('genomic_file')
+
+        if fmt == 'parquet':
+            table = pq.read_table(filepath)
+        else:
+            table = pa.ipc.open_file(filepath).read_all()
+        assert table.num_rows == 25
+        assert table.column_names == ['kf_id', 'data_type', 'size']
+        assert table.column('size').type == pa.int32()
+        assert table.column('size').to_pylist() == list(range(25))
+
+
+def test_export_columnar(tmpdir):
+    """
+    Test pfb_exporter.cli.export --columnar
+    """
+    output_dir = str(tmpdir)
+    result = CliRunner().invoke(
+        cli.export,
+        [DATA_DIR, '-m', DATA_DIR, '-o', output_dir, '--columnar', 'parquet']
+    )
+    assert result.exit_code == 0
+    table = pq.read_table(
+        os.path.join(output_dir, 'tables', 'participant.parquet')
+    )
+    assert table.column('is_proband').to_pylist() == [True]
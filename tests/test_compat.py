@@ -0,0 +1,137 @@
+import os
+from copy import deepcopy
+
+import pytest
+from fastavro import reader
+
+from conftest import TEST_DATA_DIR
+from click.testing import CliRunner
+
+from pfb_exporter import cli
+from pfb_exporter.compat import (
+    IncompatibleSchemaError,
+    align_pfb_schema,
+    check_compatibility,
+    fingerprint,
+    rewrite_pfb
+)
+from pfb_exporter.container import read_container
+from pfb_exporter.writer import PfbWriter
+
+DATA_DIR = os.path.join(TEST_DATA_DIR, 'input')
+
+PFB_SCHEMA = {
+    'family': {
+        'attributes': [
+            {'name': 'kf_id', 'type': 'string'},
+            {'name': 'size', 'type': 'int'},
+        ]
+    },
+    'participant': {
+        'attributes': [
+            {'name': 'kf_id', 'type': 'string'},
+            {'name': 'gender', 'type': 'enum', 'symbols': ['Female', 'Male']},
+            {'name': 'family_id', 'type': 'string'},
+        ],
+        'foreign_keys': [{'table': 'family', 'name': 'family_id'}]
+    }
+}
+
+
+def test_fingerprint():
+    """
+    Test pfb_exporter.compat.fingerprint
+    """
+    schema = {
+        'type': 'record', 'name': 'a', 'namespace': 'x.y', 'doc': 'd',
+        'fields': [
+            {
+                'name': 'f', 'default': None,
+                'type': ['null', {'type': 'string', 'logicalType': 'uuid'}]
+            },
+            {'name': 'g', 'type': {'type': 'enum', 'name': 'E',
+                                   'symbols': ['A']}},
+            {'name': 'h', 'type': 'E'},
+        ]
+    }
+    assert fingerprint(schema) == '88e0831e108c9594'
+    assert fingerprint('int') == fingerprint({'type': 'int'})
+
+
+def test_check_compatibility():
+    """
+    Test pfb_exporter.compat.check_compatibility
+    """
+    new = deepcopy(PFB_SCHEMA)
+    new['family']['attributes'][1]['type'] = 'long'
+    new['family']['attributes'].append({'name': 'name', 'type': 'string'})
+    new['participant']['attributes'][1]['symbols'] = ['Male', 'Other']
+    new['study'] = {'attributes': [{'name': 'kf_id', 'type': 'string'}]}
+
+    aligned = align_pfb_schema(PFB_SCHEMA, new)
+    assert list(aligned) == ['family', 'participant', 'study']
+    assert aligned['participant']['attributes'][1]['symbols'] == [
+        'Female', 'Male', 'Other'
+    ]
+    changes = check_compatibility(PFB_SCHEMA, aligned)
+    assert len(changes.compatible) == 4
+
+    del new['participant']
+    new['family']['attributes'][0]['type'] = 'int'
+    with pytest.raises(IncompatibleSchemaError) as e:
+        check_compatibility(PFB_SCHEMA, new)
+    assert e.value.incompatible == [
+        'Removed table participant',
+        'Changed type of family.kf_id from string to int'
+    ]
+
+
+def test_rewrite_and_append(tmpdir):
+    """
+    Test that a PFB file is rewritten with a compatible schema and appended to
+    """
+    pfb_file = os.path.join(str(tmpdir), 'pfb.avro')
+    with PfbWriter(pfb_file, PFB_SCHEMA) as writer:
+        writer.write_metadata()
+        writer.write({'type': 'family', 'kf_id': 'FM_1', 'size': 3})
+        writer.write({'type': 'participant', 'kf_id': 'PT_1',
+                      'gender': 'Male', 'family_id': 'FM_1'})
+
+    new = deepcopy(PFB_SCHEMA)
+    new['family']['attributes'].append({'name': 'name', 'type': 'string'})
+    new['study'] = {'attributes': [{'name': 'kf_id', 'type': 'string'}]}
+    header, _ = read_container(pfb_file)
+    rewrite_pfb(pfb_file, header, new)
+
+    with PfbWriter(pfb_file, new, append=True) as writer:
+        writer.write({'type': 'study', 'kf_id': 'SD_1'})
+        writer.write({'type': 'family', 'kf_id': 'FM_2', 'name': 'b'})
+
+    with open(pfb_file, 'rb') as f:
+        records = list(reader(f))
+    assert [r['name'] for r in records] == [
+        'Metadata', 'family', 'participant', 'study', 'family'
+    ]
+    nodes = records[0]['object']['nodes']
+    assert [n['name'] for n in nodes] == ['family', 'participant', 'study']
+    assert records[1]['object'] == {'kf_id': 'FM_1', 'size': 3, 'name': None}
+    assert records[2]['object']['gender'] == 'Male'
+    assert records[4]['object']['name'] == 'b'
+
+
+def test_export_append(tmpdir):
+    """
+    Test that pfb_exporter.cli.export --append appends to an existing PFB
+    """
+    output_dir = str(tmpdir)
+    runner = CliRunner()
+    for _ in range(2):
+        result = runner.invoke(
+            cli.export, [DATA_DIR, '-m', DATA_DIR, '-o', output_dir,
+                         '--append']
+        )
+        assert result.exit_code == 0
+
+    with open(os.path.join(output_dir, 'pfb.avro'), 'rb') as f:
+        names = [r['name'] for r in reader(f)]
+    assert names == ['Metadata'] + ['family', 'participant'] * 2
@@ -0,0 +1,83 @@
+import gzip
+import json
+
+import pytest
+
+from pfb_exporter.compression import DecompressingReader
+from pfb_exporter.payloads import iter_payloads, list_payload_files
+
+
+def _records(table, n):
+    return [{'kf_id': f'{table}_{i}', 'type': table} for i in range(n)]
+
+
+def test_compressed_payloads(tmpdir):
+    """
+    Test compressed payloads, including multi-member gzip files, are read
+    in the same order as uncompressed payloads
+    """
+    data_dir = tmpdir.mkdir('data')
+    family = _records('family', 10)
+    participant = _records('participant', 5000)
+    study = _records('study', 2)
+
+    with gzip.open(str(data_dir.join('family.json.gz')), 'wt') as f:
+        json.dump(family, f)
+    # Concatenated gzip members
+    with open(str(data_dir.join('participant.jsonl.gz')), 'wb') as f:
+        for i in range(0, len(participant), 1000):
+            f.write(gzip.compress(''.join(
+                json.dumps(r) + '\n' for r in participant[i:i + 1000]
+            ).encode('utf-8')))
+    with open(str(data_dir.join('study.json')), 'w') as f:
+        json.dump(study, f)
+    data_dir.join('notes.txt.gz').write('not a payload')
+
+    assert [p.rsplit('/', 1)[-1] for p in list_payload_files(
+        str(data_dir)
+    )] == ['family.json.gz', 'participant.jsonl.gz', 'study.json']
+    for workers in [1, 3]:
+        records = list(iter_payloads(str(data_dir), workers=workers))
+        assert records == family + participant + study
+
+    # Stopping early stops the decompression threads
+    records = iter_payloads(str(data_dir))
+    next(records)
+    records.close()
+
+
+def test_truncated_gzip(tmpdir):
+    """
+    Test a truncated gzip file raises an error instead of yielding partial
+    data silently
+    """
+    filepath = str(tmpdir.join('participant.jsonl.gz'))
+    data = gzip.compress(b'{"kf_id": "PT_1"}\n' * 1000)
+    with open(filepath, 'wb') as f:
+        f.write(data[:len(data) // 2])
+
+    with pytest.raises(EOFError):
+        with DecompressingReader(filepath, chunk_size=64).start() as reader:
+            reader.read()
+
+
+def test_zstd_frames(tmpdir):
+    """
+    Test zstd files with several frames are decompressed to the end
+    """
+    zstandard = pytest.importorskip('zstandard')
+    data_dir = tmpdir.mkdir('data')
+    participant = _records('participant', 5000)
+    filepath = str(data_dir.join('participant.jsonl.zst'))
+    compressor = zstandard.ZstdCompressor()
+    with open(filepath, 'wb') as f:
+        for i in range(0, len(participant), 1000):
+            f.write(compressor.compress(''.join(
+                json.dumps(r) + '\n' for r in participant[i:i + 1000]
+            ).encode('utf-8')))
+
+    assert list(iter_payloads(str(data_dir))) == participant
+    # Frame boundaries within a chunk and across chunks
+    with DecompressingReader(filepath, chunk_size=64).start() as reader:
+        lines = reader.read().decode('utf-8').splitlines()
+    assert [json.loads(line) for line in lines] == participant
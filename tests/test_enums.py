@@ -0,0 +1,105 @@
+import io
+
+from fastavro import reader
+from sqlalchemy import Column, Integer, Text, create_engine
+from sqlalchemy.ext.declarative import declarative_base
+
+from pfb_exporter.enums import EnumDetector, decode_enum, parse_overrides
+from pfb_exporter.writer import PfbWriter
+
+
+def _schema():
+    return {
+        'genomic_file': {
+            'attributes': [
+                {'name': 'kf_id', 'type': 'string'},
+                {'name': 'data_type', 'type': 'string'},
+                {'name': 'file_format', 'type': 'string'},
+                {'name': 'external_id', 'type': 'string'},
+                {'name': 'paired_end', 'type': 'int'},
+            ]
+        }
+    }
+
+
+def _records(n=100):
+    return [
+        {
+            'type': 'genomic_file',
+            'kf_id': f'GF_{i:08d}',
+            'data_type': ['Aligned Reads', 'gVCF', 'Variant Calls'][i % 3],
+            'file_format': ['cram', 'bam'][i % 2],
+            'external_id': f's3://bucket/{i % 60}.cram',
+            'paired_end': i % 2,
+        }
+        for i in range(n)
+    ]
+
+
+def test_enum_detection():
+    """
+    Test pfb_exporter.enums.EnumDetector detects low-cardinality columns,
+    honors overrides and the writer encodes enum symbols
+    """
+    schema = _schema()
+    detector = EnumDetector(
+        schema,
+        threshold=10,
+        overrides=parse_overrides(['genomic_file.file_format=string'])
+    )
+    records = list(detector.observe_all(_records()))
+    assert detector.enums() == {
+        ('genomic_file', 'data_type'): [
+            'Aligned Reads', 'Variant Calls', 'gVCF'
+        ]
+    }
+    detector.apply(schema)
+
+    buf = io.BytesIO()
+    with PfbWriter(buf, schema) as writer:
+        writer.write_metadata()
+        writer.write_all(records)
+    buf.seek(0)
+
+    avro_reader = reader(buf)
+    node = [t for t in avro_reader.writer_schema['fields'][2]['type']
+            if t['name'] == 'genomic_file'][0]
+    types = {f['name']: f['type'][1] for f in node['fields']}
+    assert types['data_type']['type'] == 'enum'
+    assert types['file_format'] == 'string'
+
+    entities = list(avro_reader)[1:]
+    assert [decode_enum(e['object']['data_type']) for e in entities] == [
+        r['data_type'] for r in records
+    ]
+
+
+def test_enum_detection_database(tmpdir):
+    """
+    Test pfb_exporter.enums.EnumDetector.profile_database
+    """
+    Base = declarative_base()
+
+    class GenomicFile(Base):
+        __tablename__ = 'genomic_file'
+        kf_id = Column(Text, primary_key=True)
+        data_type = Column(Text)
+        file_format = Column(Text)
+        external_id = Column(Text)
+        paired_end = Column(Integer)
+
+    db_url = f'sqlite:///{tmpdir}/test.db'
+    engine = create_engine(db_url)
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(
+            GenomicFile.__table__.insert(),
+            [{k: v for k, v in r.items() if k != 'type'} for r in _records()]
+        )
+    engine.dispose()
+
+    detector = EnumDetector(_schema(), threshold=10)
+    detector.profile_database(db_url, {'GenomicFile': GenomicFile})
+    assert sorted(detector.enums()) == [
+        ('genomic_file', 'data_type'), ('genomic_file', 'file_format')
+    ]
@@ -0,0 +1,84 @@
+import os
+import gzip
+import json
+
+from click.testing import CliRunner
+from sqlalchemy import create_engine
+
+from test_subgraph import RECORDS, _write_models
+from pfb_exporter import cli
+from pfb_exporter.export import PfbExporter
+
+
+def test_estimate_payloads(tmpdir):
+    """
+    Test pfb_exporter.cli.estimate extrapolates the rows of payload files
+    from a sample of each file, without reading the whole file
+    """
+    models = _write_models(tmpdir)
+    data_dir = tmpdir.mkdir('data')
+    participants = [
+        {'kf_id': f'PT_{i:06d}', 'study_id': 'SD_1'} for i in range(500)
+    ]
+    with open(str(data_dir.join('participant.jsonl')), 'w') as jsonl_file:
+        jsonl_file.writelines(json.dumps(p) + '\n' for p in participants)
+    with gzip.open(str(data_dir.join('study.jsonl.gz')), 'wt') as jsonl_file:
+        jsonl_file.writelines(
+            json.dumps({'kf_id': f'SD_{i:06d}'}) + '\n' for i in range(300)
+        )
+    with open(str(data_dir.join('family.json')), 'w') as json_file:
+        json.dump([{'kf_id': f'FM_{i:06d}'} for i in range(400)], json_file)
+    with open(str(data_dir.join('biospecimen.json')), 'w') as json_file:
+        json.dump([{'kf_id': 'BS_000001', 'participant_id': 'PT_1'}],
+                  json_file)
+
+    output_dir = str(tmpdir.join('estimate'))
+    result = CliRunner().invoke(
+        cli.estimate,
+        [str(data_dir), '-m', models.__file__, '-o', output_dir,
+         '--sample_size', '50'],
+        catch_exceptions=False
+    )
+    assert result.exit_code == 0
+
+    with open(os.path.join(output_dir, 'estimate.json')) as json_file:
+        report = json.load(json_file)
+    tables = report['tables']
+    assert report['source'] == 'payloads'
+    assert tables['participant']['sampled'] == 50
+    # Extrapolated from the share of the file (or of the compressed file)
+    # read for the sample
+    for table, rows in [('participant', 500), ('study', 300),
+                        ('family', 400)]:
+        assert abs(tables[table]['rows'] - rows) < rows * 0.1
+    # Files read to the end are counted
+    assert tables['biospecimen']['rows'] == 1
+    assert report['total']['output_bytes'] > 0
+    assert report['memory']['peak_bytes'] >= report['memory']['baseline_bytes']
+
+
+def test_estimate_database(tmpdir):
+    """
+    Test an estimate from the database counts the rows of each table
+    """
+    models = _write_models(tmpdir)
+    engine = create_engine(f'sqlite:///{tmpdir}/test.db')
+    models.Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        for table in models.Base.metadata.sorted_tables:
+            conn.execute(table.insert(), RECORDS[table.name])
+
+    report = PfbExporter(
+        None,
+        models_filepath=models.__file__,
+        output_dir=str(tmpdir.join('estimate')),
+        engine=engine
+    ).estimate(sample_size=1)
+    engine.dispose()
+
+    assert report['source'] == 'database'
+    assert {
+        table: counts['rows'] for table, counts in report['tables'].items()
+    } == {table: len(records) for table, records in RECORDS.items()}
+    assert all(t['sampled'] == 1 for t in report['tables'].values())
+    assert report['total']['rows'] == 13
@@ -0,0 +1,174 @@
+import os
+import logging
+import threading
+
+from fastavro import reader
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+from pfb_exporter.export import PfbExporter
+from pfb_exporter.extract import RangeScanner
+from pfb_exporter.graph import iter_by_level
+from pfb_exporter.utils import import_module_from_file
+
+MODELS = """
+from sqlalchemy import Column, DateTime, ForeignKey, String
+from sqlalchemy.ext.declarative import declarative_base
+
+Base = declarative_base()
+
+
+class Family(Base):
+    __tablename__ = 'family'
+    kf_id = Column(String(11), primary_key=True)
+
+
+class Participant(Base):
+    __tablename__ = 'participant'
+    kf_id = Column(String(11), primary_key=True)
+    created_at = Column(DateTime)
+    family_id = Column(ForeignKey('family.kf_id'))
+"""
+
+# Two tables without foreign keys, in the same dependency level
+LEVEL_MODELS = """
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.ext.declarative import declarative_base
+
+Base = declarative_base()
+
+
+class Sample(Base):
+    __tablename__ = 'sample'
+    kf_id = Column(String(16), primary_key=True)
+    version = Column(Integer, primary_key=True)
+
+
+class Specimen(Base):
+    __tablename__ = 'specimen'
+    kf_id = Column(String(16), primary_key=True)
+"""
+
+
+def _create_db(tmpdir, n=1000):
+    models_filepath = str(tmpdir.join('models.py'))
+    with open(models_filepath, 'w') as models_file:
+        models_file.write(MODELS)
+    models = import_module_from_file(models_filepath)
+
+    engine = create_engine(f'sqlite:///{tmpdir}/test.db')
+    models.Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(
+            models.Family.__table__.insert(), [{'kf_id': 'FM_00000001'}]
+        )
+        conn.execute(models.Participant.__table__.insert(), [
+            {'kf_id': f'PT_{i:08d}', 'family_id': 'FM_00000001'}
+            for i in range(n)
+        ])
+    return models, engine
+
+
+def test_range_scanner(tmpdir, caplog):
+    """
+    Test pfb_exporter.extract.RangeScanner reads every row exactly once
+    across concurrent slices
+    """
+    models, engine = _create_db(tmpdir)
+    for key in [None, 'created_at']:
+        scanner = RangeScanner(
+            engine, models.Participant.__table__, key=key, slices=8,
+            workers=3, batch_size=50, min_rows=0
+        )
+        # created_at is null for all rows
+        assert len(scanner.slice_clauses()) == (8 if key is None else 2)
+
+        ids = [row['kf_id'] for row in scanner.scan()]
+        assert sorted(ids) == [f'PT_{i:08d}' for i in range(1000)]
+
+    with caplog.at_level(logging.WARNING):
+        scanner = RangeScanner(
+            engine, models.Family.__table__, key='created_at'
+        )
+    assert scanner.key.name == 'kf_id'
+    assert 'family has no column created_at' in caplog.text
+    engine.dispose()
+
+
+def test_export_from_database(tmpdir):
+    """
+    Test pfb_exporter.export.PfbExporter without a data dir exports from
+    the database
+    """
+    models, engine = _create_db(tmpdir, n=10)
+    output_dir = str(tmpdir.join('pfb_export'))
+    PfbExporter(
+        None,
+        models_filepath=models.__file__,
+        output_dir=output_dir,
+        scan_workers=2,
+        engine=engine,
+        setup_logging=False
+    ).run()
+    engine.dispose()
+
+    with open(os.path.join(output_dir, 'pfb.avro'), 'rb') as pfb_file:
+        names = [r['name'] for r in reader(pfb_file)]
+    assert names == ['Metadata', 'family'] + ['participant'] * 10
+
+
+def test_scans_share_slots(tmpdir):
+    """
+    Test the tables of a level scanned concurrently over fewer slots than
+    slices finish while the consumer reads one table at a time, without
+    opening more connections than the pool holds
+    """
+    models_filepath = str(tmpdir.join('level.py'))
+    with open(models_filepath, 'w') as models_file:
+        models_file.write(LEVEL_MODELS)
+    models = import_module_from_file(models_filepath)
+    # Checking out a connection beyond the pool fails
+    engine = create_engine(
+        f'sqlite:///{tmpdir}/level.db', poolclass=QueuePool, pool_size=2,
+        max_overflow=0, pool_timeout=5,
+        connect_args={'check_same_thread': False}
+    )
+    models.Base.metadata.create_all(engine)
+    tables = models.Base.metadata.tables
+    with engine.begin() as conn:
+        conn.execute(tables['sample'].insert(), [
+            {'kf_id': f'sample_{i // 3:08d}', 'version': i % 3}
+            for i in range(3000)
+        ])
+        conn.execute(tables['specimen'].insert(), [
+            {'kf_id': f'specimen_{i:08d}'} for i in range(3000)
+        ])
+
+    slots = threading.Semaphore(2)
+    ids = []
+
+    def _scan(name):
+        return RangeScanner(
+            engine, tables[name], slices=16, workers=2, batch_size=10,
+            min_rows=0, slots=slots
+        ).scan()
+
+    def _consume():
+        for row in iter_by_level(
+            [sorted(tables)], _scan, max_workers=2, prefetch_size=10
+        ):
+            ids.append(row['kf_id'])
+
+    thread = threading.Thread(target=_consume, daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    deadlocked = thread.is_alive()
+    if deadlocked:
+        # Free the scans so the test fails instead of hanging
+        for _ in range(100):
+            slots.release()
+        thread.join()
+    assert not deadlocked
+    assert len(ids) == 6000
+    assert len(set(ids)) == 4000
+    engine.dispose()
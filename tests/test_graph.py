@@ -0,0 +1,67 @@
+import pytest
+
+from pfb_exporter.graph import (
+    DependencyCycleError,
+    dependency_levels,
+    import_order,
+    iter_by_level
+)
+
+
+def _schema(fks):
+    return {
+        table: {'foreign_keys': [{'table': p, 'name': f'{p}_id'}
+                                 for p in parents]}
+        for table, parents in fks.items()
+    }
+
+
+def test_dependency_levels():
+    """
+    Test pfb_exporter.graph.dependency_levels groups tables parents first
+    and ignores self references
+    """
+    schema = _schema({
+        'study': [],
+        'family': [],
+        'participant': ['study', 'family', 'participant'],
+        'biospecimen': ['participant'],
+        'diagnosis': ['participant'],
+        'biospecimen_diagnosis': ['biospecimen', 'diagnosis'],
+    })
+    assert dependency_levels(schema) == [
+        ['family', 'study'],
+        ['participant'],
+        ['biospecimen', 'diagnosis'],
+        ['biospecimen_diagnosis'],
+    ]
+    order = import_order(schema)
+    assert order.index('participant') < order.index('diagnosis')
+
+
+def test_dependency_cycle():
+    """
+    Test pfb_exporter.graph.dependency_levels reports cycles
+    """
+    schema = _schema({
+        'study': [],
+        'a': ['study', 'c'],
+        'b': ['a'],
+        'c': ['b'],
+    })
+    with pytest.raises(DependencyCycleError) as e:
+        dependency_levels(schema)
+    assert sorted(e.value.cycle) == ['a', 'b', 'c']
+
+
+def test_iter_by_level():
+    """
+    Test pfb_exporter.graph.iter_by_level keeps table order within a level
+    when tables are produced concurrently
+    """
+    levels = [['a', 'b', 'c'], ['d']]
+    out = list(iter_by_level(
+        levels, lambda t: (f'{t}{i}' for i in range(50)),
+        max_workers=2, prefetch_size=5
+    ))
+    assert out == [f'{t}{i}' for t in 'abcd' for i in range(50)]
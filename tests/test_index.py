@@ -0,0 +1,138 @@
+import os
+
+import pytest
+from click.testing import CliRunner
+
+from conftest import TEST_DATA_DIR
+from pfb_exporter import cli
+from pfb_exporter.index import (
+    PfbIndex,
+    RecordIndexError,
+    build_index,
+    get_records,
+    index_path
+)
+from pfb_exporter.memory import MemoryGovernor
+from pfb_exporter.writer import PfbWriter
+
+DATA_DIR = os.path.join(TEST_DATA_DIR, 'input')
+
+PFB_SCHEMA = {
+    'family': {
+        'attributes': [{'name': 'kf_id', 'type': 'string'}]
+    },
+    'participant': {
+        'attributes': [
+            {'name': 'kf_id', 'type': 'string'},
+            {'name': 'age', 'type': 'int'},
+            {'name': 'family_id', 'type': 'string'},
+        ],
+        'foreign_keys': [{'table': 'family', 'name': 'family_id'}]
+    }
+}
+
+
+def _records(start, stop):
+    for i in range(start, stop):
+        yield {'type': 'family', 'kf_id': f'FM_{i}'}
+        yield {
+            'type': 'participant', 'kf_id': f'PT_{i}', 'age': i,
+            'family_id': f'FM_{i}'
+        }
+
+
+def _write(filepath, records, append=False, index=True):
+    with PfbWriter(
+        filepath, PFB_SCHEMA, codec='deflate', append=append,
+        sync_interval=256, index=index
+    ) as writer:
+        if not append:
+            writer.write_metadata()
+        writer.write_all(records)
+
+
+def test_index_lookup(tmpdir):
+    """
+    Test pfb_exporter.writer.PfbWriter writes a record id index which
+    pfb_exporter.index.get_records finds Entities with, and that
+    build_index builds the same index with spilled runs
+    """
+    pfb_file = str(tmpdir.join('pfb.avro'))
+    _write(pfb_file, _records(0, 2000))
+
+    with PfbIndex(index_path(pfb_file)) as index:
+        assert len(index) == 4000
+        assert index.types == ['family', 'participant']
+        assert len(index.find('family', 'FM_7')) == 1
+        assert index.find('family', 'PT_7') == []
+        assert index.find('biospecimen', 'PT_7') == []
+
+    entities = get_records(
+        pfb_file, 'participant', ['PT_1999', 'PT_5', 'PT_nope', 'PT_1000']
+    )
+    assert [e['id'] for e in entities] == ['PT_1999', 'PT_5', 'PT_1000']
+    assert entities[1]['object'] == {
+        'kf_id': 'PT_5', 'age': 5, 'family_id': 'FM_5'
+    }
+    assert entities[1]['relations'] == [
+        {'dst_id': 'FM_5', 'dst_name': 'family'}
+    ]
+
+    rebuilt = str(tmpdir.join('rebuilt.idx'))
+    assert build_index(
+        pfb_file, index_filepath=rebuilt, memory=MemoryGovernor(1024)
+    ) == 4000
+    with open(rebuilt, 'rb') as a, open(index_path(pfb_file), 'rb') as b:
+        assert a.read() == b.read()
+
+
+def test_index_append(tmpdir):
+    """
+    Test the record id index covers the appended and the existing records,
+    and that an index which is out of date is rejected
+    """
+    pfb_file = str(tmpdir.join('pfb.avro'))
+    _write(pfb_file, _records(0, 10))
+    os.remove(index_path(pfb_file))
+    # The existing records are indexed from their blocks
+    _write(pfb_file, _records(10, 500), append=True)
+    # The existing records are taken from the index
+    _write(pfb_file, _records(500, 1000), append=True)
+
+    ids = ['PT_3', 'PT_250', 'PT_999']
+    assert [
+        e['object']['age'] for e in get_records(pfb_file, 'participant', ids)
+    ] == [3, 250, 999]
+
+    _write(pfb_file, _records(1000, 1001), append=True, index=False)
+    with pytest.raises(RecordIndexError):
+        get_records(pfb_file, 'participant', ids)
+
+
+def test_get_cli(tmpdir):
+    """
+    Test pfb_exporter.cli.get finds Entities in an exported PFB file
+    """
+    output_dir = str(tmpdir.join('pfb_export'))
+    result = CliRunner().invoke(
+        cli.export, [DATA_DIR, '-m', DATA_DIR, '-o', output_dir]
+    )
+    assert result.exit_code == 0
+    pfb_file = os.path.join(output_dir, 'pfb.avro')
+
+    result = CliRunner().invoke(
+        cli.get, [pfb_file, 'family', 'family_drifty_undischarged']
+    )
+    assert result.exit_code == 0
+    assert '"external_id": "vade_Bombax"' in result.output
+
+    os.remove(index_path(pfb_file))
+    result = CliRunner().invoke(cli.get, [pfb_file, 'family', 'FM_1'])
+    assert result.exit_code == 1
+    assert 'pfbe index' in result.output
+
+    result = CliRunner().invoke(cli.index, [pfb_file])
+    assert result.exit_code == 0
+    result = CliRunner().invoke(cli.get, [pfb_file, 'family', 'FM_1'])
+    assert result.exit_code == 1
+    assert 'Not found: FM_1' in result.output
@@ -0,0 +1,147 @@
+import io
+import os
+import random
+import threading
+
+import pytest
+from fastavro import reader
+from click.testing import CliRunner
+
+from conftest import TEST_DATA_DIR
+from pfb_exporter import cli
+from pfb_exporter.container import Header, iter_blocks
+from pfb_exporter.graph import iter_by_level
+from pfb_exporter.index import IndexBuilder
+from pfb_exporter.memory import MemoryGovernor, parse_size
+from pfb_exporter.sort import ExternalSorter
+from pfb_exporter.writer import PfbWriter
+
+DATA_DIR = os.path.join(TEST_DATA_DIR, 'input')
+
+
+def test_memory_governor():
+    """
+    Test pfb_exporter.memory.MemoryGovernor asks the largest spillable
+    consumer to spill and blocks queues until they are drained
+    """
+    assert parse_size('8G') == 8 * 1024 ** 3
+    assert parse_size('1.5mb') == int(1.5 * 1024 ** 2)
+    assert parse_size('100') == 100
+    with pytest.raises(ValueError):
+        parse_size('8X')
+
+    governor = MemoryGovernor(100)
+    small = governor.consumer('small', spillable=True)
+    large = governor.consumer('large', spillable=True)
+    q = governor.consumer('queue')
+    assert not large.add(40)
+    assert not small.add(2)
+    # An empty queue always gets its item, even over budget
+    assert q.reserve(70)
+    # small can't bring the total back under budget and is not the largest
+    assert not small.add(1)
+    assert large.add(1)
+    large.spilled()
+    assert governor.used == 73
+
+    done = threading.Event()
+
+    def _reserve():
+        q.reserve(30)
+        done.set()
+
+    t = threading.Thread(target=_reserve)
+    t.start()
+    assert not done.wait(0.3)
+    q.release(70)
+    assert done.wait(5)
+    t.join()
+    assert governor.peak == 114
+    assert q.waits == 1 and large.spills == 1
+
+
+def test_tracked_memory_does_not_spill(tmpdir):
+    """
+    Test small spillable buffers are not spilled record by record while
+    tracking-only consumers hold more than the budget
+    """
+    governor = MemoryGovernor(100000)
+    tracked = governor.consumer('subgraph records', tracking=True)
+    tracked.add(200000)
+    assert governor.used == 200000 and not governor.over_budget
+
+    out = io.BytesIO()
+    pfb_schema = {'participant': {'attributes': [
+        {'name': 'kf_id', 'type': 'string'}
+    ]}}
+    with PfbWriter(out, pfb_schema, memory=governor) as writer:
+        writer.write_all(
+            {'type': 'participant', 'kf_id': f'PT_{i:04d}'}
+            for i in range(200)
+        )
+    out.seek(0)
+    assert len(list(iter_blocks(out, Header.read(out)))) == 1
+
+    builder = IndexBuilder(
+        max_buffer_size=1000, tmp_dir=str(tmpdir), memory=governor
+    )
+    for i in range(300):
+        builder.add('participant', f'PT_{i:04d}', 0, i)
+    assert builder._runs == []
+    builder.close()
+
+    # Spillable buffers holding a share of the budget still spill
+    sort_buffer = governor.consumer('sort buffer', spillable=True)
+    assert not sort_buffer.add(1000)
+    assert sort_buffer.add(100000)
+
+
+def test_sort_and_prefetch_within_budget(tmpdir):
+    """
+    Test the sort buffer spills and the prefetch queues make progress when
+    the budget is much smaller than the records
+    """
+    records = [
+        {'type': t, 'kf_id': f'{t[:2].upper()}_{i:04d}'}
+        for t in ['participant', 'family', 'study']
+        for i in range(500)
+    ]
+    random.Random(0).shuffle(records)
+
+    governor = MemoryGovernor(4096)
+    with ExternalSorter(tmp_dir=str(tmpdir), memory=governor) as sorter:
+        sorter.add_all(records)
+        assert sum(len(r) for r in sorter._runs.values()) > 3
+        out = list(iter_by_level(
+            sorter.order([['study', 'family', 'participant']]),
+            sorter.sorted_partition,
+            max_workers=3,
+            memory=governor
+        ))
+
+    assert [r['type'] for r in out] == (
+        ['study'] * 500 + ['family'] * 500 + ['participant'] * 500
+    )
+    assert governor.used == 0
+    assert governor.peak <= 4096 + max(c.peak for c in governor.consumers)
+
+
+def test_export_max_memory(tmpdir):
+    """
+    Test pfb_exporter.cli.export with --max_memory
+    """
+    output_dir = str(tmpdir.join('pfb_export'))
+    result = CliRunner().invoke(
+        cli.export,
+        [DATA_DIR, '-m', DATA_DIR, '-o', output_dir, '--max_memory', '1K']
+    )
+    assert result.exit_code == 0
+
+    with open(os.path.join(output_dir, 'pfb.avro'), 'rb') as pfb_file:
+        names = [r['name'] for r in reader(pfb_file)]
+    assert names == ['Metadata', 'family', 'participant']
+
+    result = CliRunner().invoke(
+        cli.export, [DATA_DIR, '-o', output_dir, '--max_memory', 'lots']
+    )
+    assert result.exit_code == 2
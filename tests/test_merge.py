@@ -0,0 +1,86 @@
+import os
+from copy import deepcopy
+
+from fastavro import reader
+from click.testing import CliRunner
+
+from pfb_exporter import cli
+from pfb_exporter.container import read_container
+from pfb_exporter.merge import PfbMerger
+from pfb_exporter.writer import PfbWriter
+
+PFB_SCHEMA = {
+    'family': {
+        'attributes': [
+            {'name': 'kf_id', 'type': 'string'},
+            {'name': 'size', 'type': 'int'},
+        ]
+    },
+    'participant': {
+        'attributes': [
+            {'name': 'kf_id', 'type': 'string'},
+            {'name': 'family_id', 'type': 'string'},
+        ],
+        'foreign_keys': [{'table': 'family', 'name': 'family_id'}]
+    }
+}
+
+
+def _write_pfb(filepath, pfb_schema, study, n, codec='null'):
+    with PfbWriter(filepath, pfb_schema, codec=codec) as writer:
+        writer.write_metadata()
+        for i in range(n):
+            writer.write({'type': 'family', 'kf_id': f'{study}_FM_{i}'})
+            writer.write({'type': 'participant', 'kf_id': f'{study}_PT_{i}',
+                          'family_id': f'{study}_FM_{i}'})
+
+
+def test_merge_identical(tmpdir):
+    """
+    Test pfb_exporter.cli.merge copies the data blocks of PFB files with
+    identical schemas
+    """
+    inputs = [os.path.join(str(tmpdir), f'{s}.avro') for s in ['a', 'b']]
+    for i, fp in enumerate(inputs):
+        _write_pfb(fp, PFB_SCHEMA, i, 20000)
+    output = os.path.join(str(tmpdir), 'merged', 'pfb.avro')
+
+    result = CliRunner().invoke(cli.merge, inputs + ['-o', output])
+    assert result.exit_code == 0
+
+    with open(output, 'rb') as f:
+        records = list(reader(f))
+    assert len(records) == 1 + 2 * 40000
+    assert [r['name'] for r in records].count('Metadata') == 1
+    assert records[0]['object']['nodes'][1]['links'][0]['dst'] == 'family'
+    assert records[-1]['id'] == '1_PT_19999'
+
+    header, _ = read_container(output)
+    assert header.sync != read_container(inputs[0])[0].sync
+
+
+def test_merge_compatible(tmpdir):
+    """
+    Test pfb_exporter.merge.PfbMerger merges PFB files with compatible
+    schemas and different codecs into the union of their schemas
+    """
+    other = deepcopy(PFB_SCHEMA)
+    other['family']['attributes'][1]['type'] = 'long'
+    other['study'] = {'attributes': [{'name': 'kf_id', 'type': 'string'}]}
+    a = os.path.join(str(tmpdir), 'a.avro')
+    b = os.path.join(str(tmpdir), 'b.avro')
+    _write_pfb(a, PFB_SCHEMA, 'a', 10)
+    _write_pfb(b, other, 'b', 10, codec='deflate')
+    output = os.path.join(str(tmpdir), 'merged.avro')
+
+    merger = PfbMerger([a, b], output)
+    assert merger.merge() == 40
+
+    with open(output, 'rb') as f:
+        records = list(reader(f))
+    assert [n['name'] for n in records[0]['object']['nodes']] == [
+        'family', 'participant', 'study'
+    ]
+    assert {r['id'] for r in records[1:]} == {
+        f'{s}_{t}_{i}' for s in 'ab' for t in ['FM', 'PT'] for i in range(10)
+    }
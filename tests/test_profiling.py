@@ -0,0 +1,41 @@
+import os
+import json
+import pstats
+
+from conftest import TEST_DATA_DIR
+from click.testing import CliRunner
+
+from pfb_exporter import cli
+
+DATA_DIR = os.path.join(TEST_DATA_DIR, 'input')
+
+
+def test_export_profile(tmpdir):
+    """
+    Test that pfb_exporter.cli.export --profile writes per phase profiles
+    """
+    output_dir = str(tmpdir)
+    runner = CliRunner()
+    result = runner.invoke(
+        cli.export,
+        [DATA_DIR, '-m', DATA_DIR, '-o', output_dir, '--profile', '-w', '2']
+    )
+    assert result.exit_code == 0
+
+    profile_dir = os.path.join(output_dir, 'profile')
+    with open(os.path.join(profile_dir, 'summary.json')) as summary_file:
+        summary = json.load(summary_file)
+    phases = ['import_models', 'create_schema', 'read', 'encode', 'write']
+    assert set(phases) <= set(summary)
+
+    for phase in phases:
+        base = os.path.join(profile_dir, phase)
+        assert pstats.Stats(f'{base}.pstats').total_calls > 0
+        assert os.path.exists(f'{base}-allocations.txt')
+        with open(f'{base}.collapsed') as collapsed_file:
+            for line in collapsed_file.read().splitlines():
+                stack, _, value = line.rpartition(' ')
+                assert stack and int(value) > 0
+
+    # Sorted partitions are merged on worker threads
+    assert os.path.exists(os.path.join(profile_dir, 'encode-workers.pstats'))
@@ -0,0 +1,65 @@
+import random
+
+from pfb_exporter.rows import RowPacker
+from pfb_exporter.sort import ExternalSorter
+
+PFB_SCHEMA = {
+    'participant': {
+        'attributes': [
+            {'name': 'kf_id', 'type': 'string'},
+            {'name': 'gender', 'type': 'string'},
+            {'name': 'family_id', 'type': 'string'},
+        ],
+        'foreign_keys': [{'table': 'family', 'name': 'family_id'}]
+    }
+}
+
+
+def test_row_packer():
+    """
+    Test pfb_exporter.rows.RowPacker packs records into rows and interns
+    string values
+    """
+    packer = RowPacker(PFB_SCHEMA, intern_pool_size=2)
+    records = [
+        {'kf_id': f'PT_{i}', 'gender': ''.join(['Fem', 'ale']),
+         'extra': 1, 'type': 'participant'}
+        for i in range(3)
+    ]
+    rows = [packer.pack(r) for r in records]
+
+    assert rows[0] == ('PT_0', 'Female', None, None)
+    assert rows[0].get('type') == 'participant'
+    assert rows[0].get('gender') == 'Female'
+    assert rows[0].get('extra', 'missing') == 'missing'
+    assert rows[0].to_dict()['kf_id'] == 'PT_0'
+    # The shared value is interned, values beyond the pool size are not
+    assert rows[1].get('gender') is rows[0].get('gender')
+    assert rows[2].get('kf_id') not in packer._pools['participant'][0]
+    assert packer.pack({'type': 'project'}) is None
+
+
+def test_sort_rows(tmpdir):
+    """
+    Test pfb_exporter.sort.ExternalSorter stores and yields rows when it has
+    a packer
+    """
+    records = [
+        {'type': 'participant', 'kf_id': f'PT_{i:04d}', 'gender': 'Male'}
+        for i in range(100)
+    ] + [{'type': 'project', 'kf_id': 'PR_0001'}]
+    random.Random(0).shuffle(records)
+
+    with ExternalSorter(
+        max_buffer_size=512, tmp_dir=str(tmpdir),
+        packer=RowPacker(PFB_SCHEMA)
+    ) as sorter:
+        sorter.add_all(records)
+        rows = list(sorter.sorted_partition('participant'))
+        projects = list(sorter.sorted_partition('project'))
+
+    assert [r.get('kf_id') for r in rows] == [
+        f'PT_{i:04d}' for i in range(100)
+    ]
+    assert all(r.get('type') == 'participant' for r in rows)
+    assert projects == [{'type': 'project', 'kf_id': 'PR_0001'}]
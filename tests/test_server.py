@@ -0,0 +1,47 @@
+import os
+import json
+import time
+import threading
+from urllib.request import Request, urlopen
+
+from conftest import TEST_DATA_DIR
+from pfb_exporter.server import ExportServer
+
+DATA_DIR = os.path.join(TEST_DATA_DIR, 'input')
+
+
+def _request(url, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    with urlopen(Request(url, data=data)) as resp:
+        return resp.status, json.loads(resp.read())
+
+
+def test_export_server(tmpdir):
+    """
+    Test pfb_exporter.server.ExportServer runs jobs submitted over HTTP
+    with the resident PFB schema
+    """
+    server = ExportServer(
+        models_filepath=DATA_DIR, output_dir=str(tmpdir), max_jobs=2
+    )
+    httpd = server.make_http_server(port=0)
+    url = f'http://127.0.0.1:{httpd.server_address[1]}'
+    t = threading.Thread(target=httpd.serve_forever, daemon=True)
+    t.start()
+    try:
+        status, job = _request(f'{url}/jobs', {'data_dir': DATA_DIR})
+        assert status == 202
+
+        for _ in range(100):
+            status, job = _request(f'{url}/jobs/{job["id"]}')
+            if job['status'] not in ('queued', 'running'):
+                break
+            time.sleep(0.05)
+        assert job['status'] == 'succeeded', job['error']
+        assert os.path.isfile(os.path.join(job['output_dir'], 'pfb.avro'))
+        assert os.path.isfile(
+            os.path.join(job['output_dir'], 'logs', 'pfb-export.log')
+        )
+    finally:
+        httpd.shutdown()
+        server.shutdown()
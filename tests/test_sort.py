@@ -0,0 +1,60 @@
+import os
+import random
+
+from fastavro import reader
+
+from conftest import TEST_DATA_DIR
+from click.testing import CliRunner
+
+from pfb_exporter import cli
+from pfb_exporter.sort import ExternalSorter
+
+OUTPUT_DIR = os.path.join(TEST_DATA_DIR, 'pfb_export')
+DATA_DIR = os.path.join(TEST_DATA_DIR, 'input')
+
+
+def test_external_sort(tmpdir):
+    """
+    Test pfb_exporter.sort.ExternalSorter spills and merges runs in
+    import order
+    """
+    records = [
+        {'type': t, 'kf_id': f'{t[:2].upper()}_{i:04d}'}
+        for t in ['participant', 'family', 'study']
+        for i in range(200)
+    ]
+    random.Random(0).shuffle(records)
+
+    with ExternalSorter(max_buffer_size=1024, tmp_dir=str(tmpdir)) as sorter:
+        sorter.add_all(records)
+        assert sum(len(r) for r in sorter._runs.values()) > 3
+
+        out = list(sorter.sorted_records(
+            [['study', 'family'], ['participant']], max_workers=2
+        ))
+
+    assert len(out) == len(records)
+    assert [r['type'] for r in out] == (
+        ['study'] * 200 + ['family'] * 200 + ['participant'] * 200
+    )
+    for t in ['study', 'family', 'participant']:
+        ids = [r['kf_id'] for r in out if r['type'] == t]
+        assert ids == sorted(ids)
+    assert not os.path.exists(sorter.run_dir)
+
+
+def test_export_import_order():
+    """
+    Test that pfb_exporter.cli.export writes parents before children
+    """
+    runner = CliRunner()
+    result = runner.invoke(
+        cli.export,
+        [DATA_DIR, '-m', DATA_DIR, '-o', OUTPUT_DIR]
+    )
+    assert result.exit_code == 0
+
+    with open(os.path.join(OUTPUT_DIR, 'pfb.avro'), 'rb') as pfb_file:
+        names = [r['name'] for r in reader(pfb_file)]
+
+    assert names == ['Metadata', 'family', 'participant']
@@ -0,0 +1,147 @@
+import os
+import json
+
+from fastavro import reader
+from click.testing import CliRunner
+
+from conftest import TEST_DATA_DIR
+from pfb_exporter import cli
+from pfb_exporter.stats import STATS_KEY, read_stats
+from pfb_exporter.writer import PfbWriter
+
+DATA_DIR = os.path.join(TEST_DATA_DIR, 'input')
+
+PFB_SCHEMA = {
+    'participant': {
+        'attributes': [
+            {'name': 'kf_id', 'type': 'string'},
+            {'name': 'age', 'type': 'int'},
+            {'name': 'notes', 'type': 'string'},
+            {'name': 'created_at', 'type': 'string', 'format': 'date-time'},
+        ]
+    }
+}
+
+
+def _write(filepath, records, codec='null', append=False):
+    with PfbWriter(
+        filepath, PFB_SCHEMA, codec=codec, append=append
+    ) as writer:
+        if not append:
+            writer.write_metadata()
+        for record in records:
+            writer.write(record, entity_type='participant')
+    return writer
+
+
+def test_writer_stats(tmpdir):
+    """
+    Test pfb_exporter.writer.PfbWriter stores statistics in the Metadata
+    Entity, with any codec and when appending
+    """
+    records = [
+        {'kf_id': f'PT_{i}', 'age': i % 7,
+         'created_at': f'2019-05-{i % 28 + 1:02d}T00:00:00'}
+        for i in range(5000)
+    ]
+    for codec in ['null', 'deflate']:
+        pfb_file = os.path.join(str(tmpdir), f'{codec}.avro')
+        writer = _write(pfb_file, records, codec=codec)
+
+        stats = read_stats(pfb_file)
+        assert stats == writer.stats
+        participant = stats['tables']['participant']
+        assert participant['count'] == stats['count'] == 5000
+        assert participant['bytes'] == stats['bytes'] > 0
+        assert participant['attributes']['notes']['null_count'] == 5000
+        assert participant['attributes']['age'] == {
+            'null_count': 0, 'min': 0, 'max': 6
+        }
+        assert participant['attributes']['created_at']['max'] == (
+            '2019-05-28T00:00:00'
+        )
+        with open(pfb_file, 'rb') as f:
+            assert len(list(reader(f))) == 5001
+
+    _write(pfb_file, [{'kf_id': 'PT_X', 'age': 100}], append=True)
+    stats = read_stats(pfb_file)
+    assert stats['count'] == 5001
+    assert stats['tables']['participant']['attributes']['age']['max'] == 100
+
+
+def test_deflate_stats(tmpdir):
+    """
+    Test statistics of a deflate output are rewritten without the padding
+    reserved for in place updates, also when appending
+    """
+    pfb_file = os.path.join(str(tmpdir), 'deflate.avro')
+
+    def _misc_stats():
+        with open(pfb_file, 'rb') as f:
+            metadata = next(reader(f))['object']
+        return metadata['misc'][STATS_KEY]
+
+    _write(pfb_file, [{'kf_id': f'PT_{i}', 'age': i} for i in range(10)],
+           codec='deflate')
+    value = _misc_stats()
+    assert value == value.strip()
+    assert json.loads(value)['count'] == 10
+
+    _write(pfb_file, [{'kf_id': 'PT_X', 'age': 100}], codec='deflate',
+           append=True)
+    value = _misc_stats()
+    assert value == value.strip()
+    stats = read_stats(pfb_file)
+    assert stats == json.loads(value)
+    assert stats['count'] == 11
+    assert stats['tables']['participant']['attributes']['age'] == {
+        'null_count': 0, 'min': 0, 'max': 100
+    }
+    with open(pfb_file, 'rb') as f:
+        assert len(list(reader(f))) == 12
+
+
+def test_stats_date_times(tmpdir):
+    """
+    Test min and max of date-time attributes compare points in time rather
+    than strings
+    """
+    pfb_file = os.path.join(str(tmpdir), 'dates.avro')
+    writer = _write(pfb_file, [
+        {'kf_id': 'PT_1', 'created_at': '2019-05-01T10:00:00+02:00'},
+        {'kf_id': 'PT_2', 'created_at': '2019-05-01T09:00:00Z'},
+        {'kf_id': 'PT_3', 'created_at': '2019-5-1T08:30:00'},
+        {'kf_id': 'PT_4', 'created_at': '2019-4-30T23:00:00-02:00'},
+        {'kf_id': 'PT_5', 'created_at': 'unknown'},
+    ])
+    created_at = writer.stats['tables']['participant']['attributes'][
+        'created_at'
+    ]
+    assert created_at['min'] == '2019-4-30T23:00:00-02:00'
+    assert created_at['max'] == '2019-05-01T09:00:00Z'
+
+    _write(pfb_file, [
+        {'kf_id': 'PT_6', 'created_at': '2019-5-2'}
+    ], append=True)
+    created_at = read_stats(pfb_file)['tables']['participant'][
+        'attributes'
+    ]['created_at']
+    assert created_at['min'] == '2019-4-30T23:00:00-02:00'
+    assert created_at['max'] == '2019-5-2'
+
+
+def test_export_stats(tmpdir):
+    """
+    Test that pfb_exporter.cli.export writes stats.json
+    """
+    output_dir = str(tmpdir)
+    result = CliRunner().invoke(
+        cli.export, [DATA_DIR, '-m', DATA_DIR, '-o', output_dir]
+    )
+    assert result.exit_code == 0
+
+    with open(os.path.join(output_dir, 'stats.json')) as json_file:
+        stats = json.load(json_file)
+    assert stats == read_stats(os.path.join(output_dir, 'pfb.avro'))
+    assert stats['count'] == 2
+    assert stats['tables']['participant']['count'] == 1
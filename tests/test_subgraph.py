@@ -0,0 +1,160 @@
+import os
+import json
+
+import pytest
+from fastavro import reader
+from sqlalchemy import create_engine
+
+from pfb_exporter.export import PfbExporter
+from pfb_exporter.subgraph import parse_root
+from pfb_exporter.utils import import_module_from_file
+
+MODELS = """
+from sqlalchemy import Column, ForeignKey, String
+from sqlalchemy.ext.declarative import declarative_base
+
+Base = declarative_base()
+
+
+class Study(Base):
+    __tablename__ = 'study'
+    kf_id = Column(String(11), primary_key=True)
+
+
+class Family(Base):
+    __tablename__ = 'family'
+    kf_id = Column(String(11), primary_key=True)
+
+
+class SequencingCenter(Base):
+    __tablename__ = 'sequencing_center'
+    kf_id = Column(String(11), primary_key=True)
+
+
+class Participant(Base):
+    __tablename__ = 'participant'
+    kf_id = Column(String(11), primary_key=True)
+    study_id = Column(ForeignKey('study.kf_id'), nullable=False)
+    family_id = Column(ForeignKey('family.kf_id'))
+
+
+class Biospecimen(Base):
+    __tablename__ = 'biospecimen'
+    kf_id = Column(String(11), primary_key=True)
+    participant_id = Column(ForeignKey('participant.kf_id'), nullable=False)
+    sequencing_center_id = Column(ForeignKey('sequencing_center.kf_id'))
+"""
+
+RECORDS = {
+    'study': [{'kf_id': 'SD_1'}, {'kf_id': 'SD_2'}],
+    'family': [{'kf_id': 'FM_1'}, {'kf_id': 'FM_2'}],
+    'sequencing_center': [{'kf_id': 'SC_1'}, {'kf_id': 'SC_2'}],
+    'participant': [
+        {'kf_id': 'PT_1', 'study_id': 'SD_1', 'family_id': 'FM_1'},
+        {'kf_id': 'PT_2', 'study_id': 'SD_1', 'family_id': None},
+        # Same family as PT_1 but in another study
+        {'kf_id': 'PT_3', 'study_id': 'SD_2', 'family_id': 'FM_1'},
+        {'kf_id': 'PT_4', 'study_id': 'SD_2', 'family_id': 'FM_2'},
+    ],
+    'biospecimen': [
+        {'kf_id': 'BS_1', 'participant_id': 'PT_1',
+         'sequencing_center_id': 'SC_1'},
+        {'kf_id': 'BS_2', 'participant_id': 'PT_2',
+         'sequencing_center_id': None},
+        {'kf_id': 'BS_3', 'participant_id': 'PT_4',
+         'sequencing_center_id': 'SC_2'},
+    ]
+}
+
+# Records connected to SD_1
+EXPECTED = {
+    'study': {'SD_1'},
+    'participant': {'PT_1', 'PT_2'},
+    'biospecimen': {'BS_1', 'BS_2'},
+    'family': {'FM_1'},
+    'sequencing_center': {'SC_1'},
+}
+
+
+def _write_models(tmpdir):
+    models_filepath = str(tmpdir.join('models.py'))
+    with open(models_filepath, 'w') as models_file:
+        models_file.write(MODELS)
+    return import_module_from_file(models_filepath)
+
+
+def _read_entities(output_dir):
+    entities = {}
+    with open(os.path.join(output_dir, 'pfb.avro'), 'rb') as pfb_file:
+        for entity in reader(pfb_file):
+            if entity['name'] == 'Metadata':
+                continue
+            entities.setdefault(entity['name'], set()).add(entity['id'])
+    return entities
+
+
+def test_parse_root():
+    """
+    Test pfb_exporter.subgraph.parse_root
+    """
+    assert parse_root('study:kf_id=SD_1') == ('study', 'kf_id', 'SD_1')
+    assert parse_root('study:name=a=b') == ('study', 'name', 'a=b')
+    for root in ['study', 'study:kf_id', 'study:=SD_1', ':kf_id=SD_1']:
+        with pytest.raises(ValueError):
+            parse_root(root)
+
+
+def test_subgraph_from_database(tmpdir):
+    """
+    Test a subgraph export from the database contains the root's
+    descendants and the parents they reference, and nothing else
+    """
+    models = _write_models(tmpdir)
+    engine = create_engine(f'sqlite:///{tmpdir}/test.db')
+    models.Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        for table in models.Base.metadata.sorted_tables:
+            conn.execute(table.insert(), RECORDS[table.name])
+
+    output_dir = str(tmpdir.join('pfb_export'))
+    PfbExporter(
+        None,
+        models_filepath=models.__file__,
+        output_dir=output_dir,
+        engine=engine,
+        root=('study', 'kf_id', 'SD_1')
+    ).run()
+    engine.dispose()
+
+    assert _read_entities(output_dir) == EXPECTED
+    with open(os.path.join(output_dir, 'stats.json')) as json_file:
+        assert json.load(json_file)['count'] == 7
+
+
+def test_subgraph_from_payloads(tmpdir):
+    """
+    Test a subgraph export from payloads selects the same records as from
+    the database
+    """
+    models = _write_models(tmpdir)
+    data_dir = tmpdir.mkdir('data')
+    for table, records in RECORDS.items():
+        with open(str(data_dir.join(f'{table}.json')), 'w') as json_file:
+            json.dump(records, json_file)
+
+    output_dir = str(tmpdir.join('pfb_export'))
+    PfbExporter(
+        str(data_dir),
+        models_filepath=models.__file__,
+        output_dir=output_dir,
+        root=('study', 'kf_id', 'SD_1')
+    ).run()
+    assert _read_entities(output_dir) == EXPECTED
+
+    with pytest.raises(ValueError):
+        PfbExporter(
+            str(data_dir),
+            models_filepath=models.__file__,
+            output_dir=output_dir,
+            root=('study', 'kf_id', 'SD_3')
+        ).run()
@@ -0,0 +1,106 @@
+import os
+import json
+import shlex
+import subprocess
+
+import pytest
+from sqlalchemy import create_engine
+
+from test_subgraph import MODELS, RECORDS, _read_entities, _write_models
+from pfb_exporter.export import PfbExporter
+from pfb_exporter.graph import select_tables
+from pfb_exporter.transform.sqla import SqlaTransformer
+
+PARENTS = {
+    'study': set(),
+    'family': set(),
+    'sequencing_center': set(),
+    'participant': {'study', 'family'},
+    'biospecimen': {'participant', 'sequencing_center'},
+}
+
+
+def test_select_tables():
+    """
+    Test pfb_exporter.graph.select_tables pulls in the parents of selected
+    tables unless they are excluded
+    """
+    assert select_tables(
+        PARENTS, PARENTS.get, include=['biospecimen']
+    ) == set(PARENTS)
+    assert select_tables(
+        PARENTS, PARENTS.get, include=['biospecimen'],
+        exclude=['sequencing_center', 'family']
+    ) == {'biospecimen', 'participant', 'study'}
+    # Children of excluded tables are kept without their foreign keys
+    assert select_tables(
+        PARENTS, PARENTS.get, exclude=['participant']
+    ) == {'study', 'family', 'sequencing_center', 'biospecimen'}
+    with pytest.raises(ValueError):
+        select_tables(PARENTS, PARENTS.get, include=['specimen'])
+
+
+def test_export_selected_tables(tmpdir):
+    """
+    Test an export of selected tables from the database leaves out the
+    other tables and the foreign keys to excluded tables
+    """
+    models = _write_models(tmpdir)
+    engine = create_engine(f'sqlite:///{tmpdir}/test.db')
+    models.Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        for table in models.Base.metadata.sorted_tables:
+            conn.execute(table.insert(), RECORDS[table.name])
+
+    output_dir = str(tmpdir.join('pfb_export'))
+    PfbExporter(
+        None,
+        models_filepath=models.__file__,
+        output_dir=output_dir,
+        engine=engine,
+        tables=['biospecimen'],
+        exclude_tables=['sequencing_center']
+    ).run()
+    engine.dispose()
+
+    assert set(_read_entities(output_dir)) == {
+        'study', 'family', 'participant', 'biospecimen'
+    }
+    with open(os.path.join(output_dir, 'pfb-schema.json')) as json_file:
+        pfb_schema = json.load(json_file)
+    assert [
+        fk['table'] for fk in pfb_schema['biospecimen']['foreign_keys']
+    ] == ['participant']
+
+
+def test_generate_selected_models(tmpdir, monkeypatch):
+    """
+    Test only the selected tables and their parents are reflected when the
+    models are generated from the database
+    """
+    models = _write_models(tmpdir)
+    engine = create_engine(f'sqlite:///{tmpdir}/test.db')
+    models.Base.metadata.create_all(engine)
+    engine.dispose()
+
+    commands = []
+    models_filepath = str(tmpdir.join('generated.py'))
+
+    def _sqlacodegen(cmd_str, **kwargs):
+        commands.append(cmd_str)
+        with open(models_filepath, 'w') as models_file:
+            models_file.write(MODELS)
+        return subprocess.CompletedProcess(cmd_str, 0)
+
+    monkeypatch.setattr(subprocess, 'run', _sqlacodegen)
+    pfb_schema = SqlaTransformer(
+        models_filepath, None,
+        db_conn_url=f'sqlite:///{tmpdir}/test.db',
+        tables=['participant'],
+        db_schema='main'
+    ).transform()
+
+    assert shlex.split(commands[0])[-4:] == [
+        '--schema', 'main', '--tables', 'family,participant,study'
+    ]
+    assert set(pfb_schema) == {'family', 'participant', 'study'}
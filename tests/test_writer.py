@@ -0,0 +1,58 @@
+import io
+
+from fastavro import reader, schemaless_writer
+
+from pfb_exporter.writer import PfbWriter, compile_schema
+
+ATTRIBUTES = [
+    {'name': 'kf_id', 'type': 'string'},
+    {'name': 'visible', 'type': 'boolean'},
+]
+
+PFB_SCHEMA = {
+    'family': {'attributes': ATTRIBUTES},
+    'sample': {'attributes': ATTRIBUTES},
+    'participant': {
+        'attributes': ATTRIBUTES + [
+            {'name': 'age', 'type': 'int'},
+            {'name': 'gender', 'type': 'enum', 'symbols': ['Female', 'Male']},
+        ],
+        'foreign_keys': [{'table': 'family', 'name': 'family_id'}]
+    }
+}
+
+
+def test_tagged_schemas():
+    """
+    Test Entities encoded with the tagged schema of their table have the
+    same bytes as with the PFB Entity schema, and tables with the same
+    fields are written to their own union branch
+    """
+    compiled = compile_schema(PFB_SCHEMA)
+    writer = PfbWriter(io.BytesIO(), PFB_SCHEMA)
+    entity = writer.make_entity({
+        'type': 'participant', 'kf_id': 'PT_1', 'age': 3, 'gender': 'Male',
+        'family_id': 'FM_1'
+    })
+    union, tagged = io.BytesIO(), io.BytesIO()
+    schemaless_writer(union, compiled.parsed_schema, entity)
+    schemaless_writer(
+        tagged, compiled.tagged_schemas['participant'], entity
+    )
+    assert union.getvalue() == tagged.getvalue()
+
+    out = io.BytesIO()
+    with PfbWriter(out, PFB_SCHEMA) as writer:
+        writer.write_metadata()
+        writer.write_all([
+            {'type': 'family', 'kf_id': 'FM_1', 'visible': True},
+            {'type': 'sample', 'kf_id': 'SA_1', 'visible': True},
+            {'type': 'participant', 'kf_id': 'PT_1'},
+        ])
+    out.seek(0)
+    records = list(reader(out, return_record_name=True))
+    assert [(r['name'], r['object'][0]) for r in records[1:]] == [
+        ('family', 'family'),
+        ('sample', 'sample'),
+        ('participant', 'participant'),
+    ]